@@ -3,18 +3,189 @@
 from mrjob.job import MRJob
 from mrjob.step import MRStep
 from json import loads
-from functools import reduce
+from functools import cached_property
 import numpy as np
 
 class Align_Hadoop(MRJob):
     # Include additional files needed by the job
-    FILES = ['seq_utils.py']
-    
+    FILES = ['seq_utils.py', 'kmer_index.py', 'seq_format.py', 'reducer_utils.py', 'reference_cache.py', 'job_metrics.py']
+
+    def configure_args(self):
+        super(Align_Hadoop, self).configure_args()
+        self.add_file_arg(
+            '--cdna_file', default=None, help='JSON lines of the cDNAs, shipped to every mapper (broadcast join); the input is then only the sequences')
+        self.add_file_arg(
+            '--reference_cache', default=None, help='pre-encoded cDNAs (reference_cache.build_reference_cache) memory-mapped by every mapper instead of --cdna_file')
+        self.add_passthru_arg(
+            '--engine', type=str, default='scalar', choices=['scalar', 'vectorized'], help='quality adjusted Smith-Waterman implementation')
+        self.add_passthru_arg(
+            '--input_format', type=str, default='json', choices=['json', 'packed'], help='format of the input lines (and --cdna_file), JSON or the 2-bit packed format of seq_format')
+        self.add_passthru_arg(
+            '--mode', type=str, default='full', choices=['full', 'banded', 'xdrop', 'pseudo'], help='align against the whole transcript, or around the best shared k-mer within a band or by X-drop extension, or pseudoalign with the k-mers (needs --cdna_file or --reference_cache)')
+        self.add_passthru_arg(
+            '--seed_length', type=int, default=11, help='k-mer length of the seeds of the banded and xdrop modes and of the pseudo mode index (e.g. 31)')
+        self.add_file_arg(
+            '--kmer_index', default=None, help='k-mer index (.npz from kmer_index.build_kmer_index) of the reference for the pseudo mode, built by every mapper if not given')
+        self.add_passthru_arg(
+            '--band_width', type=int, default=16, help='half width of the band around the seed diagonal (banded mode)')
+        self.add_passthru_arg(
+            '--x_drop', type=float, default=20, help='score drop-off that stops the extensions (xdrop mode)')
+        self.add_passthru_arg(
+            '--prefilter', action='store_true', default=False, help='skip the pairs whose bit-parallel edit distance bound cannot beat the k-th best score of the read so far')
+        self.add_passthru_arg(
+            '--top_k', type=int, default=1, help='number of best transcripts counted per sequence')
+        self.add_passthru_arg(
+            '--ties', type=str, default='all', choices=['all', 'lowest_id'], help='keep all transcripts tying with the k-th best, or break ties by the lowest transcript ID')
+        self.add_passthru_arg(
+            '--umi_count', action='store_true', default=False, help='count unique (cell, UMI) pairs per feature and output a sparse cell x feature matrix')
+        self.add_passthru_arg(
+            '--barcode_length', type=int, default=16, help='length of the cell barcode at the start of the barcode read (10x 3\' v3.1: 16)')
+        self.add_passthru_arg(
+            '--umi_length', type=int, default=12, help='length of the UMI following the cell barcode (10x 3\' v3.1: 12)')
+        self.add_passthru_arg(
+            '--profile_task', type=int, default=None, help='run a sampling profiler in the mapper task with this partition number, its collapsed stacks are written to the task log')
+        self.add_file_arg(
+            '--feature_map', default=None, help='transcript_id<TAB>feature lines (e.g. gene IDs) to count features instead of transcripts with --umi_count')
+        self.add_file_arg(
+            '--scoring_matrix', default=None, help='substitution matrix file (seq_utils.read_score_table, e.g. NCBI NUC.4.4), default: match 2, mismatch -1, N 0')
+        self.add_passthru_arg(
+            '--gap_open', type=float, default=-2, help='score of the first base of a gap')
+        self.add_passthru_arg(
+            '--gap_extend', type=float, default=None, help='score of every further base of a gap (affine gaps, needs the vectorized engine or --mode banded), default: --gap_open (linear gaps)')
+
+    def alignment_engine(self):
+        """
+        Returns the quality adjusted alignment function selected by --engine and --mode.
+        """
+        from seq_utils import quality_alignment_engine
+        return quality_alignment_engine(self.options.engine, self.options.mode, self.options.seed_length, self.options.band_width, self.options.x_drop)
+
+    @cached_property
+    def scoring(self):
+        """
+        The seq_utils.ScoringScheme of --scoring_matrix, --gap_open and --gap_extend, built once per task.
+        """
+        from seq_utils import ScoringScheme
+        return ScoringScheme.from_file(self.options.scoring_matrix, self.options.gap_open, self.options.gap_extend)
+
+    def read_record(self, line):
+        """
+        Parses an input line in the format given by --input_format.
+        """
+        if self.options.input_format == 'packed':
+            from seq_format import decode_record
+            return decode_record(line)
+        return loads(line)
+
+    def mapper_init_metrics(self):
+        """
+        Sets up the metered parsing and alignment functions of a mapper task (see job_metrics) and,
+        in the task selected by --profile_task, the sampling profiler.
+        """
+        from job_metrics import metered, quality_cells, start_profiler, task_partition
+        from seq_utils import score_bound_profile, profile_score_bound
+        self.metrics = {}
+        self.profile = start_profiler() if self.options.profile_task == task_partition() else None
+        self.parse = metered(self.metrics, 'parse', self.read_record)
+        self.align = metered(self.metrics, 'align', self.alignment_engine(), quality_cells)
+        self.bound_profile = metered(self.metrics, 'prefilter', score_bound_profile)
+        self.score_bound = metered(self.metrics, 'prefilter', profile_score_bound)
+
+    def mapper_final_metrics(self):
+        """
+        Reports the metrics of the mapper task in the 'alignment' counter group and stops the profiler.
+        """
+        from job_metrics import flush_counters, stop_profiler
+        flush_counters(self, 'alignment', self.metrics)
+        if self.profile is not None:
+            stop_profiler(self.profile)
+        return iter(())
+
+    def mapper_init_broadcast(self):
+        """
+        Loads the cDNA reference once per mapper task, --reference_cache is memory-mapped without parsing or encoding.
+        The pseudo mode loads (or builds) the k-mer index of the reference too.
+        """
+        self.mapper_init_metrics()
+        if self.options.reference_cache:
+            from reference_cache import open_reference_cache, cached_records
+            self.cdnas = list(cached_records(open_reference_cache(self.options.reference_cache)))
+        else:
+            with open(self.options.cdna_file, 'r') as file:
+                self.cdnas = [self.read_record(line) for line in file if line.strip()]
+        if self.options.mode == 'pseudo':
+            from kmer_index import build_kmer_index, load_kmer_index
+            self.sequences = {cdna['transcript_id']: cdna['sequence'] for cdna in self.cdnas}
+            if self.options.kmer_index:
+                self.index = load_kmer_index(self.options.kmer_index)
+            else:
+                self.index = build_kmer_index(self.cdnas, self.options.seed_length)
+
+    def mapper_broadcast(self, _, line):
+        """
+        Aligns one sequence against all cDNAs of the reference and yields only its top-k (transcript_id, score) hits,
+        so no cartesian product goes through the shuffle.
+        """
+        from seq_utils import prefilter_alignments
+        from reducer_utils import top_hits
+        from job_metrics import add_metrics
+        substitution_matrix, gap_penalty = self.scoring.substitution_matrix, self.scoring.gap_penalty
+        seq = self.parse(line)
+        if 'barcode' not in seq:
+            return # cDNAs are read from --cdna_file or --reference_cache
+        add_metrics(self.metrics, {'records in': 1})
+        if self.options.mode == 'pseudo':
+            yield from self.mapper_pseudo(seq, self.align)
+            return
+        if self.options.prefilter:
+            alignments = self.count_pruned(prefilter_alignments(seq['sequence'], seq['quality'], ((cdna['transcript_id'], cdna['sequence']) for cdna in self.cdnas),
+                                                                self.align, substitution_matrix, gap_penalty, self.options.top_k))
+        else:
+            alignments = ((cdna['transcript_id'], self.align(seq['sequence'], seq['quality'], cdna['sequence'], substitution_matrix, gap_penalty)) for cdna in self.cdnas)
+        hits = ((transcript_id, alignment[0]) for transcript_id, alignment in alignments if alignment is not None) # Seeded modes skip the cDNAs without a shared k-mer
+        for hit in top_hits(hits, self.options.top_k, self.options.ties, unique=True): # One hit per transcript of a windowed reference
+            yield seq['barcode'], hit
+
+    def mapper_pseudo(self, seq, quality_adjusted_smith_waterman):
+        """
+        Pseudoaligns one sequence with the k-mer index and yields its top-k (transcript_id, support) hits,
+        only the ambiguous sequences are aligned, against their compatible transcripts.
+        The sequences are counted by status in the 'pseudo <status>' metrics.
+        """
+        from kmer_index import pseudoalign_hits
+        from job_metrics import add_metrics
+        substitution_matrix, gap_penalty = self.scoring.substitution_matrix, self.scoring.gap_penalty
+        hits, status = pseudoalign_hits(self.index, self.sequences, seq['sequence'], seq['quality'], quality_adjusted_smith_waterman,
+                                        substitution_matrix, gap_penalty, self.options.top_k, self.options.ties)
+        add_metrics(self.metrics, {'pseudo ' + status: 1})
+        for hit in hits:
+            yield seq['barcode'], hit
+
+    def count_pruned(self, alignments):
+        """
+        Counts the pairs skipped by the prefilter (alignment None) in the 'pairs pruned' metric.
+        """
+        from job_metrics import add_metrics
+        for transcript_id, alignment in alignments:
+            if alignment is None:
+                add_metrics(self.metrics, {'pairs pruned': 1})
+            yield transcript_id, alignment
+
+    def combiner_alignments(self, barcode, hits):
+        """
+        Keeps only the top-k hits of each barcode before the shuffle.
+        """
+        from reducer_utils import top_hits
+        for hit in top_hits(hits, self.options.top_k, self.options.ties):
+            yield barcode, hit
+
     def mapper_read(self, _, line):
         """
-        Reads each line of input and parses it as JSON.
+        Reads each line of input and parses it as JSON (or the packed format).
         """
-        yield _, loads(line)
+        from job_metrics import add_metrics
+        add_metrics(self.metrics, {'records in': 1})
+        yield _, self.parse(line)
         
     def reducer_catesian(self, _, jsons):
         """
@@ -32,50 +203,130 @@ class Align_Hadoop(MRJob):
             for seq in sequences:
                 yield seq, cdna
 
-    def mapper_swa(self, seq, cdna):
+    def mapper_init_swa(self):
         """
-        Applies the quality-adjusted Smith-Waterman algorithm to each sequence and cDNA pair.
+        Top-k scores and score bound profile of each sequence seen by this mapper task so far, for --prefilter.
         """
-        from seq_utils import quality_adjusted_smith_waterman, substitution_matrix, gap_penalty
-        yield seq['barcode'], (cdna['transcript_id'], *quality_adjusted_smith_waterman(seq['sequence'], seq['quality'], cdna['sequence'], substitution_matrix, gap_penalty))
+        self.mapper_init_metrics()
+        self.best_scores = {}
+        self.bound_profiles = {}
 
-    def mergeValue(self, c,v):
+    def mapper_swa(self, seq, cdna):
         """
-        Merges the current best alignments with a new alignment.
+        Applies the quality-adjusted Smith-Waterman algorithm to each sequence and cDNA pair and yields its score.
+        With --prefilter, pairs whose score bound is below the k-th best score of the sequence so far are skipped.
         """
-        if not c: # If no current best alignment, use the new value
-            return [v]
-        if c[0][1] > v[1]: # If the current best score is higher, keep the current best
-            return c
-        elif c[0][1] == v[1]: # If the scores are equal, append the new alignment
-            c.append(v)
-            return c
-        else: # If the new score is higher, use the new value
-            return [v]
+        from seq_utils import below_score, push_score
+        from job_metrics import add_metrics
+        substitution_matrix, gap_penalty = self.scoring.substitution_matrix, self.scoring.gap_penalty
+        best_scores = self.best_scores.setdefault(seq['barcode'], [])
+        if self.options.prefilter and len(best_scores) == self.options.top_k:
+            # The per-read part of the bound is computed once per sequence, not per pair
+            if seq['barcode'] not in self.bound_profiles:
+                self.bound_profiles[seq['barcode']] = self.bound_profile(seq['sequence'], seq['quality'], substitution_matrix, gap_penalty)
+            if below_score(self.score_bound(self.bound_profiles[seq['barcode']], seq['sequence'], cdna['sequence']), best_scores[0]):
+                add_metrics(self.metrics, {'pairs pruned': 1})
+                return
+        alignment = self.align(seq['sequence'], seq['quality'], cdna['sequence'], substitution_matrix, gap_penalty)
+        if alignment is not None: # Seeded modes skip the pairs without a shared k-mer
+            push_score(best_scores, alignment[0], self.options.top_k)
+            yield seq['barcode'], (cdna['transcript_id'], alignment[0])
 
-    def reducer_alignments(self, barcode, alignments):
+    def reducer_alignments(self, barcode, hits):
         """
-        Reduces the alignments to keep only the best ones for each barcode.
+        Reduces the hits to keep only the top-k ones for each barcode.
         """
-        for alignment in reduce(self.mergeValue, alignments, []):
-            yield alignment[0], barcode
+        from reducer_utils import top_hits
+        for hit in top_hits(hits, self.options.top_k, self.options.ties):
+            yield hit[0], barcode
 
     def reducer_featurecount(self, feature, barcodes):
         """
         Counts the number of unique barcodes associated with each feature.
         """
-        yield feature, len(list(barcodes))
+        yield feature, sum(1 for _ in barcodes) # Count without materializing the barcodes
+
+    def mapper_init_umi(self):
+        """
+        Loads the --feature_map once per mapper task.
+        """
+        self.features = {}
+        if self.options.feature_map:
+            with open(self.options.feature_map, 'r') as file:
+                self.features = dict(line.rstrip('\n').split('\t', 1) for line in file if line.strip())
+
+    def mapper_umi(self, transcript_id, barcode):
+        """
+        Splits the barcode read into cell barcode and UMI and keys each assignment by (cell, UMI, feature).
+        """
+        cell = barcode[:self.options.barcode_length]
+        umi = barcode[self.options.barcode_length:self.options.barcode_length + self.options.umi_length]
+        yield (cell, umi, self.features.get(transcript_id, transcript_id)), None
+
+    def combiner_umi(self, key, _):
+        """
+        Collapses the PCR duplicates of a mapper task, each (cell, UMI, feature) goes through the shuffle once.
+        """
+        yield key, None
+
+    def reducer_umi(self, key, _):
+        """
+        Emits one count per unique (cell, UMI, feature).
+        """
+        cell, umi, feature = key
+        yield (cell, feature), 1
+
+    def reducer_matrix(self, key, counts):
+        """
+        Sums the UMI counts of a (cell, feature) entry of the matrix, without materializing them.
+        """
+        yield key, sum(counts)
+
+    def count_steps(self):
+        """
+        The counting steps: reads per transcript, or with --umi_count the sparse cell x feature matrix of UMI counts.
+        """
+        if self.options.umi_count:
+            return [
+                MRStep(mapper_init=self.mapper_init_umi,
+                       mapper=self.mapper_umi,
+                       combiner=self.combiner_umi,
+                       reducer=self.reducer_umi),
+                MRStep(combiner=self.reducer_matrix,
+                       reducer=self.reducer_matrix)
+            ]
+        return [MRStep(reducer=self.reducer_featurecount)]
     
     def steps(self):
         """
         Defines the steps of the MapReduce job.
+        With --cdna_file or --reference_cache the cDNAs are joined map-side instead of through the cartesian reducer.
         """
+        if self.options.mode == 'pseudo' and not (self.options.cdna_file or self.options.reference_cache):
+            raise ValueError("--mode pseudo needs the reference map-side, use --cdna_file or --reference_cache")
+        # The banded mode supports affine gaps with either engine, the full alignments of full and pseudo only the vectorized one
+        if self.options.gap_extend not in (None, self.options.gap_open) and (self.options.mode == 'xdrop' or (self.options.engine == 'scalar' and self.options.mode != 'banded')):
+            raise ValueError("Affine gaps (--gap_extend) need --mode banded, or --engine vectorized and a mode other than xdrop")
+        if self.options.cdna_file or self.options.reference_cache:
+            return [
+                MRStep(mapper_init=self.mapper_init_broadcast,
+                       mapper=self.mapper_broadcast,
+                       mapper_final=self.mapper_final_metrics,
+                       combiner=self.combiner_alignments,
+                       reducer=self.reducer_alignments),
+                *self.count_steps()
+            ]
         return [
-            MRStep(mapper=self.mapper_read,
+            MRStep(mapper_init=self.mapper_init_metrics,
+                   mapper=self.mapper_read,
+                   mapper_final=self.mapper_final_metrics,
                    reducer=self.reducer_catesian),
-            MRStep(mapper=self.mapper_swa,
+            MRStep(mapper_init=self.mapper_init_swa,
+                   mapper=self.mapper_swa,
+                   mapper_final=self.mapper_final_metrics,
+                   combiner=self.combiner_alignments,
                    reducer=self.reducer_alignments),
-            MRStep(reducer=self.reducer_featurecount)
+            *self.count_steps()
         ]
 
 
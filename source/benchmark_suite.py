@@ -0,0 +1,270 @@
+import argparse
+import csv
+import os
+import random
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from json import dumps
+from multiprocessing import get_context
+from time import time, perf_counter
+from benchmark_utils import generate_random_dna_sequence
+from seq_utils import read_fasta
+
+# Scripted benchmark suite replacing the runs of blastn_benchmark.ipynb and align_benchmark.ipynb.
+# Every grid point (system, dataset size, query length or number of sequences, run) is measured in a fresh process,
+# so the peak RSS of a measurement isn't inflated by the previous ones, and the datasets are generated from fixed seeds.
+# The runtime of the distributed systems is split into phases:
+#   startup   Spark session start and/or the runtime of the same job on a single short cDNA (job launch, JVMs, pool start)
+#   io        writing the dataset to HDFS
+#   compute   runtime minus the startup baseline, used for the cell updates per second (GCUPS)
+# The results are written as CSV and JSON lines to benchmark/<task>_suite_<timestamp>.{csv,json},
+# with the column names of Visualize_Benchmark.ipynb ("System", "Run", "n_cDNAs", "len_query"/"n_Sequences", "runtime [s]").
+#
+# Example:
+#   python benchmark_suite.py blastn --systems scalar vectorized local --n_cdnas 10 100 1000 --len_query 20 80 --runs 3
+#   python benchmark_suite.py align --systems spark hadoop --n_cdnas 100 1000 --n_sequences 10 100 --hdfs_url http://host.docker.internal:9870
+
+SYSTEMS = {'scalar': 'Scalar', 'vectorized': 'Vectorized', 'local': 'Local', 'spark': 'Spark', 'hadoop': 'Hadoop'}
+WEIGHTS = {'A': 6, 'C': 4, 'G': 4, 'T': 6}  # Base composition of the notebook runs
+
+
+def dataset_rng(*key):
+    """
+    Returns a generator seeded by the grid point, a string seed is hashed deterministically across processes.
+    """
+    return random.Random('-'.join(map(str, key)))
+
+
+def generate_cdnas(n, length, seed, fasta=None):
+    """
+    Generates n random cDNAs of the given length, or samples n cDNAs of a FASTA file and keeps their 3' tail
+    of at most length bases (like the notebook runs, the sequencing is done on the 3' end).
+    """
+    rng = dataset_rng(seed, 'cdnas', n)
+    if fasta:
+        return [{"transcript_id": cdna['transcript_id'], "sequence": cdna['sequence'][-length:]} for cdna in rng.sample(read_fasta(fasta), n)]
+    return [{"transcript_id": "T%07d" % k, "sequence": generate_random_dna_sequence(length, weights=WEIGHTS, rng=rng)} for k in range(n)]
+
+
+def generate_sequences(cdnas, n, length, seed):
+    """
+    Generates n single-cell reads: substrings of random cDNAs with random 28 base barcodes and quality strings.
+    """
+    rng = dataset_rng(seed, 'sequences', len(cdnas), n)
+    sequences = []
+    for _ in range(n):
+        cdna = rng.choice(cdnas)['sequence']
+        start = rng.randrange(max(1, len(cdna) - length + 1))
+        sequence = cdna[start:start + length]
+        sequences.append({"barcode": generate_random_dna_sequence(28, rng=rng),
+                          "sequence": sequence,
+                          "quality": ''.join(rng.choice('FFFF:,') for _ in sequence)})
+    return sequences
+
+
+def peak_rss():
+    """
+    Peak resident set size in MB of this process and of its largest terminated child (the pool workers, the Hadoop job).
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024  # ru_maxrss is in KB on Linux
+
+
+def timed(f, *args, **kw):
+    """
+    Returns the runtime of a call and its result.
+    """
+    ts = perf_counter()
+    result = f(*args, **kw)
+    return perf_counter() - ts, result
+
+
+def scoring_scheme(options):
+    """
+    The seq_utils.ScoringScheme of the --scoring_matrix, --gap_open and --gap_extend options.
+    """
+    from seq_utils import ScoringScheme
+    return ScoringScheme.from_file(options.scoring_matrix, options.gap_open, options.gap_extend)
+
+
+def run_blastn(system, query, cdnas, options, hdfs):
+    """
+    Runs one BLASTN measurement and returns (startup, io, runtime, baseline), baseline being the runtime
+    of the job on a single cDNA that is subtracted from the runtime for the compute phase.
+    """
+    from seq_utils import alignment_engines
+    from benchmark_utils import blastn_local, blastn_pyspark, blastn_hadoop, get_spark_session, writeToHadoop
+    scoring = scoring_scheme(options)
+    substitution_matrix, gap_penalty = scoring.substitution_matrix, scoring.gap_penalty
+    baseline = [{"transcript_id": "T0", "sequence": query}]
+    if system in ('scalar', 'vectorized'):
+        engine = alignment_engines[system]
+        runtime, _ = timed(lambda: [engine(query, cdna['sequence'], substitution_matrix, gap_penalty) for cdna in cdnas])
+        return 0.0, 0.0, runtime, 0.0
+    if system == 'local':
+        startup = blastn_local(query, baseline, options.processes, scoring=scoring)[0]
+        return startup, 0.0, blastn_local(query, cdnas, options.processes, scoring=scoring)[0], startup
+
+    client, filepath = hdfs
+    if system == 'spark':
+        session_start, spark = timed(get_spark_session, options.master)
+        try:
+            writeToHadoop(client, filepath, baseline)
+            job_start = blastn_pyspark(query, filepath, engine=options.engine, spark=spark, scoring=scoring)[0]
+            io, _ = timed(writeToHadoop, client, filepath, cdnas)
+            return session_start + job_start, io, blastn_pyspark(query, filepath, engine=options.engine, spark=spark, scoring=scoring)[0], job_start
+        finally:
+            spark.stop()
+    writeToHadoop(client, filepath, baseline)
+    startup = blastn_hadoop(query, filepath, engine=options.engine, scoring=scoring)[0]
+    io, _ = timed(writeToHadoop, client, filepath, cdnas)
+    return startup, io, blastn_hadoop(query, filepath, engine=options.engine, scoring=scoring)[0], startup
+
+
+def run_align(system, sequences, cdnas, options, hdfs):
+    """
+    Runs one sequence alignment measurement and returns (startup, io, runtime, baseline) like run_blastn.
+    """
+    from seq_utils import quality_alignment_engines
+    from benchmark_utils import align_local, align_pyspark, align_hadoop, get_spark_session, writeToHadoop
+    scoring = scoring_scheme(options)
+    substitution_matrix, gap_penalty = scoring.substitution_matrix, scoring.gap_penalty
+    baseline = [{"transcript_id": "T0", "sequence": sequences[0]['sequence']}]
+    if system in ('scalar', 'vectorized'):
+        engine = quality_alignment_engines[system]
+        runtime, _ = timed(lambda: [engine(seq['sequence'], seq['quality'], cdna['sequence'], substitution_matrix, gap_penalty) for seq in sequences for cdna in cdnas])
+        return 0.0, 0.0, runtime, 0.0
+    if system == 'local':
+        startup = align_local(baseline, sequences[:1], options.processes, scoring=scoring)[0]
+        return startup, 0.0, align_local(cdnas, sequences, options.processes, scoring=scoring)[0], startup
+
+    client, filepath = hdfs
+    filepath_cdna, filepath_seq = filepath + '_cdna', filepath + '_seq'
+    def write(cdnas, sequences):
+        writeToHadoop(client, filepath_cdna, cdnas)
+        writeToHadoop(client, filepath_seq, sequences)
+    kw = dict(broadcast=options.broadcast, engine=options.engine, scoring=scoring)
+    if system == 'spark':
+        session_start, spark = timed(get_spark_session, options.master)
+        try:
+            write(baseline, sequences[:1])
+            job_start = align_pyspark(filepath_cdna, filepath_seq, spark=spark, **kw)[0]
+            io, _ = timed(write, cdnas, sequences)
+            return session_start + job_start, io, align_pyspark(filepath_cdna, filepath_seq, spark=spark, **kw)[0], job_start
+        finally:
+            spark.stop()
+    write(baseline, sequences[:1])
+    startup = align_hadoop(filepath_cdna, filepath_seq, **kw)[0]
+    io, _ = timed(write, cdnas, sequences)
+    return startup, io, align_hadoop(filepath_cdna, filepath_seq, **kw)[0], startup
+
+
+def measure(task, system, data, cells, options):
+    """
+    Runs one measurement (in a fresh worker process) and returns the phases, GCUPS and peak RSS.
+    """
+    hdfs = None
+    if system in ('spark', 'hadoop'):
+        from hdfs import InsecureClient
+        hdfs = InsecureClient(options.hdfs_url, user=options.hdfs_user), options.hdfs_path
+    run = run_blastn if task == 'blastn' else run_align
+    try:
+        startup, io, runtime, baseline = run(system, *data, options, hdfs)
+    finally:
+        if hdfs:
+            from benchmark_utils import deleteTestSet
+            for suffix in ('', '_cdna', '_seq'):
+                if hdfs[0].status(hdfs[1] + suffix, strict=False):
+                    deleteTestSet(hdfs[0], hdfs[1] + suffix)
+    compute = max(runtime - baseline, 0.0)
+    return {
+        "startup [s]": startup,
+        "io [s]": io,
+        "compute [s]": compute,
+        "runtime [s]": runtime,
+        "cells": cells,
+        "GCUPS": cells / compute / 1e9 if compute > 0 else None,
+        "peak RSS [MB]": peak_rss(),
+    }
+
+
+def grid(task, options):
+    """
+    Yields the grid points of a task: (parameters of the row, dataset, number of cells of the dynamic programming matrices).
+    The datasets only depend on the seed and the grid point, so every system and run aligns the same data.
+    """
+    for n_cdnas in options.n_cdnas:
+        cdnas = generate_cdnas(n_cdnas, options.cdna_length, options.seed, options.fasta)
+        reference_length = sum(len(cdna['sequence']) for cdna in cdnas)
+        if task == 'blastn':
+            for len_query in options.len_query:
+                query = generate_random_dna_sequence(len_query, weights=WEIGHTS, rng=dataset_rng(options.seed, 'query', len_query))
+                yield {"n_cDNAs": n_cdnas, "len_query": len_query}, (query, cdnas), len_query * reference_length
+        else:
+            for n_sequences in options.n_sequences:
+                sequences = generate_sequences(cdnas, n_sequences, options.read_length, options.seed)
+                yield {"n_cDNAs": n_cdnas, "n_Sequences": n_sequences}, (sequences, cdnas), sum(len(seq['sequence']) for seq in sequences) * reference_length
+
+
+def run_suite(task, options):
+    """
+    Measures every system over the grid and writes the rows to output_dir/<task>_suite_<timestamp>.csv and .json
+    as soon as they are measured, so an interrupted suite keeps its results.
+
+    Returns:
+    list: The result rows.
+    """
+    os.makedirs(options.output_dir, exist_ok=True)
+    filepath = os.path.join(options.output_dir, '%s_suite_%.0f' % (task, time()))
+    rows = []
+    with open(filepath + '.csv', 'w', newline='') as csv_file, open(filepath + '.json', 'w') as json_file:
+        writer = None
+        for params, data, cells in grid(task, options):
+            for run in range(options.runs):
+                for system in options.systems:
+                    # A fresh process per measurement, for the peak RSS and a cold start of every run
+                    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+                        result = pool.submit(measure, task, system, data, cells, options).result()
+                    row = {"System": SYSTEMS[system], "Run": run, **params, "seed": options.seed, "gap_open": options.gap_open, "gap_extend": options.gap_extend, **result}
+                    rows.append(row)
+                    if writer is None:
+                        writer = csv.DictWriter(csv_file, fieldnames=list(row))
+                        writer.writeheader()
+                    writer.writerow(row)
+                    json_file.write(dumps(row) + '\n')
+                    csv_file.flush()
+                    json_file.flush()
+                    print(dumps(row))
+    return rows
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Reproducible benchmarks of the BLASTN and sequence alignment programs.')
+    parser.add_argument('task', choices=['blastn', 'align'])
+    parser.add_argument('--systems', nargs='+', choices=list(SYSTEMS), default=['scalar', 'vectorized', 'local'])
+    parser.add_argument('--n_cdnas', nargs='+', type=int, default=[1, 10, 100, 1000], help='numbers of cDNAs of the grid')
+    parser.add_argument('--len_query', nargs='+', type=int, default=[10, 20, 40, 60, 80], help='query lengths of the grid (blastn)')
+    parser.add_argument('--n_sequences', nargs='+', type=int, default=[1, 10, 100], help='numbers of sequences of the grid (align)')
+    parser.add_argument('--cdna_length', type=int, default=1000, help="length of the generated cDNAs, or of the kept 3' tail of the --fasta cDNAs")
+    parser.add_argument('--read_length', type=int, default=90, help='length of the generated sequences (align)')
+    parser.add_argument('--fasta', default=None, help='sample the cDNAs of this FASTA file instead of generating them')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes of the local system')
+    parser.add_argument('--engine', default='scalar', choices=['scalar', 'vectorized'], help='Smith-Waterman implementation of Spark and Hadoop')
+    parser.add_argument('--scoring_matrix', default=None, help='substitution matrix file (seq_utils.read_score_table)')
+    parser.add_argument('--gap_open', type=float, default=-2, help='score of the first base of a gap')
+    parser.add_argument('--gap_extend', type=float, default=None, help='score of every further base of a gap (affine gaps), default: --gap_open')
+    parser.add_argument('--broadcast', action='store_true', help='broadcast join instead of the cartesian product (align)')
+    parser.add_argument('--master', default='local[1]', help='Spark master')
+    parser.add_argument('--hdfs_url', default='http://host.docker.internal:9870')
+    parser.add_argument('--hdfs_user', default='alfa')
+    parser.add_argument('--hdfs_path', default='/bigdata/benchmark_suite', help='HDFS path of the datasets, deleted after every measurement')
+    parser.add_argument('--output_dir', default='./benchmark')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    run_suite(options.task, options)
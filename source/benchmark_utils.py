@@ -12,7 +12,7 @@ def timing(f):
 
 import random
 
-def generate_random_dna_sequence(length, include_n=False, weights=None):
+def generate_random_dna_sequence(length, include_n=False, weights=None, rng=None):
     """
     Generates a random DNA sequence of a given length with optional nucleotide weights.
 
@@ -20,6 +20,7 @@ def generate_random_dna_sequence(length, include_n=False, weights=None):
     - length (int): The length of the DNA sequence.
     - include_n (bool): If True, the sequence may contain 'N'.
     - weights (dict): A dictionary with nucleotides as keys and their corresponding weights (int) as values. default: 1
+    - rng (random.Random): A seeded generator for reproducible sequences, default: the global random module.
 
     Returns:
     - str: A random DNA sequence.
@@ -32,11 +33,12 @@ def generate_random_dna_sequence(length, include_n=False, weights=None):
     # Create a list of nucleotides according to their weights
     weighted_nucleotides = []
     for nucleotide in nucleotides:
-        weighted_nucleotides.extend([nucleotide] * weights.get(nucleotide,1))
+        weighted_nucleotides.extend([nucleotide] * (weights or {}).get(nucleotide,1))
     
 
     # Generate the random sequence
-    sequence = ''.join(random.choice(weighted_nucleotides) for _ in range(length))
+    rng = rng or random
+    sequence = ''.join(rng.choice(weighted_nucleotides) for _ in range(length))
     return sequence
 
 ## Example usage
@@ -47,8 +49,9 @@ def generate_random_dna_sequence(length, include_n=False, weights=None):
 # print(f"Random DNA Sequence (length {length}, include 'N': {include_n}): {random_dna_sequence}")
 
 
-from json import dumps, loads
-def writeToHadoop(client, filepath, cdnas_ds):
+from json import loads
+from seq_utils import split_windows
+def writeToHadoop(client, filepath, cdnas_ds, num_parts=None, max_length=None, overlap=None):
     """
     Writes a dataset to Hadoop file system (HDFS).
 
@@ -56,20 +59,43 @@ def writeToHadoop(client, filepath, cdnas_ds):
     client (hdfs.InsecureClient): The HDFS client.
     filepath (str): The path in HDFS where the file will be written.
     cdnas_ds (list): The dataset to be written, where each element is a dictionary representing a cDNA.
+    num_parts (int): Write a directory of this many part files of equal estimated alignment cost instead of one file
+                     (see balanced_parts), so every map task or Spark partition gets the same amount of work.
+    max_length (int): Split the cDNAs longer than this into overlapping windows (see seq_utils.split_windows),
+                      the jobs merge the hits of the windows back into one hit per transcript.
+    overlap (int): Overlap of the windows, at least the query length plus the gaps of an alignment, required with max_length.
 
     Returns:
     None
+
+    Raises:
+    ValueError: If max_length is given without overlap.
     """
-    try:
-        # Open the HDFS file for writing
-        with client.write(filepath) as writer:
-            # Write the first cDNA as JSON string
-            writer.write(dumps(cdnas_ds[0]))
-            # Write the remaining cDNAs, each on a new line as JSON string
-            for cdna in cdnas_ds[1:]:
-                writer.write('\n' + dumps(cdna))
-    except Exception as e:
-        print("Fehler beim Kopieren der Datei in HDFS: ", e)
+    if max_length:
+        if overlap is None:
+            raise ValueError("max_length needs the overlap of the windows, at least the query length plus the gaps of an alignment")
+        cdnas_ds = list(split_windows(cdnas_ds, max_length, overlap))
+    if num_parts:
+        for part, records in enumerate(balanced_parts(cdnas_ds, num_parts)):
+            writeToHadoop(client, '%s/part-%05d' % (filepath, part), records)
+        return
+    # Write the JSON lines in large blocks instead of one request per cDNA, errors are raised to the caller
+    with client.write(filepath, overwrite=True) as writer:
+        for block in serialize_blocks(cdnas_ds):
+            writer.write(block)
+
+def balanced_parts(records, num_parts):
+    """
+    Distributes records into parts of equal estimated alignment cost. The DP cells of aligning a record are
+    proportional to its sequence length, so the parts are balanced by total length (see balance_by_cost)
+    and each part is sorted by length, which keeps records of similar cost together.
+    Empty parts are left out.
+    """
+    assignment = balance_by_cost([(k, len(record['sequence'])) for k, record in enumerate(records)], num_parts)
+    parts = [[] for _ in range(num_parts)]
+    for k, record in enumerate(records):
+        parts[assignment[k]].append(record)
+    return [sorted(part, key=lambda record: len(record['sequence'])) for part in parts if part]
 
 def deleteTestSet(client, filepath):
     """
@@ -82,137 +108,646 @@ def deleteTestSet(client, filepath):
     Returns:
     None
     """
-    # Delete the specified file from HDFS
-    client.delete(filepath)
+    # Delete the specified file (or directory of part files) from HDFS
+    client.delete(filepath, recursive=True)
+
+
+from hdfs_upload import serialize_blocks, bulkWriteToHadoop, LocalClient, LocalWriter
+
+
+from kmer_index import dump_kmer_index
+def writeIndexToHadoop(client, filepath, index):
+    """
+    Writes a k-mer index (see kmer_index.build_kmer_index) to Hadoop file system (HDFS),
+    e.g. next to the JSON lines of the cDNAs it was built from.
+
+    Parameters:
+    client (hdfs.InsecureClient): The HDFS client.
+    filepath (str): The path in HDFS where the index will be written.
+    index (dict): The k-mer index.
+
+    Returns:
+    None
+    """
+    client.write(filepath, data=dump_kmer_index(index), overwrite=True)
+
+
+from seq_format import encode_record, encode_attributes, decode_record
+def writePackedToHadoop(client, filepath, cdnas_ds):
+    """
+    Writes a dataset to Hadoop file system (HDFS) in the 2-bit packed format of seq_format.
+    The header attributes are dictionary-encoded into a separate file filepath + '.attributes',
+    which the alignment jobs never read.
+
+    Parameters:
+    client (hdfs.InsecureClient): The HDFS client.
+    filepath (str): The path in HDFS where the file will be written.
+    cdnas_ds (list): The dataset to be written, where each element is a dictionary representing a cDNA or sequence.
+
+    Returns:
+    None
+    """
+    with client.write(filepath, encoding='utf-8', overwrite=True) as writer:
+        writer.write('\n'.join(encode_record(cdna) for cdna in cdnas_ds))
+    with client.write(filepath + '.attributes', encoding='utf-8', overwrite=True) as writer:
+        writer.write('\n'.join(encode_attributes(cdnas_ds)))
+
+def writePartsToHadoop(client, filepath, output_dir):
+    """
+    Uploads the part files written by demultiplex.demultiplex to the directory filepath in HDFS,
+    the alignment jobs read the directory as their sequence dataset.
+
+    Parameters:
+    client (hdfs.InsecureClient): The HDFS client.
+    filepath (str): The directory in HDFS.
+    output_dir (str): The local directory of the part files.
+
+    Returns:
+    None
+    """
+    client.upload(filepath, output_dir, overwrite=True)
+
+def record_parser(input_format):
+    """
+    Returns the function parsing one line of a dataset, 'json' (writeToHadoop) or 'packed' (writePackedToHadoop).
+    """
+    return decode_record if input_format == 'packed' else loads
 
 
 from time import time
 from subprocess import run
-from seq_utils import smith_waterman, substitution_matrix, gap_penalty
+from seq_utils import alignment_engines, smith_waterman_score, smith_waterman_score_batch, banded_smith_waterman, write_score_table
+from kmer_index import load_kmer_index, find_candidates, seeded_alignment
+from pyspark import SparkFiles
 from pyspark.sql import SparkSession
+from contextlib import nullcontext
+from tempfile import NamedTemporaryFile
+from reference_cache import open_reference_cache, cached_records
+import os
+from heapq import heappush, heappop
+
+def get_spark_session(master="local[1]", conf=None):
+    """
+    Returns a Spark session. Pass it to the *_pyspark functions to reuse it across benchmark runs
+    instead of starting (and stopping) a new session per call.
+
+    Parameters:
+    master (str): The Spark master, e.g. "local[*]" to use all cores.
+    conf (dict): Additional Spark settings, e.g. {"spark.executor.cores": "4", "spark.executor.memory": "4g"}.
+
+    Returns:
+    SparkSession: The Spark session.
+    """
+    builder = SparkSession.builder.master(master).appName("SparkBlast.com")
+    for key, value in (conf or {}).items():
+        builder = builder.config(key, value)
+    return builder.getOrCreate()
+
+def spark_session(spark, master):
+    """
+    Context manager of the *_pyspark functions: keeps a passed session open, stops a newly created one at exit.
+    """
+    if spark is not None:
+        return nullcontext(spark)
+    return get_spark_session(master)
 
-# see blastn_pyspark for more info
-def mergeValue(c,v):
-    if not c:  # If no current best alignment, use the new value
-        return [v]
-    if c[0][1] > v[1]:  # If the current best score is higher, keep the current best
-        return c
-    elif c[0][1] == v[1]:  # If the scores are equal, append the new alignment
-        c.append(v)
-        return c
-    else:  # If the new score is higher, use the new value
-        return [v]
-
-def mergeCombiners(a,b):
-    if not (a and b):  # If one list is empty, return the other
-        return a + b
-    if a[0][1] > b[0][1]:  # If the best score in 'a' is higher, keep 'a'
-        return a
-    elif a[0][1] < b[0][1]:  # If the best score in 'b' is higher, keep 'b'
-        return b
-    else:  # If the best scores are equal, combine the lists
-        return a + b
-
-
-def blastn_pyspark(query_sequence, filepath):
+def balance_by_cost(costs, num_partitions):
+    """
+    Assigns items to partitions so that the total cost of the partitions is balanced
+    (greedy longest processing time first: the most expensive item goes to the least loaded partition).
+
+    Parameters:
+    costs (list): (key, cost) pairs.
+    num_partitions (int): The number of partitions.
+
+    Returns:
+    dict: key -> partition index.
+    """
+    partition_loads = [(0, partition) for partition in range(num_partitions)]
+    assignment = {}
+    for key, cost in sorted(costs, key=lambda x: x[1], reverse=True):
+        load, partition = heappop(partition_loads)
+        assignment[key] = partition
+        heappush(partition_loads, (load + cost, partition))
+    return assignment
+
+def partition_by_length(rdd, num_partitions):
+    """
+    Repartitions an RDD of records so that every partition holds about the same total sequence length
+    (the alignment cost is proportional to it), instead of the same number of records.
+    The records are computed by three jobs (zipWithIndex, the lengths and the repartitioning), so rdd should be persisted.
+    """
+    indexed = rdd.zipWithIndex().map(lambda x: (x[1], x[0]))
+    assignment = rdd.context.broadcast(balance_by_cost(indexed.mapValues(lambda seq: len(seq['sequence'])).collect(), num_partitions))
+    return indexed.partitionBy(num_partitions, lambda index: assignment.value[index]).values()
+
+def cached_reference_rdd(sc, reference_cache, num_partitions=None):
+    """
+    RDD of the cDNA records of a reference cache (see reference_cache): the cache file is shipped to the executors
+    and memory-mapped there, each partition is a range of transcripts, so nothing is parsed or encoded.
+    """
+    sc.addFile(reference_cache)
+    name = os.path.basename(reference_cache)
+    bounds = shard_bounds(len(open_reference_cache(reference_cache)['transcript_ids']), num_partitions or sc.defaultParallelism)
+    return sc.parallelize(bounds, len(bounds)).flatMap(lambda bound: cached_records(open_reference_cache(SparkFiles.get(name)), *bound))
+
+def reference_ranges_file(reference_cache, num_shards):
+    """
+    Writes the input of the Hadoop jobs with a reference cache: a local temporary file of start<TAB>end transcript ranges,
+    to be removed after the job.
+    """
+    bounds = shard_bounds(len(open_reference_cache(reference_cache)['transcript_ids']), num_shards)
+    with NamedTemporaryFile('w', suffix='.ranges', delete=False) as file:
+        file.writelines('%d\t%d\n' % bound for bound in bounds)
+    return file.name
+
+from functools import partial
+from reducer_utils import hit_key, first_hit, merge_hit, merge_hits, top_hits
+from pyspark.accumulators import AccumulatorParam
+from job_metrics import merge_metrics, add_metrics, metered, full_cells, banded_cells, quality_cells, parse_counters
+from local_backend import scoring_scheme
+
+
+def scoring_args(scoring):
+    """
+    Command line options of the MapReduce jobs for a ScoringScheme, the substitution matrix is written to a temporary file.
+
+    Returns:
+    tuple: The options and the path of the temporary file (None without scoring), to be removed after the job.
+    """
+    if scoring is None:
+        return [], None
+    matrix_file = NamedTemporaryFile('w', suffix='.txt', delete=False)
+    matrix_file.close()
+    write_score_table(scoring.substitution_matrix, matrix_file.name)
+    gap_open, gap_extend = scoring.gap_penalty if scoring.affine else (scoring.gap_penalty, scoring.gap_penalty)
+    return ["--scoring_matrix", matrix_file.name, "--gap_open", str(gap_open), "--gap_extend", str(gap_extend)], matrix_file.name
+
+
+class MetricsParam(AccumulatorParam):
+    """
+    Accumulator of metrics dicts (see job_metrics), the Spark counterpart of the counters of the MapReduce jobs.
+    """
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, a, b):
+        return merge_metrics(a, b)
+
+
+def blastn_pyspark(query_sequence, filepath, engine='scalar', score_only=False, kmer_index=None, band_width=16, exhaustive=False, top_k=1, ties='all', input_format='json', spark=None, master="local[1]", num_partitions=None, reference_cache=None, metrics=None, max_length=None, overlap=None, scoring=None):
     """
     Executes the BLASTN algorithm using PySpark.
 
     Parameters:
     query_sequence (str): The DNA sequence to be used as the query for the alignment.
     filepath (str): The HDFS path where the input sequences are stored.
+    engine (str): The Smith-Waterman implementation, 'scalar' or 'vectorized'.
+    score_only (bool): Score all transcripts without traceback and align only the best hits afterwards.
+    kmer_index (str): Local path of a k-mer index, only transcripts sharing a seed with the query are aligned.
+    band_width (int): Band width around the seed diagonals used with kmer_index.
+    exhaustive (bool): Ignore kmer_index and align every transcript, for correctness checks.
+    top_k (int): Number of best hits to output.
+    ties (str): 'all' keeps every hit tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    input_format (str): Format of the dataset, 'json' (writeToHadoop) or 'packed' (writePackedToHadoop).
+    spark (SparkSession): A session to reuse (see get_spark_session), by default a new one is started and stopped.
+    master (str): The Spark master of a newly started session, e.g. "local[*]".
+    num_partitions (int): Repartition the input into this many partitions of equal total sequence length.
+    reference_cache (str): Local path of a reference cache (see reference_cache) read instead of filepath.
+    metrics (dict): Filled with the metrics of the job (see job_metrics): times per stage, records, aligned pairs and DP cells.
+    max_length (int): Split the cDNAs longer than this into overlapping windows (see seq_utils.split_windows) before
+                      the partitioning, so long transcripts are spread over several tasks.
+    overlap (int): Overlap of the windows, by default twice the query length.
+    scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
 
     Returns:
     tuple: Execution time and the alignment output.
     """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    # The windows of a transcript are merged into its best hit
+    merge_value, merge_combiners = partial(merge_hit, k=top_k, ties=ties, unique=True), partial(merge_hits, k=top_k, ties=ties, unique=True)
+    overlap = overlap or 2 * len(query_sequence)
     ts = time() # Start timing the operation
+    candidates = None
+    if kmer_index and not exhaustive:
+        # Look up the seeds of the query once on the driver
+        candidates = find_candidates(load_kmer_index(kmer_index), query_sequence)
     # Initialize a Spark session and Spark context
-    with SparkSession.builder.master("local[1]").appName("SparkBlast.com").getOrCreate() as spark:
+    with spark_session(spark, master) as spark:
         sc = spark.sparkContext
-        # Read sequences from HDFS and deserialize JSON strings
-        sequences_rdd = sc.textFile("hdfs://localhost:9000" + filepath).map(lambda x: loads(x
-        # Perform the Smith-Waterman alignment and aggregate results
-        out = sequences_rdd.map(lambda seq: (seq['transcript_id'], *smith_waterman(query_sequence, seq['sequence'], substitution_matrix, gap_penalty))) \
-            .aggregate([], mergeValue, mergeCombiners)
+        # Metered stages, their metrics are accumulated on the driver
+        accumulator = sc.accumulator({}, MetricsParam())
+        smith_waterman = metered(accumulator, 'align', alignment_engines[engine], full_cells)
+        parsed_rdd = None
+        if reference_cache:
+            sequences_rdd = cached_reference_rdd(sc, reference_cache, num_partitions)
+        else:
+            # Read sequences from HDFS and deserialize the records
+            sequences_rdd = sc.textFile("hdfs://localhost:9000" + filepath).map(metered(accumulator, 'parse', record_parser(input_format), counts={'records in': 1}))
+            if max_length:
+                sequences_rdd = sequences_rdd.flatMap(lambda seq: split_windows([seq], max_length, overlap))
+            # Parsed once: partition_by_length runs several jobs on the records, which would read, parse and count them again
+            sequences_rdd = parsed_rdd = sequences_rdd.persist()
+            if num_partitions:
+                sequences_rdd = partition_by_length(sequences_rdd, num_partitions)
+        if candidates is not None:
+            # Align only the transcripts sharing a seed, in a band around the seed diagonals
+            banded = metered(accumulator, 'align', banded_smith_waterman, banded_cells)
+            full = metered(accumulator, 'align', alignment_engines['vectorized'], full_cells)
+            out = sequences_rdd.filter(lambda seq: seq['transcript_id'] in candidates) \
+                .map(lambda seq: (seq['transcript_id'], *seeded_alignment(query_sequence, seq['sequence'], candidates[seq['transcript_id']], band_width, seq.get('window', 0),
+                                                                          substitution_matrix, gap_penalty, banded, full))) \
+                .aggregate([], merge_value, merge_combiners)
+        elif score_only:
+            # Score all transcripts and keep only the (transcript_id, score, sequence) of the top-k
+            score = metered(accumulator, 'score', smith_waterman_score, full_cells)
+            best = sequences_rdd.map(lambda seq: (seq['transcript_id'], score(query_sequence, seq['sequence'], substitution_matrix, gap_penalty), seq['sequence'])) \
+                .aggregate([], merge_value, merge_combiners)
+            # Attach the alignments: the surviving sequences came along, so only they are aligned, on the driver
+            traceback = metered(accumulator, 'traceback', alignment_engines[engine])
+            out = top_hits(((transcript_id, *traceback(query_sequence, sequence, substitution_matrix, gap_penalty)) for transcript_id, _, sequence in best), top_k, ties, unique=True)
+        else:
+            # Perform the Smith-Waterman alignment and aggregate results
+            out = sequences_rdd.map(lambda seq: (seq['transcript_id'], *smith_waterman(query_sequence, seq['sequence'], substitution_matrix, gap_penalty))) \
+                .aggregate([], merge_value, merge_combiners)
+        if parsed_rdd is not None:
+            parsed_rdd.unpersist()
+        if metrics is not None:
+            metrics.update(accumulator.value)
     te = time() # End timing the operation
     return te-ts, out # Return the execution time and results
 
 
-def blastn_hadoop(query_sequence, filepath):
+def blastn_hadoop(query_sequence, filepath, engine='scalar', score_only=False, kmer_index=None, band_width=16, exhaustive=False, top_k=1, ties='all', input_format='json', reference_cache=None, num_shards=16, metrics=None, profile_task=None, scoring=None):
     #"""
     #Executes the BLASTN algorithm using Hadoop MapReduce.
     #
     #Parameters:
     #query_sequence (str): The DNA sequence to be used as the query for the alignment.
     #filepath (str): The HDFS path where the input sequences are stored.
+    #engine (str): The Smith-Waterman implementation, 'scalar' or 'vectorized'.
+    #score_only (bool): Score all transcripts without traceback and align only the top-k hits of each mapper task.
+    #kmer_index (str): Path (local or hdfs://) of a k-mer index, only transcripts sharing a seed with the query are aligned.
+    #band_width (int): Band width around the seed diagonals used with kmer_index.
+    #exhaustive (bool): Ignore kmer_index and align every transcript, for correctness checks.
+    #top_k (int): Number of best hits to output.
+    #ties (str): 'all' keeps every hit tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    #input_format (str): Format of the dataset, 'json' (writeToHadoop) or 'packed' (writePackedToHadoop).
+    #reference_cache (str): Local path of a reference cache (see reference_cache) read instead of filepath.
+    #num_shards (int): Number of map tasks with reference_cache.
+    #metrics (dict): Filled with the 'blastn' counters of the job (see job_metrics): times per stage, records, aligned pairs and DP cells.
+    #profile_task (int): Run the sampling profiler in the mapper task with this partition number (see the task logs).
+    #scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
     #
     #Returns:
     #tuple: Execution time and the alignment output.
     #"""
     ts = time() # Start timing the operation
     # Run the Hadoop job using the specified script and capture the output
-    result = run(["python3", "blastn_hadoop.py", "-r", "hadoop", "--conf-path","mrjob.conf", "--query_sequence", query_sequence, "hdfs://localhost:9000" + filepath], capture_output=True)
+    args, matrix_file = scoring_args(scoring)
+    args += ["--engine", engine, "--input_format", input_format, "--top_k", str(top_k), "--ties", ties] + (["--score_only"] if score_only else [])
+    if kmer_index:
+        args += ["--kmer_index", kmer_index, "--band_width", str(band_width)] + (["--exhaustive"] if exhaustive else [])
+    if profile_task is not None:
+        args += ["--profile_task", str(profile_task)]
+    ranges_file = reference_ranges_file(reference_cache, num_shards) if reference_cache else None
+    if reference_cache:
+        inputs = ["--reference_cache", reference_cache, ranges_file]
+    else:
+        inputs = ["hdfs://localhost:9000" + filepath]
+    try:
+        result = run(["python3", "blastn_hadoop.py", "-r", "hadoop", "--conf-path","mrjob.conf", "--query_sequence", query_sequence, *args, *inputs], capture_output=True)
+    finally:
+        for temporary_file in (matrix_file, ranges_file):
+            if temporary_file:
+                os.remove(temporary_file)
     te = time() # End timing the operation
+    if metrics is not None:
+        metrics.update(parse_counters(result.stderr.decode('utf-8')).get('blastn', {}))
     # Process the output from the Hadoop job and deserialize JSON strings
     return te-ts, list(map(lambda x: tuple(loads(x)), result.stdout.decode('utf-8').split('\t\n')[:-1]))
 
 
 
-from operator import add
-from seq_utils import quality_adjusted_smith_waterman
+def blastn_batch_pyspark(queries, filepath, engine='scalar', top_k=1, ties='all', input_format='json', spark=None, master="local[1]", num_partitions=None, reference_cache=None, scoring=None):
+    """
+    Executes the BLASTN algorithm for a batch of queries using PySpark.
+    Each cDNA is read once and scored against all queries, the best hits are reduced per query.
 
-# Function to create the initial combiner list
-def createCombiner(v):
-    return [v]
+    Parameters:
+    queries (list): (query_id, sequence) tuples, e.g. from seq_utils.read_queries.
+    filepath (str): The HDFS path where the input sequences are stored.
+    engine (str): The Smith-Waterman implementation used for the traceback of the best hits, 'scalar' or 'vectorized'.
+    top_k (int): Number of best hits to output per query.
+    ties (str): 'all' keeps every hit tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    input_format (str): Format of the dataset, 'json' (writeToHadoop) or 'packed' (writePackedToHadoop).
+    spark (SparkSession): A session to reuse (see get_spark_session), by default a new one is started and stopped.
+    master (str): The Spark master of a newly started session, e.g. "local[*]".
+    num_partitions (int): Repartition the input into this many partitions of equal total sequence length.
+    reference_cache (str): Local path of a reference cache (see reference_cache) read instead of filepath.
+    scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
 
+    Returns:
+    tuple: Execution time and the alignment output as (query_id, transcript_id, score, align1, align2) tuples.
+    """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    smith_waterman = alignment_engines[engine]
+    query_ids = [query_id for query_id, query in queries]
+    query_list = [query for query_id, query in queries]
+    query_sequences = dict(queries)
+    ts = time() # Start timing the operation
+    # Initialize a Spark session and Spark context
+    with spark_session(spark, master) as spark:
+        sc = spark.sparkContext
+        parsed_rdd = None
+        if reference_cache:
+            sequences_rdd = cached_reference_rdd(sc, reference_cache, num_partitions)
+        else:
+            # Read sequences from HDFS and deserialize the records, once: partition_by_length, the scoring pass
+            # and the alignment pass of the survivors all read them
+            sequences_rdd = parsed_rdd = sc.textFile("hdfs://localhost:9000" + filepath).map(record_parser(input_format)).persist()
+            if num_partitions:
+                sequences_rdd = partition_by_length(sequences_rdd, num_partitions)
+        # Score every cDNA against all queries at once and keep the (transcript_id, score) of the top-k per query
+        best = sequences_rdd.flatMap(lambda seq: zip(query_ids, [(seq['transcript_id'], score) for score in smith_waterman_score_batch(query_list, seq['sequence'], substitution_matrix, gap_penalty)])) \
+            .combineByKey(first_hit, partial(merge_hit, k=top_k, ties=ties, unique=True), partial(merge_hits, k=top_k, ties=ties, unique=True)) \
+            .collect()
+        # Attach the alignments: a second pass aligns only the surviving hits
+        survivors = {}
+        for query_id, hits in best:
+            for hit in hits:
+                survivors.setdefault(hit[0], []).append(query_id)
+        out = sequences_rdd.filter(lambda seq: seq['transcript_id'] in survivors) \
+            .flatMap(lambda seq: [(query_id, seq['transcript_id'], *smith_waterman(query_sequences[query_id], seq['sequence'], substitution_matrix, gap_penalty)) for query_id in survivors[seq['transcript_id']]]) \
+            .collect()
+        out.sort(key=lambda x: (query_ids.index(x[0]), *hit_key(x[1:])))
+        if parsed_rdd is not None:
+            parsed_rdd.unpersist()
+    te = time() # End timing the operation
+    return te-ts, out # Return the execution time and results
+
+
+def blastn_batch_hadoop(query_file, filepath, engine='scalar', top_k=1, ties='all', input_format='json', reference_cache=None, num_shards=16, scoring=None):
+    """
+    Executes the BLASTN algorithm for a batch of queries using Hadoop MapReduce.
 
+    Parameters:
+    query_file (str): Local file with one query per line (query_id<TAB>sequence).
+    filepath (str): The HDFS path where the input sequences are stored.
+    engine (str): The Smith-Waterman implementation used for the traceback of the best hits, 'scalar' or 'vectorized'.
+    top_k (int): Number of best hits to output per query.
+    ties (str): 'all' keeps every hit tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    input_format (str): Format of the dataset, 'json' (writeToHadoop) or 'packed' (writePackedToHadoop).
+    reference_cache (str): Local path of a reference cache (see reference_cache) read instead of filepath.
+    num_shards (int): Number of map tasks with reference_cache.
+    scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
 
-def align_pyspark(filepath_cdna, filepath_seq):
+    Returns:
+    tuple: Execution time and the alignment output as (query_id, transcript_id, score, align1, align2) tuples.
+    """
+    args, matrix_file = scoring_args(scoring)
+    ts = time() # Start timing the operation
+    ranges_file = reference_ranges_file(reference_cache, num_shards) if reference_cache else None
+    if reference_cache:
+        inputs = ["--reference_cache", reference_cache, ranges_file]
+    else:
+        inputs = ["hdfs://localhost:9000" + filepath]
+    # Run the Hadoop job using the specified script and capture the output
+    try:
+        result = run(["python3", "blastn_hadoop.py", "-r", "hadoop", "--conf-path","mrjob.conf", "--query_file", query_file, "--engine", engine, "--top_k", str(top_k), "--ties", ties, "--input_format", input_format, *args, *inputs], capture_output=True)
+    finally:
+        for temporary_file in (matrix_file, ranges_file):
+            if temporary_file:
+                os.remove(temporary_file)
+    te = time() # End timing the operation
+    # Process the output from the Hadoop job and deserialize JSON strings
+    return te-ts, list(map(lambda x: tuple(loads(x)), result.stdout.decode('utf-8').split('\t\n')[:-1]))
+
+
+from operator import add
+from seq_utils import quality_alignment_engine, prefilter_alignments
+from kmer_index import build_kmer_index, pseudoalign_hits
+
+def feature_map(cdnas, attribute='gene'):
+    """
+    Maps the transcript IDs of read_fasta records to a header attribute (e.g. 'gene' or 'gene_symbol'),
+    to count genes instead of transcripts with umi_count.
+    """
+    return {cdna['transcript_id']: cdna['attributes'][attribute] for cdna in cdnas if attribute in cdna.get('attributes', {})}
+
+
+def write_matrix_market(counts, output_dir):
+    """
+    Writes (cell, feature, count) triplets as a sparse feature x cell matrix in the layout of the 10x tools:
+    output_dir/matrix.mtx (Matrix Market coordinate format), features.tsv and barcodes.tsv.
+    """
+    counts = list(counts)
+    cells = sorted({cell for cell, _, _ in counts})
+    features = sorted({feature for _, feature, _ in counts})
+    cell_index = {cell: k for k, cell in enumerate(cells, 1)}  # Matrix Market indices start at 1
+    feature_index = {feature: k for k, feature in enumerate(features, 1)}
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'matrix.mtx'), 'w') as file:
+        file.write("%%MatrixMarket matrix coordinate integer general\n")
+        file.write("%d %d %d\n" % (len(features), len(cells), len(counts)))
+        for cell, feature, count in sorted(counts, key=lambda x: (cell_index[x[0]], feature_index[x[1]])):
+            file.write("%d %d %d\n" % (feature_index[feature], cell_index[cell], count))
+    with open(os.path.join(output_dir, 'features.tsv'), 'w') as file:
+        file.writelines(feature + '\n' for feature in features)
+    with open(os.path.join(output_dir, 'barcodes.tsv'), 'w') as file:
+        file.writelines(cell + '\n' for cell in cells)
+
+
+def align_pyspark(filepath_cdna, filepath_seq, broadcast=False, engine='scalar', mode='full', seed_length=11, band_width=16, x_drop=20, prefilter=False, top_k=1, ties='all', umi_count=False, barcode_length=16, umi_length=12, features=None, input_format='json', spark=None, master="local[1]", num_partitions=None, reference_cache=None, metrics=None, scoring=None):
     """
     Executes the sequence alignment using PySpark.
 
     Parameters:
     filepath_cdna (str): The HDFS path where the cDNA sequences are stored.
     filepath_seq (str): The HDFS path where the single-cell RNA sequences are stored.
+    broadcast (bool): Broadcast the cDNAs to the executors instead of building the cartesian product.
+    engine (str): The quality adjusted Smith-Waterman implementation, 'scalar' or 'vectorized'.
+    mode (str): 'full' alignment against the whole cDNA, or 'banded' / 'xdrop' alignment around the best shared k-mer,
+                or 'pseudo' k-mer pseudoalignment aligning only the ambiguous sequences (broadcast only).
+    seed_length (int): k-mer length of the seeds of the banded and xdrop modes and of the pseudo mode index.
+    band_width (int): Half width of the band around the seed diagonal (banded mode).
+    x_drop (float): Score drop-off that stops the extensions (xdrop mode).
+    prefilter (bool): Skip the pairs whose edit distance bound cannot beat the k-th best score of the sequence (broadcast only),
+                      the number of pruned pairs is the 'pairs pruned' metric.
+    top_k (int): Number of best transcripts counted per sequence.
+    ties (str): 'all' keeps every transcript tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    umi_count (bool): Count the unique (cell barcode, UMI) pairs per feature instead of the sequences per transcript.
+    barcode_length (int): Length of the cell barcode at the start of the barcode read (umi_count).
+    umi_length (int): Length of the UMI following the cell barcode (umi_count).
+    features (dict): transcript_id -> feature counted by umi_count (see feature_map), by default the transcripts.
+    input_format (str): Format of the dataset, 'json' (writeToHadoop) or 'packed' (writePackedToHadoop).
+    spark (SparkSession): A session to reuse (see get_spark_session), by default a new one is started and stopped.
+    master (str): The Spark master of a newly started session, e.g. "local[*]".
+    num_partitions (int): Repartition the input into this many partitions of equal total sequence length.
+    reference_cache (str): Local path of a reference cache (see reference_cache) read instead of filepath_cdna.
+                           With broadcast, every executor memory-maps it instead of receiving a broadcast.
+    metrics (dict): Filled with the metrics of the job (see job_metrics): times per stage, records, aligned and pruned pairs and DP cells.
+    scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
 
     Returns:
-    tuple: Execution time and the alignment output.
+    tuple: Execution time and the alignment output, with umi_count the (cell, feature, count) triplets (see write_matrix_market).
     """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    features = features or {}
+    if mode == 'pseudo' and not broadcast:
+        raise ValueError("mode='pseudo' needs the cDNAs on the executors, use broadcast")
+    merge_value, merge_combiners = partial(merge_hit, k=top_k, ties=ties), partial(merge_hits, k=top_k, ties=ties)
     ts = time() # Start timing the operation
     # Initialize a Spark session and Spark context
-    with SparkSession.builder.master("local[1]").appName("SparkBlast.com").getOrCreate() as spark:
+    with spark_session(spark, master) as spark:
         sc = spark.sparkContext
-        # Read cDNA and sequence data from HDFS and deserialize JSON strings
-        cdnas_rdd = sc.textFile("hdfs://localhost:9000" + filepath_cdna).map(lambda x: loads(x))
-        sequences_rdd = sc.textFile("hdfs://localhost:9000" + filepath_seq).map(lambda x: loads(x))
-        # see alignment spark for more details
-        out = cdnas_rdd.cartesian(sequences_rdd) \
-            .map(lambda seq: (seq[1]['barcode'], (seq[0]['transcript_id'], *quality_adjusted_smith_waterman(seq[1]['sequence'], seq[1]['quality'], seq[0]['sequence'], substitution_matrix, gap_penalty)))) \
-            .combineByKey(createCombiner, mergeValue, mergeCombiners) \
-            .flatMap(lambda x: [(y[0],1) for y in x[1]]) \
-            .reduceByKey(add) \
-            .collect()
+        # Metered stages, their metrics are accumulated on the driver
+        accumulator = sc.accumulator({}, MetricsParam())
+        quality_adjusted_smith_waterman = metered(accumulator, 'align', quality_alignment_engine(engine, mode, seed_length, band_width, x_drop), quality_cells)
+        parse = metered(accumulator, 'parse', record_parser(input_format), counts={'records in': 1})
+        # Read cDNA and sequence data from HDFS (or the reference cache) and deserialize the records
+        # Parsed once: partition_by_length runs several jobs on the records and the cartesian product reads
+        # every partition of one side once per partition of the other, each would parse (and count) them again
+        if reference_cache:
+            cdnas_rdd = cached_reference_rdd(sc, reference_cache, num_partitions)
+        else:
+            cdnas_rdd = sc.textFile("hdfs://localhost:9000" + filepath_cdna).map(parse).persist()
+        sequences_rdd = sc.textFile("hdfs://localhost:9000" + filepath_seq).map(parse).persist()
+        parsed_rdds = [sequences_rdd] + ([] if reference_cache else [cdnas_rdd])
+        if num_partitions:
+            if broadcast:
+                sequences_rdd = partition_by_length(sequences_rdd, num_partitions)
+            else:
+                # The cartesian product has partitions(cdnas) x partitions(sequences) partitions,
+                # so balance the cDNAs by length and keep the sequences in a single partition
+                if not reference_cache:
+                    cdnas_rdd = partition_by_length(cdnas_rdd, num_partitions)
+                sequences_rdd = sequences_rdd.coalesce(1)
+        if broadcast:
+            # Ship the cDNAs to every executor once and keep only the best alignments of each sequence
+            # The pseudo mode looks the compatible transcripts up by ID and needs the k-mer index of the cDNAs
+            reference = dict if mode == 'pseudo' else list
+            if not reference_cache:
+                cdna_records = cdnas_rdd.collect()
+            if mode == 'pseudo':
+                index = sc.broadcast(build_kmer_index(cached_records(open_reference_cache(reference_cache)) if reference_cache else cdna_records, seed_length))
+            def best_alignments(seq, cdnas):
+                if mode == 'pseudo':
+                    hits, status = pseudoalign_hits(index.value, cdnas, seq['sequence'], seq['quality'], quality_adjusted_smith_waterman, substitution_matrix, gap_penalty, top_k, ties)
+                    add_metrics(accumulator, {'pseudo ' + status: 1})
+                    return [(seq['barcode'], hit) for hit in hits]
+                if prefilter:
+                    alignments = list(prefilter_alignments(seq['sequence'], seq['quality'], cdnas, quality_adjusted_smith_waterman, substitution_matrix, gap_penalty, top_k))
+                    add_metrics(accumulator, {'pairs pruned': sum(alignment is None for _, alignment in alignments)})
+                else:
+                    alignments = ((transcript_id, quality_adjusted_smith_waterman(seq['sequence'], seq['quality'], sequence, substitution_matrix, gap_penalty)) for transcript_id, sequence in cdnas)
+                # Seeded modes skip the cDNAs without a shared k-mer, only (transcript_id, score) is kept
+                return [(seq['barcode'], hit) for hit in top_hits(((transcript_id, alignment[0]) for transcript_id, alignment in alignments if alignment is not None), top_k, ties, unique=True)]
+            if reference_cache:
+                # The cache file is shipped instead, each partition memory-maps it once
+                sc.addFile(reference_cache)
+                name = os.path.basename(reference_cache)
+                def cached_cdnas():
+                    return reference((cdna['transcript_id'], cdna['sequence']) for cdna in cached_records(open_reference_cache(SparkFiles.get(name))))
+                alignments_rdd = sequences_rdd.mapPartitions(lambda seqs: (pair for cdnas in [cached_cdnas()] for seq in seqs for pair in best_alignments(seq, cdnas)))
+            else:
+                cdnas = sc.broadcast(reference((cdna['transcript_id'], cdna['sequence']) for cdna in cdna_records))
+                alignments_rdd = sequences_rdd.flatMap(lambda seq: best_alignments(seq, cdnas.value))
+        else:
+            # see alignment spark for more details
+            alignments_rdd = cdnas_rdd.cartesian(sequences_rdd) \
+                .map(lambda seq: (seq[1]['barcode'], seq[0]['transcript_id'], quality_adjusted_smith_waterman(seq[1]['sequence'], seq[1]['quality'], seq[0]['sequence'], substitution_matrix, gap_penalty))) \
+                .filter(lambda x: x[2] is not None) \
+                .map(lambda x: (x[0], (x[1], x[2][0]))) # Seeded modes skip the pairs without a shared k-mer
+        best_rdd = alignments_rdd.combineByKey(first_hit, merge_value, merge_combiners)
+        if umi_count:
+            # Collapse the duplicates of a molecule to one (cell, UMI, feature), then count the UMIs per (cell, feature)
+            out = best_rdd \
+                .flatMap(lambda x: [(x[0][:barcode_length], x[0][barcode_length:barcode_length + umi_length], features.get(y[0], y[0])) for y in x[1]]) \
+                .distinct() \
+                .map(lambda x: ((x[0], x[2]), 1)) \
+                .reduceByKey(add) \
+                .map(lambda x: (x[0][0], x[0][1], x[1])) \
+                .collect()
+        else:
+            out = best_rdd \
+                .flatMap(lambda x: [(y[0],1) for y in x[1]]) \
+                .reduceByKey(add) \
+                .collect()
+        for rdd in parsed_rdds:
+            rdd.unpersist()
+        if metrics is not None:
+            metrics.update(accumulator.value)
     te = time() # End timing the operation
     return te-ts, out # Return the execution time and results
 
 
-def align_hadoop(filepath_cdna, filepath_seq):
+def align_hadoop(filepath_cdna, filepath_seq, broadcast=False, engine='scalar', mode='full', seed_length=11, band_width=16, x_drop=20, prefilter=False, top_k=1, ties='all', umi_count=False, barcode_length=16, umi_length=12, features=None, input_format='json', reference_cache=None, metrics=None, profile_task=None, scoring=None):
     """
     Executes the sequence alignment using Hadoop MapReduce.
 
     Parameters:
     filepath_cdna (str): The HDFS path where the cDNA sequences are stored.
     filepath_seq (str): The HDFS path where the single-cell RNA sequences are stored.
+    broadcast (bool): Ship the cDNAs to every mapper (--cdna_file) instead of building the cartesian product, required by mode='pseudo'.
+    engine (str): The quality adjusted Smith-Waterman implementation, 'scalar' or 'vectorized'.
+    mode (str): 'full' alignment against the whole cDNA, or 'banded' / 'xdrop' alignment around the best shared k-mer,
+                or 'pseudo' k-mer pseudoalignment aligning only the ambiguous sequences (broadcast only).
+    seed_length (int): k-mer length of the seeds of the banded and xdrop modes and of the pseudo mode index.
+    band_width (int): Half width of the band around the seed diagonal (banded mode).
+    x_drop (float): Score drop-off that stops the extensions (xdrop mode).
+    prefilter (bool): Skip the pairs whose edit distance bound cannot beat the k-th best score of the sequence so far,
+                      the pruned pairs are counted in the 'alignment' job counters.
+    top_k (int): Number of best transcripts counted per sequence.
+    ties (str): 'all' keeps every transcript tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    umi_count (bool): Count the unique (cell barcode, UMI) pairs per feature instead of the sequences per transcript,
+                      the duplicates are collapsed by a combiner before the shuffle.
+    barcode_length (int): Length of the cell barcode at the start of the barcode read (umi_count).
+    umi_length (int): Length of the UMI following the cell barcode (umi_count).
+    features (dict): transcript_id -> feature counted by umi_count (see feature_map), by default the transcripts.
+    input_format (str): Format of the dataset, 'json' (writeToHadoop) or 'packed' (writePackedToHadoop).
+    reference_cache (str): Local path of a reference cache (see reference_cache) memory-mapped by every mapper
+                           instead of filepath_cdna, implies broadcast.
+    metrics (dict): Filled with the 'alignment' counters of the job (see job_metrics): times per stage, records, aligned and pruned pairs and DP cells.
+    profile_task (int): Run the sampling profiler in the mapper tasks with this partition number (see the task logs).
+    scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
 
     Returns:
-    tuple: Execution time and the alignment output.
+    tuple: Execution time and the alignment output, with umi_count the (cell, feature, count) triplets (see write_matrix_market).
     """
+    args, matrix_file = scoring_args(scoring)
+    if profile_task is not None:
+        args += ["--profile_task", str(profile_task)]
+    if umi_count:
+        args += ["--umi_count", "--barcode_length", str(barcode_length), "--umi_length", str(umi_length)]
+        if features:
+            feature_file = NamedTemporaryFile('w', suffix='.tsv', delete=False)
+            with feature_file:
+                feature_file.writelines("%s\t%s\n" % item for item in features.items())
+            args += ["--feature_map", feature_file.name]
     ts = time() # Start timing the operation
     # Run the Hadoop job using the specified script and capture the output
-    result = run(["python3", "alignment_hadoop.py", "-r", "hadoop", "--conf-path","mrjob.conf", "hdfs://localhost:9000" + filepath_cdna, "hdfs://localhost:9000" + filepath_seq], capture_output=True)
+    if reference_cache:
+        inputs = ["--reference_cache", reference_cache, "hdfs://localhost:9000" + filepath_seq]
+    elif broadcast:
+        inputs = ["--cdna_file", "hdfs://localhost:9000" + filepath_cdna, "hdfs://localhost:9000" + filepath_seq]
+    else:
+        inputs = ["hdfs://localhost:9000" + filepath_cdna, "hdfs://localhost:9000" + filepath_seq]
+    result = run(["python3", "alignment_hadoop.py", "-r", "hadoop", "--conf-path","mrjob.conf", "--engine", engine, "--mode", mode, "--seed_length", str(seed_length), "--band_width", str(band_width), "--x_drop", str(x_drop), *(["--prefilter"] if prefilter else []), "--top_k", str(top_k), "--ties", ties, *args, "--input_format", input_format, *inputs], capture_output=True)
     te = time() # End timing the operation
+    if umi_count and features:
+        os.remove(feature_file.name)
+    if matrix_file:
+        os.remove(matrix_file)
+    if metrics is not None:
+        metrics.update(parse_counters(result.stderr.decode('utf-8')).get('alignment', {}))
     # Process the output from the Hadoop job
-    out = list(map(lambda x: (x[0][1:-1], int(x[1])), 
-                   map(lambda x: x.split('\t'),
-                       result.stdout.decode('utf-8').split('\n')[:-1])))
-    return te-ts, out # Return the execution time and results
\ No newline at end of file
+    lines = map(lambda x: x.split('\t'), result.stdout.decode('utf-8').split('\n')[:-1])
+    if umi_count:
+        out = [(*loads(x[0]), int(x[1])) for x in lines] # Key [cell, feature]
+    else:
+        out = list(map(lambda x: (x[0][1:-1], int(x[1])), lines))
+    return te-ts, out # Return the execution time and results
+
+from local_backend import share_sequences, shared_reference, attach_reference, attach_reference_cache, reference_sequence, \
+    blastn_local_shard, align_local_shard, local_reference, shard_bounds, blastn_local, align_local
@@ -3,7 +3,7 @@
 from mrjob.job import MRJob
 from mrjob.step import MRStep
 from json import loads, dumps
-from functools import reduce
+from functools import cached_property
 import numpy as np
 from mrjob.protocol import JSONValueProtocol
 
@@ -14,7 +14,7 @@ class TupleProtocol(object):
 
 class Blastn_Hadoop(MRJob):
     # Include additional files needed by the job
-    FILES = ['seq_utils.py']
+    FILES = ['seq_utils.py', 'kmer_index.py', 'seq_format.py', 'reducer_utils.py', 'reference_cache.py', 'job_metrics.py']
     
     OUTPUT_PROTOCOL = TupleProtocol
 
@@ -22,50 +22,206 @@ class Blastn_Hadoop(MRJob):
         super(Blastn_Hadoop, self).configure_args()
         self.add_passthru_arg(
             '--query_sequence', type=str, default="AGTACGCATACGGCATA", help='please input a sequence to query')
+        self.add_passthru_arg(
+            '--engine', type=str, default='scalar', choices=['scalar', 'vectorized'], help='Smith-Waterman implementation used by the mapper')
+        self.add_passthru_arg(
+            '--input_format', type=str, default='json', choices=['json', 'packed'], help='format of the input lines, JSON or the 2-bit packed format of seq_format')
+        self.add_passthru_arg(
+            '--score_only', action='store_true', default=False, help='score all transcripts without traceback and align only the top-k hits of each mapper task')
+        self.add_file_arg(
+            '--query_file', default=None, help='file with one query per line (query_id<TAB>sequence), aligns all queries in one pass')
+        self.add_file_arg(
+            '--kmer_index', default=None, help='k-mer index (.npz from kmer_index.build_kmer_index), only transcripts sharing a seed with the query are aligned')
+        self.add_passthru_arg(
+            '--band_width', type=int, default=16, help='band width around the seed diagonals used with --kmer_index')
+        self.add_passthru_arg(
+            '--exhaustive', action='store_true', default=False, help='ignore --kmer_index and align every transcript, for correctness checks')
+        self.add_passthru_arg(
+            '--top_k', type=int, default=1, help='number of best hits to output (per query)')
+        self.add_passthru_arg(
+            '--ties', type=str, default='all', choices=['all', 'lowest_id'], help='keep all hits tying with the k-th best, or break ties by the lowest transcript ID')
+        self.add_file_arg(
+            '--reference_cache', default=None, help='pre-encoded reference (reference_cache.build_reference_cache), the input lines are then start<TAB>end ranges of transcripts to align')
+        self.add_passthru_arg(
+            '--profile_task', type=int, default=None, help='run a sampling profiler in the mapper task with this partition number, its collapsed stacks are written to the task log')
+        self.add_file_arg(
+            '--scoring_matrix', default=None, help='substitution matrix file (seq_utils.read_score_table, e.g. NCBI NUC.4.4), default: match 2, mismatch -1, N 0')
+        self.add_passthru_arg(
+            '--gap_open', type=float, default=-2, help='score of the first base of a gap')
+        self.add_passthru_arg(
+            '--gap_extend', type=float, default=None, help='score of every further base of a gap (affine gaps, needs the vectorized engine), default: --gap_open (linear gaps)')
+
+    @cached_property
+    def scoring(self):
+        """
+        The seq_utils.ScoringScheme of --scoring_matrix, --gap_open and --gap_extend, built once per task.
+        """
+        from seq_utils import ScoringScheme
+        return ScoringScheme.from_file(self.options.scoring_matrix, self.options.gap_open, self.options.gap_extend)
+
+    def hadoop_input_format(self):
+        """
+        With --reference_cache every line of the (small) input is a range of transcripts, one map task per line.
+        """
+        if self.options.reference_cache:
+            return 'org.apache.hadoop.mapred.lib.NLineInputFormat'
+        return super(Blastn_Hadoop, self).hadoop_input_format()
+
+    def read_records(self, line):
+        """
+        Parses an input line in the format given by --input_format,
+        or yields the transcripts of a start<TAB>end range of the --reference_cache without parsing.
+        Hadoop streaming's NLineInputFormat prepends the byte offset (offset<TAB>start<TAB>end), local runners don't.
+        """
+        if self.options.reference_cache:
+            from reference_cache import cached_records
+            start, end = map(int, line.split('\t')[-2:])
+            return cached_records(self.reference, start, end)
+        return [self.read_record(line)]
+
+    def read_record(self, line):
+        """
+        Parses an input line in the format given by --input_format.
+        """
+        if self.options.input_format == 'packed':
+            from seq_format import decode_record
+            return decode_record(line)
+        return loads(line)
+
+    def seeded(self):
+        """
+        True if the transcripts are prefiltered with the k-mer index (single query mode only).
+        """
+        return bool(self.options.kmer_index) and not self.options.exhaustive and not self.options.query_file
+
+    def mapper_init(self):
+        """
+        Loads the queries of the batch mode once per mapper task.
+        With --kmer_index the seeds of the query are looked up once per mapper task.
+        The mapper keeps the top-k hits of each key (see add_hit) and emits them in mapper_final.
+        The parsing and alignment functions are metered (see job_metrics), the metrics are reported as counters by mapper_final.
+        """
+        from seq_utils import read_queries, alignment_engines, smith_waterman_score, smith_waterman_score_batch, banded_smith_waterman
+        from kmer_index import load_kmer_index, find_candidates
+        from reference_cache import open_reference_cache
+        from job_metrics import metered, full_cells, banded_cells, batch_cells, start_profiler, task_partition
+        self.metrics = {}
+        self.profile = start_profiler() if self.options.profile_task == task_partition() else None
+        self.parse = metered(self.metrics, 'parse', lambda line: list(self.read_records(line)))
+        self.smith_waterman = metered(self.metrics, 'align', alignment_engines[self.options.engine], full_cells)
+        self.banded_smith_waterman = metered(self.metrics, 'align', banded_smith_waterman, banded_cells)
+        self.seed_smith_waterman = metered(self.metrics, 'align', alignment_engines['vectorized'], full_cells)
+        self.smith_waterman_score = metered(self.metrics, 'score', smith_waterman_score, full_cells)
+        self.smith_waterman_score_batch = metered(self.metrics, 'score', smith_waterman_score_batch, batch_cells, lambda queries, *_: len(queries))
+        self.traceback = metered(self.metrics, 'traceback', alignment_engines[self.options.engine])
+        self.reference = open_reference_cache(self.options.reference_cache) if self.options.reference_cache else None
+        self.queries = read_queries(self.options.query_file) if self.options.query_file else None
+        self.candidates = None
+        if self.seeded():
+            self.candidates = find_candidates(load_kmer_index(self.options.kmer_index), self.options.query_sequence)
+        self.top = {}
+        self.payloads = {}
+
+    def add_hit(self, key, hit, payload):
+        """
+        Adds a (transcript_id, score) hit to the top-k of a key. Its payload, the aligned sequences
+        or the cDNA sequence if the traceback is deferred, is kept only while the hit survives.
+        The windows of a long transcript (see seq_utils.split_windows) are merged into its best hit.
+        """
+        from reducer_utils import merge_hit
+        top = merge_hit(self.top.setdefault(key, []), hit, self.options.top_k, self.options.ties, unique=True)
+        if hit in top:
+            payloads = self.payloads.setdefault(key, {})
+            payloads[hit[0]] = payload
+            for transcript_id in set(payloads) - {transcript_id for transcript_id, score in top}:
+                del payloads[transcript_id]
 
     def mapper(self, _, line):
         """
         The mapper function processes each line of the input file.
         It loads the sequence data from JSON, applies the Smith-Waterman algorithm,
-        and yields the transcript ID along with the alignment score and aligned sequences.
+        and keeps the transcript ID along with the alignment score and aligned sequences if it is among the top-k.
+        With --score_only the transcripts are only scored, the top-k are aligned in mapper_final.
+        With --query_file all queries are scored against the cDNA at once and the results are keyed by query ID.
+        With --kmer_index only candidate transcripts are aligned, in a band around their seed diagonals.
         """
-        from seq_utils import smith_waterman, substitution_matrix, gap_penalty
-        seq = loads(line) # Parse the JSON line into a dictionary
-        yield _, (seq['transcript_id'], *smith_waterman(self.options.query_sequence, seq['sequence'], substitution_matrix, gap_penalty))
-
+        from kmer_index import seeded_alignment
+        from job_metrics import add_metrics
+        substitution_matrix, gap_penalty = self.scoring.substitution_matrix, self.scoring.gap_penalty
+        records = self.parse(line) # Parse the line into dictionaries
+        add_metrics(self.metrics, {'records in': len(records)})
+        for seq in records:
+            if self.candidates is not None:
+                if seq['transcript_id'] in self.candidates: # Transcripts without a shared seed are skipped
+                    score, align1, align2 = seeded_alignment(self.options.query_sequence, seq['sequence'], self.candidates[seq['transcript_id']], self.options.band_width,
+                                                             seq.get('window', 0), substitution_matrix, gap_penalty, self.banded_smith_waterman, self.seed_smith_waterman)
+                    self.add_hit(_, (seq['transcript_id'], score), (align1, align2))
+                else:
+                    add_metrics(self.metrics, {'pairs pruned': 1})
+            elif self.queries is not None:
+                scores = self.smith_waterman_score_batch([query for query_id, query in self.queries], seq['sequence'], substitution_matrix, gap_penalty)
+                for (query_id, query), score in zip(self.queries, scores):
+                    self.add_hit(query_id, (seq['transcript_id'], score), seq['sequence'])
+            elif self.options.score_only:
+                self.add_hit(_, (seq['transcript_id'], self.smith_waterman_score(self.options.query_sequence, seq['sequence'], substitution_matrix, gap_penalty)), seq['sequence'])
+            else:
+                score, align1, align2 = self.smith_waterman(self.options.query_sequence, seq['sequence'], substitution_matrix, gap_penalty)
+                self.add_hit(_, (seq['transcript_id'], score), (align1, align2))
+        return iter(()) # The hits are emitted by mapper_final
 
-    def mergeValue(self, c,v):
+    def mapper_final(self):
         """
-        This function merges values for the combiner and reducer.
-        It keeps the alignments with the highest scores.
+        Emits the top-k hits kept by add_hit with their alignment, so at most k alignments per key and mapper task
+        go through the shuffle. Hits with a deferred traceback (a cDNA sequence as payload) are aligned here.
+        Finally the metrics of the task are reported in the 'blastn' counter group.
         """
-        if not c: # If no current best alignment, use the new value
-            return [v]
-        if c[0][1] > v[1]: # If the current best score is higher, keep the current best
-            return c
-        elif c[0][1] == v[1]: # If the scores are equal, append the new alignment
-            c.append(v)
-            return c
-        else: # If the new score is higher, use the new value
-            return [v]
+        from job_metrics import flush_counters, stop_profiler
+        substitution_matrix, gap_penalty = self.scoring.substitution_matrix, self.scoring.gap_penalty
+        queries = dict(self.queries) if self.queries is not None else {}
+        for key, top in self.top.items():
+            for transcript_id, score in top:
+                payload = self.payloads[key][transcript_id]
+                if not isinstance(payload, tuple):
+                    yield key, (transcript_id, *self.traceback(queries.get(key, self.options.query_sequence), payload, substitution_matrix, gap_penalty))
+                else:
+                    yield key, (transcript_id, score, *payload)
+        flush_counters(self, 'blastn', self.metrics)
+        if self.profile is not None:
+            stop_profiler(self.profile)
 
-    
     def combiner(self, _, blast):
         """
         The combiner function aggregates results locally before sending to the reducer.
-        It applies the mergeValue function to keep only the best alignments.
+        It keeps only the top-k alignments (see reducer_utils), one per transcript.
         """
-        for i in reduce(self.mergeValue, blast, []):
+        from reducer_utils import top_hits
+        for i in top_hits(blast, self.options.top_k, self.options.ties, unique=True):
             yield _, i
 
     def reducer(self, _, blast):
         """
         The reducer function aggregates results from all mappers and combiners.
-        It applies the mergeValue function to keep only the best alignments.
+        It keeps only the top-k alignments (see reducer_utils), one per transcript.
+        In the batch mode the key is the query ID, which is prepended to each hit.
         """
-        for i in reduce(self.mergeValue, blast, []):
+        from reducer_utils import top_hits
+        for i in top_hits(blast, self.options.top_k, self.options.ties, unique=True):
+            if self.options.query_file:
+                i = (_, *i)
             yield _,i
 
+    def steps(self):
+        """
+        Defines the single step of the job, after checking the options that would otherwise fail in every mapper.
+        """
+        if self.options.gap_extend not in (None, self.options.gap_open) and self.options.engine == 'scalar' and not self.seeded():
+            raise ValueError("Affine gaps (--gap_extend) need --engine vectorized, or --kmer_index whose banded alignment supports them")
+        return [MRStep(mapper_init=self.mapper_init,
+                       mapper=self.mapper,
+                       mapper_final=self.mapper_final,
+                       combiner=self.combiner,
+                       reducer=self.reducer)]
+
 
 if __name__ == '__main__':
     # Run the MRJob
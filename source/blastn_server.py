@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.client import HTTPConnection
+from json import dumps, loads
+from os import cpu_count
+from time import perf_counter, time
+from seq_utils import ALPHABET, ScoringScheme, alignment_engines, smith_waterman_score_batch
+from reference_cache import MAGIC, open_reference_cache, reference_cache
+from reducer_utils import TIE_POLICIES, hit_key, merge_hit, merge_hits
+from local_backend import attach_reference_cache, reference_sequence, scoring_scheme, shard_bounds, shared_reference
+
+# Long-running BLASTN query service, for lookups that can't pay the startup of a Hadoop job or a Spark session.
+# The reference cache (see reference_cache) is memory-mapped once by a pool of worker processes, like blastn_local.
+# Concurrent queries are collected into batches that are scored together (smith_waterman_score_batch) shard by shard
+# in the pool, only the top-k hits of each query are aligned. The hits have the shape of blastn_pyspark:
+# (transcript_id, score, align1, align2).
+#
+# HTTP endpoints (JSON):
+#   POST /query    {"query": "ACGT...", "top_k": 1, "ties": "all"} -> {"hits": [...], "latency_ms": ...}
+#   GET  /metrics  request, batch and latency metrics
+#   GET  /health   {"status": "ok", "transcripts": ...}
+
+
+def score_shard(queries, start, end, scoring=None):
+    """
+    Scores a batch of queries against the reference sequences start to end-1 (in a worker process).
+
+    Parameters:
+    queries (list): (sequence, top_k, ties) of each query.
+
+    Returns:
+    list: The top-k (transcript_id, score, k) hits of each query, k being the index of the reference sequence.
+    """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    transcript_ids = shared_reference['transcript_ids']
+    sequences = [sequence for sequence, _, _ in queries]
+    tops = [[] for _ in queries]
+    for k in range(start, end):
+        for top, (_, top_k, ties), score in zip(tops, queries, smith_waterman_score_batch(sequences, reference_sequence(k), substitution_matrix, gap_penalty)):
+            merge_hit(top, (transcript_ids[k], score, k), top_k, ties)
+    return tops
+
+
+def align_hits(query_sequence, hits, engine='vectorized', scoring=None):
+    """
+    Aligns the query against the reference sequences of its (transcript_id, score, k) hits (in a worker process).
+    """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    smith_waterman = alignment_engines[engine]
+    return [(hit[0], *smith_waterman(query_sequence, reference_sequence(hit[2]), substitution_matrix, gap_penalty)) for hit in hits]
+
+
+class BlastnServer:
+    """
+    Batches the queries of concurrent requests and dispatches them to a pool of worker processes sharing the reference.
+
+    Parameters:
+    reference (str): A reference cache, or a FASTA file whose cache is (re)built next to it (see reference_cache).
+    processes (int): Number of worker processes, default: number of CPUs.
+    engine (str): The Smith-Waterman implementation used for the traceback of the best hits, 'scalar' or 'vectorized'.
+    scoring (ScoringScheme): Substitution scores and gap penalties (see seq_utils.ScoringScheme).
+    max_batch (int): Most queries scored together.
+    max_wait (float): Seconds a batch waits for more queries after its first one.
+    shards (int): Number of reference shards per batch, default: 4 per worker process.
+    window (int): Number of recent requests of the latency percentiles.
+
+    Raises:
+    ValueError: If the scoring scheme has affine gaps and the engine is 'scalar', which only supports linear gaps.
+    """
+
+    def __init__(self, reference, processes=None, engine='vectorized', scoring=None, max_batch=32, max_wait=0.005, shards=None, window=1000):
+        # Rejected here, not with an error on every query
+        if engine == 'scalar' and scoring is not None and scoring.affine:
+            raise ValueError("Affine gaps (--gap_extend) need --engine vectorized")
+        with open(reference, 'rb') as file:
+            is_cache = file.read(len(MAGIC)) == MAGIC
+        self.reference = reference if is_cache else reference + '.refcache'
+        if not is_cache:
+            reference_cache(reference, self.reference)
+        cache = open_reference_cache(self.reference)
+        self.transcripts, self.reference_length = len(cache['transcript_ids']), int(cache['offsets'][-1])
+        self.processes = processes or cpu_count()
+        self.engine, self.scoring = engine, scoring
+        self.max_batch, self.max_wait = max_batch, max_wait
+        self.bounds = shard_bounds(self.transcripts, shards or 4 * self.processes)
+        self.pool = None
+        self.queue = None
+        self.started = time()
+        self.latencies = deque(maxlen=window)
+        self.counts = {'requests': 0, 'errors': 0, 'batches': 0, 'batched queries': 0, 'cells': 0}
+
+    async def start(self):
+        """
+        Starts the worker processes (each memory-maps the reference once) and the batching task.
+        """
+        self.pool = ProcessPoolExecutor(self.processes, initializer=attach_reference_cache, initargs=(self.reference,))
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(2)  # One batch is collected while the previous one is scored
+        self.batcher = asyncio.create_task(self.collect_batches())
+
+    def close(self):
+        self.batcher.cancel()
+        self.pool.shutdown(cancel_futures=True)
+
+    async def query(self, query_sequence, top_k=1, ties='all'):
+        """
+        Queues a query and waits for its top-k hits, (transcript_id, score, align1, align2) tuples like blastn_pyspark.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query_sequence, top_k, ties, future))
+        return await future
+
+    async def collect_batches(self):
+        """
+        Takes the first waiting query and up to max_batch - 1 more that arrive within max_wait, then scores them together.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+            await self.slots.acquire()
+            asyncio.create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        """
+        Scores a batch shard by shard in the pool, merges the top-k of each query and aligns only those hits.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            queries = [(query_sequence, top_k, ties) for query_sequence, top_k, ties, _ in batch]
+            shards = await asyncio.gather(*(loop.run_in_executor(self.pool, score_shard, queries, start, end, self.scoring) for start, end in self.bounds))
+            tops = [[] for _ in queries]
+            for shard in shards:
+                tops = [merge_hits(top, hits, top_k, ties) for top, hits, (_, top_k, ties) in zip(tops, shard, queries)]
+            alignments = await asyncio.gather(*(loop.run_in_executor(self.pool, align_hits, query_sequence, top, self.engine, self.scoring)
+                                                for (query_sequence, _, _), top in zip(queries, tops)))
+            self.counts['batches'] += 1
+            self.counts['batched queries'] += len(batch)
+            self.counts['cells'] += sum(len(query_sequence) for query_sequence, _, _ in queries) * self.reference_length
+            for (_, _, _, future), hits in zip(batch, alignments):
+                if not future.done():
+                    future.set_result(sorted(hits, key=hit_key))
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.slots.release()
+
+    def metrics(self):
+        """
+        Request, batch and latency metrics since the start of the server, the latencies over the last window requests.
+        """
+        uptime = time() - self.started
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)] if latencies else None
+        return {
+            **self.counts,
+            'uptime [s]': uptime,
+            'queries/s': self.counts['requests'] / uptime if uptime > 0 else None,
+            'mean batch size': self.counts['batched queries'] / self.counts['batches'] if self.counts['batches'] else None,
+            'queued': self.queue.qsize() if self.queue else 0,
+            'latency p50 [ms]': percentile(50),
+            'latency p95 [ms]': percentile(95),
+            'latency p99 [ms]': percentile(99),
+            'latency max [ms]': latencies[-1] if latencies else None,
+            'GCUPS': self.counts['cells'] / uptime / 1e9 if uptime > 0 else None,
+            'transcripts': self.transcripts,
+            'processes': self.processes,
+        }
+
+    async def handle_query(self, body):
+        """
+        Validates a query request and returns the status and the response of the POST /query endpoint.
+        """
+        ts = perf_counter()
+        try:
+            request = loads(body or b'{}')
+            query_sequence, top_k, ties = request['query'].upper(), int(request.get('top_k', 1)), request.get('ties', 'all')
+            if not query_sequence or set(query_sequence) - set(ALPHABET) or top_k < 1 or ties not in TIE_POLICIES:
+                raise ValueError("query must be a non-empty %s sequence, top_k >= 1 and ties one of %s" % (ALPHABET, ', '.join(TIE_POLICIES)))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.counts['errors'] += 1
+            return 400, {'error': str(e)}
+        try:
+            hits = await self.query(query_sequence, top_k, ties)
+        except Exception as e:
+            self.counts['errors'] += 1
+            return 500, {'error': str(e)}
+        latency = (perf_counter() - ts) * 1000
+        self.counts['requests'] += 1
+        self.latencies.append(latency)
+        return 200, {'hits': hits, 'latency_ms': latency}
+
+    async def handle(self, reader, writer):
+        """
+        Serves the HTTP/1.1 requests of a connection (kept alive until the client closes it).
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if method == 'POST' and path == '/query':
+                    status, response = await self.handle_query(body)
+                elif method == 'GET' and path == '/metrics':
+                    status, response = 200, self.metrics()
+                elif method == 'GET' and path == '/health':
+                    status, response = 200, {'status': 'ok', 'transcripts': self.transcripts}
+                else:
+                    status, response = 404, {'error': 'unknown endpoint %s %s' % (method, path)}
+                payload = dumps(response).encode('utf_8')
+                close = headers.get('connection', '').lower() == 'close'
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n'
+                             % (status, {200: b'OK', 400: b'Bad Request', 404: b'Not Found'}.get(status, b'Error'), len(payload), b'close' if close else b'keep-alive'))
+                writer.write(payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Broken or malformed connection
+        finally:
+            writer.close()
+
+
+async def serve(server, host='127.0.0.1', port=8642, unix=None):
+    """
+    Runs the server on a TCP port, or on a Unix socket if unix is given, until it is cancelled.
+    """
+    await server.start()
+    if unix:
+        listener = await asyncio.start_unix_server(server.handle, path=unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    print("Serving %d transcripts on %s" % (server.transcripts, unix or '%s:%d' % (host, port)), flush=True)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def blastn_server(query_sequence, top_k=1, ties='all', host='127.0.0.1', port=8642):
+    """
+    Executes the BLASTN algorithm on a running query server.
+
+    Parameters:
+    query_sequence (str): The DNA sequence to be used as the query for the alignment.
+    top_k (int): Number of best hits to output.
+    ties (str): 'all' keeps every hit tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    host (str): Host of the server.
+    port (int): Port of the server.
+
+    Returns:
+    tuple: Execution time and the alignment output, like blastn_pyspark.
+
+    Raises:
+    RuntimeError: If the server rejects the query.
+    """
+    ts = time() # Start timing the operation
+    connection = HTTPConnection(host, port)
+    try:
+        connection.request('POST', '/query', dumps({'query': query_sequence, 'top_k': top_k, 'ties': ties}), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        result = loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError("Query failed (%d): %s" % (response.status, result.get('error')))
+    te = time() # End timing the operation
+    return te-ts, [tuple(hit) for hit in result['hits']]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='BLASTN query server over a reference loaded once')
+    parser.add_argument('reference', help='reference cache (see reference_cache), or a cDNA FASTA file whose cache is built next to it')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--unix', default=None, help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, default: number of CPUs')
+    parser.add_argument('--engine', default='vectorized', choices=['scalar', 'vectorized'], help='Smith-Waterman implementation of the traceback')
+    parser.add_argument('--max_batch', type=int, default=32, help='most queries scored together')
+    parser.add_argument('--max_wait_ms', type=float, default=5, help='milliseconds a batch waits for more queries')
+    parser.add_argument('--scoring_matrix', default=None, help='substitution matrix file (seq_utils.read_score_table)')
+    parser.add_argument('--gap_open', type=float, default=-2, help='score of the first base of a gap')
+    parser.add_argument('--gap_extend', type=float, default=None, help='score of every further base of a gap (affine gaps), default: --gap_open')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    scoring = ScoringScheme.from_file(options.scoring_matrix, options.gap_open, options.gap_extend)
+    server = BlastnServer(options.reference, options.processes, options.engine, scoring, options.max_batch, options.max_wait_ms / 1000)
+    try:
+        asyncio.run(serve(server, options.host, options.port, options.unix))
+    except KeyboardInterrupt:
+        pass
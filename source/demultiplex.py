@@ -0,0 +1,214 @@
+import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from json import dumps
+from zlib import crc32
+from seq_utils import base_codes, open_text, iter_chunks
+from seq_format import encode_record
+
+# Demultiplexing of the paired single-cell FASTQs (R1: cell barcode + UMI, R2: cDNA read) before the alignment jobs.
+# Cell barcodes are corrected against a whitelist, reads with a low quality or uncorrectable barcode are dropped,
+# and the reads are written to part files partitioned by cell. The 'barcode' field of the written records stays the
+# (corrected) cell barcode followed by the UMI, so the alignment jobs keep one key per molecule, while the
+# sequencing-error variants of a barcode now share the key of the whitelisted barcode.
+
+
+def read_whitelist(filepath):
+    """
+    Reads a barcode whitelist (plain or gzip), one barcode per line.
+    """
+    with open_text(filepath) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def pack_barcodes(barcodes):
+    """
+    Packs equal length barcodes into 2 bits per base (int64, length <= 31).
+    Returns the codes and a mask of the barcodes containing 'N' (or any other non ACGT character).
+    """
+    if not barcodes:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+    codes = base_codes[np.frombuffer(''.join(barcodes).encode('ascii'), dtype=np.uint8)].reshape(len(barcodes), -1)
+    weights = 4 ** np.arange(codes.shape[1] - 1, -1, -1, dtype=np.int64)
+    return (codes & 3).astype(np.int64) @ weights, (codes > 3).any(axis=1)
+
+
+def build_barcode_table(whitelist):
+    """
+    Precomputes the Hamming-1 neighbour lookup table of a whitelist.
+
+    Every whitelisted barcode and each of its 3 * length single substitution variants is stored with the index of
+    its whitelisted barcode. Variants that are neighbours of several whitelisted barcodes are ambiguous and left out,
+    a whitelisted barcode always maps to itself.
+
+    Returns:
+    dict: 'whitelist' (array of barcodes), 'codes' (sorted packed codes), 'targets' (whitelist indices)
+          and 'exact' (True for the whitelisted barcodes themselves).
+    """
+    length = len(whitelist[0])
+    packed, _ = pack_barcodes(whitelist)
+    indices = np.arange(len(whitelist), dtype=np.int32)
+    codes, targets, exact = [packed], [indices], [np.ones(len(whitelist), dtype=bool)]
+    for position in range(length):
+        shift = 2 * (length - 1 - position)
+        for delta in (1, 2, 3):  # XOR with 1, 2, 3 changes the base at position to each of the 3 other bases
+            codes.append(packed ^ (delta << shift))
+            targets.append(indices)
+            exact.append(np.zeros(len(whitelist), dtype=bool))
+    codes, targets, exact = np.concatenate(codes), np.concatenate(targets), np.concatenate(exact)
+
+    # Sort by code with the exact entries first, then keep a code only if it is exact or has a single neighbour
+    order = np.lexsort((~exact, codes))
+    codes, targets, exact = codes[order], targets[order], exact[order]
+    first = np.concatenate(([True], codes[1:] != codes[:-1]))
+    counts = np.diff(np.concatenate((np.flatnonzero(first), [len(codes)])))
+    keep = first & (exact | (np.repeat(counts, counts) == 1))
+    return {'whitelist': np.array(whitelist), 'codes': codes[keep], 'targets': targets[keep], 'exact': exact[keep]}
+
+
+def correct_barcodes(table, barcodes):
+    """
+    Corrects barcodes with a table of build_barcode_table.
+    A barcode with a single 'N' is corrected if exactly one whitelisted barcode matches at the other positions.
+
+    Returns:
+    tuple: The whitelist index of every barcode (-1 if it can't be corrected) and a mask of the corrected ones.
+    """
+    packed, has_n = pack_barcodes(barcodes)
+    codes = table['codes']
+    positions = np.minimum(np.searchsorted(codes, packed), len(codes) - 1)
+    found = (codes[positions] == packed) & ~has_n
+    targets = np.where(found, table['targets'][positions], -1)
+    corrected = found & ~table['exact'][positions]
+
+    for row in np.flatnonzero(has_n):
+        barcode = barcodes[row]
+        if barcode.count('N') != 1:
+            continue
+        matches = set()
+        for base in 'ACGT':
+            candidate, _ = pack_barcodes([barcode.replace('N', base)])
+            position = np.searchsorted(codes, candidate[0])
+            if position < len(codes) and codes[position] == candidate[0] and table['exact'][position]:
+                matches.add(int(table['targets'][position]))
+        if len(matches) == 1:
+            targets[row] = matches.pop()
+            corrected[row] = True
+    return targets, corrected
+
+
+def iter_read_pairs(sequences_path, barcodes_path):
+    """
+    Reads the R2 (sequence) and R1 (barcode) FASTQ files (plain or gzip) in lockstep like iter_fastq_barcode,
+    but yields plain (sequence, quality, barcode, bc_quality) tuples without parsing the headers.
+    """
+    with open_text(sequences_path) as seq_file, open_text(barcodes_path) as code_file:
+        while True:
+            if not seq_file.readline().strip():
+                break  # End of file
+            code_file.readline()
+            sequence, barcode = seq_file.readline().strip(), code_file.readline().strip()
+            seq_file.readline()  # Plus sign lines (ignored)
+            code_file.readline()
+            yield sequence, seq_file.readline().strip(), barcode, code_file.readline().strip()
+
+
+# Barcode table of the worker processes, set by init_worker
+worker_table = {}
+
+def init_worker(table):
+    """
+    Initializer of the worker processes: receives the barcode table once.
+    """
+    worker_table.update(table)
+
+
+def demultiplex_chunk(pairs, num_parts, barcode_length=16, umi_length=12, min_bc_quality=10, output_format='json'):
+    """
+    Corrects the barcodes of a chunk of read pairs and serializes the kept reads by part.
+
+    Returns:
+    tuple: Dictionary part -> text of the serialized records, and the counts of the chunk.
+    """
+    counts = {'reads': len(pairs), 'too_short': 0, 'low_quality': 0, 'no_match': 0, 'corrected': 0, 'kept': 0}
+    pairs = [pair for pair in pairs if len(pair[2]) >= barcode_length + umi_length and len(pair[3]) >= barcode_length]
+    counts['too_short'] = counts['reads'] - len(pairs)
+    if not pairs:
+        return {}, counts
+
+    # Drop the barcodes with a low quality base before the lookup
+    bc_quality = np.frombuffer(''.join(pair[3][:barcode_length] for pair in pairs).encode('ascii'), dtype=np.uint8)
+    good = (bc_quality.reshape(len(pairs), barcode_length).min(axis=1).astype(np.int64) - 33) >= min_bc_quality
+    counts['low_quality'] = int((~good).sum())
+    pairs = [pair for pair, keep in zip(pairs, good) if keep]
+
+    targets, corrected = correct_barcodes(worker_table, [pair[2][:barcode_length] for pair in pairs])
+    counts['no_match'] = int((targets < 0).sum())
+    counts['corrected'] = int(corrected.sum())
+
+    parts = {}
+    whitelist = worker_table['whitelist']
+    for (sequence, quality, barcode, _), target in zip(pairs, targets.tolist()):
+        if target < 0:
+            continue
+        cell, umi = str(whitelist[target]), barcode[barcode_length:barcode_length + umi_length]
+        record = {"barcode": cell + umi, "cell": cell, "umi": umi, "sequence": sequence, "quality": quality}
+        line = encode_record(record) if output_format == 'packed' else dumps(record)
+        parts.setdefault(crc32(cell.encode('ascii')) % num_parts, []).append(line)
+        counts['kept'] += 1
+    return {part: '\n'.join(lines) + '\n' for part, lines in parts.items()}, counts
+
+
+def demultiplex(sequences_path, barcodes_path, whitelist_path, output_dir, num_parts=8, processes=None, chunk_size=100000,
+                barcode_length=16, umi_length=12, min_bc_quality=10, output_format='json'):
+    """
+    Streams the paired FASTQs in chunks through a pool of worker processes that correct the cell barcodes,
+    and writes the kept reads to output_dir/part-NNNNN files partitioned by cell (all reads of a cell in one part).
+    The parts can be uploaded to HDFS as the sequence dataset of the alignment jobs (see writePartsToHadoop).
+
+    Parameters:
+    sequences_path (str): The R2 FASTQ file with the cDNA reads.
+    barcodes_path (str): The R1 FASTQ file with the cell barcodes and UMIs.
+    whitelist_path (str): The barcode whitelist, one barcode per line.
+    output_dir (str): The directory of the part files.
+    num_parts (int): Number of part files.
+    processes (int): Number of worker processes, default: number of CPUs.
+    chunk_size (int): Number of read pairs per chunk.
+    barcode_length (int): Length of the cell barcode at the start of R1.
+    umi_length (int): Length of the UMI following the cell barcode.
+    min_bc_quality (int): Reads with a cell barcode base below this Phred score are dropped.
+    output_format (str): 'json' (like writeToHadoop, with 'cell' and 'umi' fields) or 'packed' (like writePackedToHadoop).
+
+    Returns:
+    dict: The read counts ('reads', 'too_short', 'low_quality', 'no_match', 'corrected', 'kept') and the reads per part.
+    """
+    table = build_barcode_table(read_whitelist(whitelist_path))
+    os.makedirs(output_dir, exist_ok=True)
+    files = [open(os.path.join(output_dir, 'part-%05d' % part), 'w') for part in range(num_parts)]
+    counts = {'reads': 0, 'too_short': 0, 'low_quality': 0, 'no_match': 0, 'corrected': 0, 'kept': 0}
+    part_reads = [0] * num_parts
+
+    def collect(future):
+        parts, chunk_counts = future.result()
+        for part, text in parts.items():
+            files[part].write(text)
+            part_reads[part] += text.count('\n')
+        for key, value in chunk_counts.items():
+            counts[key] += value
+
+    try:
+        with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(table,)) as pool:
+            # Keep a bounded number of chunks in flight, so the reader never runs far ahead of the workers
+            pending = deque()
+            for chunk in iter_chunks(iter_read_pairs(sequences_path, barcodes_path), chunk_size):
+                pending.append(pool.submit(demultiplex_chunk, chunk, num_parts, barcode_length, umi_length, min_bc_quality, output_format))
+                if len(pending) >= 2 * (processes or os.cpu_count()):
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+    finally:
+        for file in files:
+            file.close()
+    counts['part_reads'] = part_reads
+    return counts
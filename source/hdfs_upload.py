@@ -0,0 +1,200 @@
+import os
+import bz2
+import shutil
+from json import dumps
+from queue import Queue
+from threading import Thread, Event
+from time import time
+
+# Bulk upload of datasets to HDFS and LocalClient, a stand-in of the HDFS client on the local file system.
+# Kept free of pyspark, so the uploads run and are tested without it, benchmark_utils re-exports these functions.
+
+
+def serialize_blocks(records, block_size=1 << 22):
+    """
+    Serializes records to JSON lines and yields them as UTF-8 blocks of about block_size bytes,
+    every block ends with a complete line.
+    """
+    lines, size = [], 0
+    for record in records:
+        line = dumps(record) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= block_size:
+            yield ''.join(lines).encode('utf-8')
+            lines, size = [], 0
+    if lines:
+        yield ''.join(lines).encode('utf-8')
+
+def bulkWriteToHadoop(client, filepath, records, num_parts=4, block_size=1 << 22, compression=None, queue_blocks=4):
+    """
+    Uploads a dataset to the directory filepath in HDFS as num_parts part files written in parallel,
+    so the jobs reading the directory get one split per part (or more, the bz2 codec is splittable).
+
+    A background thread serializes the records to JSON lines in blocks of block_size bytes and deals the blocks
+    round-robin to one writer thread per part file, which compresses and streams them to HDFS. The queues between
+    them hold queue_blocks blocks per part, so records can be a generator (e.g. iter_fasta) larger than the memory.
+    Hadoop streaming and Spark decompress the part files by their '.bz2' extension.
+
+    Parameters:
+    client (hdfs.InsecureClient): The HDFS client (or a LocalClient).
+    filepath (str): The directory in HDFS.
+    records (iterable): The dataset, dictionaries representing cDNAs or sequences.
+    num_parts (int): Number of part files written in parallel.
+    block_size (int): Size of the serialized blocks in bytes (before compression).
+    compression (str): None or 'bz2'.
+    queue_blocks (int): Number of blocks buffered per part file.
+
+    Returns:
+    dict: 'records', 'bytes' (serialized), 'bytes_written' (after compression), 'seconds' and 'bytes_per_s'.
+
+    Raises:
+    ValueError: If the compression codec isn't supported.
+    Exception: The first error of the serializer or a writer, e.g. hdfs.HdfsError.
+    """
+    if compression not in (None, 'bz2'):
+        raise ValueError("Unsupported compression: %s (use None or 'bz2')" % compression)
+    suffix = '.bz2' if compression == 'bz2' else ''
+    queues = [Queue(queue_blocks) for _ in range(num_parts)]
+    stats = {'records': 0, 'bytes': 0, 'bytes_written': [0] * num_parts}
+    errors, failed = [], Event()
+
+    def count(records):
+        for record in records:
+            stats['records'] += 1
+            yield record
+
+    def serialize():
+        try:
+            for k, block in enumerate(serialize_blocks(count(records), block_size)):
+                if failed.is_set():
+                    break
+                stats['bytes'] += len(block)
+                queues[k % num_parts].put(block)
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+        finally:
+            for queue in queues:
+                queue.put(None)
+
+    def write(part):
+        queue, done = queues[part], False
+        try:
+            compressor = bz2.BZ2Compressor() if compression == 'bz2' else None
+            with client.write('%s/part-%05d%s' % (filepath, part, suffix), overwrite=True) as writer:
+                for block in iter(queue.get, None):
+                    data = compressor.compress(block) if compressor else block
+                    writer.write(data)
+                    stats['bytes_written'][part] += len(data)
+                done = True
+                if compressor:
+                    data = compressor.flush()
+                    writer.write(data)
+                    stats['bytes_written'][part] += len(data)
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+            # Drain the queue, so the serializer never blocks on a failed part. Not after the end marker,
+            # e.g. when the flush or the close of the HDFS file fails, the queue stays empty then.
+            while not done and queue.get() is not None:
+                pass
+
+    start = time()
+    threads = [Thread(target=serialize, daemon=True)] + [Thread(target=write, args=(part,), daemon=True) for part in range(num_parts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    seconds = time() - start
+    stats['bytes_written'] = sum(stats['bytes_written'])
+    stats['seconds'] = seconds
+    stats['bytes_per_s'] = stats['bytes'] / seconds if seconds > 0 else None
+    return stats
+
+class LocalClient:
+    """
+    Stand-in for hdfs.InsecureClient on the local file system (the methods used by this module),
+    the HDFS paths are resolved below the root directory. For tests and measurements without a cluster.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def resolve(self, hdfs_path):
+        return os.path.join(self.root, hdfs_path.lstrip('/'))
+
+    def write(self, hdfs_path, data=None, overwrite=False, encoding=None):
+        """
+        Writes data to a file, or returns a writer to use as context manager if data is None.
+        """
+        path = self.resolve(hdfs_path)
+        if os.path.exists(path) and not overwrite:
+            raise FileExistsError(hdfs_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writer = open(path, 'w', encoding=encoding) if encoding else LocalWriter(path)
+        if data is None:
+            return writer
+        with writer:
+            writer.write(data)
+
+    def upload(self, hdfs_path, local_path, overwrite=False):
+        path = self.resolve(hdfs_path)
+        if os.path.exists(path):
+            if not overwrite:
+                raise FileExistsError(hdfs_path)
+            self.delete(hdfs_path, recursive=True)
+        if os.path.isdir(local_path):
+            shutil.copytree(local_path, path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copy(local_path, path)
+        return hdfs_path
+
+    def status(self, hdfs_path, strict=True):
+        path = self.resolve(hdfs_path)
+        if not os.path.exists(path):
+            if strict:
+                raise FileNotFoundError(hdfs_path)
+            return None
+        stat = os.stat(path)
+        return {'length': 0 if os.path.isdir(path) else stat.st_size, 'modificationTime': int(stat.st_mtime * 1000),
+                'type': 'DIRECTORY' if os.path.isdir(path) else 'FILE'}
+
+    def list(self, hdfs_path, status=False):
+        names = sorted(os.listdir(self.resolve(hdfs_path)))
+        if status:
+            return [(name, self.status(hdfs_path.rstrip('/') + '/' + name)) for name in names]
+        return names
+
+    def delete(self, hdfs_path, recursive=False):
+        path = self.resolve(hdfs_path)
+        if not os.path.exists(path):
+            return False
+        if os.path.isdir(path):
+            if recursive:
+                shutil.rmtree(path)
+            else:
+                os.rmdir(path)
+        else:
+            os.remove(path)
+        return True
+
+class LocalWriter:
+    """
+    Binary file writer of LocalClient.write, accepts text (UTF-8 encoded) like the HDFS writer.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+
+    def write(self, data):
+        self.file.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
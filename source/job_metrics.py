@@ -0,0 +1,153 @@
+import os
+import signal
+import sys
+from collections import Counter
+from functools import wraps
+from time import perf_counter
+
+# Hot-path instrumentation of the MapReduce jobs and the Spark functions.
+# The metrics of a task are a plain dict (name -> number) filled by the metered stages: '<stage> ms' times,
+# 'records in', 'pairs aligned', 'pairs pruned' and 'dp cells' (cells of the dynamic programming matrices).
+# The jobs flush them once per task as Hadoop counters (flush_counters), the Spark functions add them to an
+# accumulator of metrics dicts (see benchmark_utils.MetricsParam), so no per-record counter traffic is generated.
+
+
+def merge_metrics(a, b):
+    """
+    Adds the metrics of b to a (in place) and returns a.
+    """
+    for name, value in b.items():
+        a[name] = a.get(name, 0) + value
+    return a
+
+
+def add_metrics(metrics, values):
+    """
+    Adds values to a metrics dict, or to a Spark accumulator of metrics dicts.
+    """
+    if isinstance(metrics, dict):
+        merge_metrics(metrics, values)
+    else:
+        metrics.add(values)
+
+
+def metered(metrics, stage, f, cells=None, pairs=None, counts=None):
+    """
+    Wraps f to add its runtime to the '<stage> ms' metric.
+
+    Parameters:
+    metrics (dict or Accumulator): The metrics of the task.
+    stage (str): Name of the stage, e.g. 'parse', 'align', 'score' or 'traceback'.
+    f (function): The function to time.
+    cells (function): Returns the number of DP cells computed by a call from its arguments, counted with 'pairs aligned'.
+    pairs (function): Returns the number of aligned pairs of a call from its arguments (default 1 if cells is given).
+    counts (dict): Metrics added on every call, e.g. {'records in': 1} for a parser.
+    """
+    @wraps(f)
+    def wrap(*args, **kw):
+        start = perf_counter()
+        result = f(*args, **kw)
+        values = {stage + ' ms': (perf_counter() - start) * 1000, **(counts or {})}
+        if cells is not None:
+            values['pairs aligned'] = pairs(*args) if pairs is not None else 1
+            values['dp cells'] = cells(*args)
+        add_metrics(metrics, values)
+        return result
+    return wrap
+
+
+def full_cells(seq1, seq2, *_):
+    """
+    DP cells of an alignment of seq1 against the whole seq2.
+    """
+    return len(seq1) * len(seq2)
+
+
+def quality_cells(seq1, qual1, seq2, *_):
+    """
+    DP cells of a quality adjusted alignment (full matrix, an upper bound for the seeded modes).
+    """
+    return len(seq1) * len(seq2)
+
+
+def banded_cells(seq1, seq2, substitution_matrix, gap_penalty, diagonal=0, band_width=16):
+    """
+    DP cells of a banded alignment: the cells (i, j) of the band diagonal - band_width <= j - i <= diagonal + band_width,
+    at most len(seq1) * min(len(seq2), 2 * band_width + 1).
+    """
+    low, high = diagonal - band_width, diagonal + band_width
+    return sum(max(0, min(len(seq2), i + high) - max(1, i + low) + 1) for i in range(1, len(seq1) + 1))
+
+
+def batch_cells(queries, seq2, *_):
+    """
+    DP cells of the alignment of a batch of queries against seq2.
+    """
+    return sum(len(query) for query in queries) * len(seq2)
+
+
+def flush_counters(job, group, metrics):
+    """
+    Reports the metrics of a task as Hadoop counters of a group (times in whole milliseconds) and resets them.
+    """
+    for name, value in metrics.items():
+        job.increment_counter(group, name, int(round(value)))
+    metrics.clear()
+
+
+def parse_counters(log):
+    """
+    Parses the counters printed by mrjob at the end of a job (stderr of the runner).
+
+    Returns:
+    dict: group -> {name: value}
+    """
+    counters, group = {}, None
+    for line in log.splitlines():
+        if line.startswith('\t\t') and group is not None and '=' in line:
+            name, value = line.strip().rsplit('=', 1)
+            counters[group][name] = counters[group].get(name, 0) + int(value)
+        elif line.startswith('\t') and line.strip():
+            group = line.strip()
+            counters.setdefault(group, {})
+        elif not line.startswith('\t'):
+            group = None
+    return counters
+
+
+def task_partition():
+    """
+    Partition number of the running Hadoop task, from the job configuration exported by Hadoop streaming.
+    """
+    return int(os.environ.get('mapreduce_task_partition', os.environ.get('mapred_task_partition', 0)))
+
+
+def start_profiler(interval=0.005):
+    """
+    Starts a sampling profiler: every interval seconds of CPU time the Python stack is recorded.
+
+    Returns:
+    Counter: The samples, collapsed stack ("file:function;file:function;...") -> count, filled until stop_profiler.
+    """
+    samples = Counter()
+    def sample(signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append('%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+            frame = frame.f_back
+        samples[';'.join(reversed(stack))] += 1
+    signal.signal(signal.SIGPROF, sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    return samples
+
+
+def stop_profiler(samples, file=None):
+    """
+    Stops the sampling profiler and writes the collapsed stacks (the input format of flamegraph.pl), most frequent first.
+    By default they are written to stderr, which ends up in the task log of a Hadoop task.
+    """
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    signal.signal(signal.SIGPROF, signal.SIG_DFL)
+    file = file or sys.stderr
+    for stack, count in samples.most_common():
+        file.write('%s %d\n' % (stack, count))
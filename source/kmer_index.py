@@ -0,0 +1,174 @@
+import numpy as np
+from io import BytesIO
+from seq_utils import kmer_codes
+from reducer_utils import top_hits
+
+
+def build_kmer_index(cdnas, k=11):
+    """
+    Builds a k-mer index from the output of read_fasta (or the JSON lines written by writeToHadoop).
+    The windows of a long transcript (see seq_utils.split_windows) are indexed as the transcript, at their positions in it,
+    so the diagonals of find_candidates are relative to the transcript start whether it was split or not.
+
+    Parameters:
+    cdnas (iterable): Dictionaries with 'transcript_id' and 'sequence' keys.
+    k (int): The k-mer length, at most 31.
+
+    Returns:
+    dict: 'k', 'transcript_ids' and the arrays 'kmers', 'transcripts', 'positions' sorted by k-mer code.
+    """
+    numbers, kmers, transcripts, positions = {}, [], [], []
+    for cdna in cdnas:
+        codes = kmer_codes(cdna['sequence'], k)
+        valid = np.flatnonzero(codes >= 0)
+        kmers.append(codes[valid])
+        positions.append((valid + cdna.get('window', 0)).astype(np.int32))
+        transcripts.append(np.full(len(valid), numbers.setdefault(cdna['transcript_id'], len(numbers)), dtype=np.int32))
+
+    kmers = np.concatenate(kmers) if kmers else np.empty(0, dtype=np.int64)
+    transcripts = np.concatenate(transcripts) if transcripts else np.empty(0, dtype=np.int32)
+    positions = np.concatenate(positions) if positions else np.empty(0, dtype=np.int32)
+    order = np.lexsort((positions, transcripts, kmers))
+    kmers, transcripts, positions = kmers[order], transcripts[order], positions[order]
+    # The overlap of two windows would be indexed twice
+    unique = np.ones(len(kmers), dtype=bool)
+    unique[1:] = (kmers[1:] != kmers[:-1]) | (transcripts[1:] != transcripts[:-1]) | (positions[1:] != positions[:-1])
+    return {
+        'k': k,
+        'transcript_ids': np.array(list(numbers), dtype=str),
+        'kmers': kmers[unique],
+        'transcripts': transcripts[unique],
+        'positions': positions[unique],
+    }
+
+
+def save_kmer_index(index, filepath):
+    """
+    Saves a k-mer index as a NumPy .npz file, filepath may also be a writable file object.
+    """
+    np.savez(filepath, **index)
+
+
+def load_kmer_index(filepath):
+    """
+    Loads a k-mer index saved by save_kmer_index.
+    """
+    with np.load(filepath) as data:
+        index = {key: data[key] for key in data.files}
+    index['k'] = int(index['k'])
+    return index
+
+
+def dump_kmer_index(index):
+    """
+    Serializes a k-mer index to bytes, e.g. to write it to HDFS with client.write(filepath, data=...).
+    """
+    buffer = BytesIO()
+    save_kmer_index(index, buffer)
+    return buffer.getvalue()
+
+
+def find_candidates(index, query, min_seeds=1):
+    """
+    Looks up the k-mers of a query in the index.
+
+    Parameters:
+    index (dict): The k-mer index from build_kmer_index or load_kmer_index.
+    query (str): The query sequence.
+    min_seeds (int): Minimum number of shared k-mers for a transcript to become a candidate.
+
+    Returns:
+    dict: transcript_id -> sorted list of diagonals (transcript position - query position) of the shared k-mers.
+    """
+    query_kmers = kmer_codes(query, index['k'])
+    query_positions = np.flatnonzero(query_kmers >= 0)
+    query_kmers = query_kmers[query_positions]
+    # All index entries of a k-mer are one contiguous run of the sorted array
+    starts = np.searchsorted(index['kmers'], query_kmers, side='left')
+    ends = np.searchsorted(index['kmers'], query_kmers, side='right')
+
+    seeds = {}
+    for query_pos, start, end in zip(query_positions, starts, ends):
+        for transcript, pos in zip(index['transcripts'][start:end], index['positions'][start:end]):
+            seeds.setdefault(int(transcript), []).append(int(pos) - int(query_pos))
+
+    return {str(index['transcript_ids'][transcript]): sorted(set(diagonals))
+            for transcript, diagonals in seeds.items() if len(diagonals) >= min_seeds}
+
+
+def seed_band(diagonals, band_width, window=0):
+    """
+    Returns the (diagonal, band_width) pair of a band that covers all seed diagonals plus band_width on each side.
+    The diagonals are relative to the transcript start (see build_kmer_index), for a window of the transcript
+    starting at window (see seq_utils.split_windows) the band is shifted into it.
+    """
+    low, high = min(diagonals), max(diagonals)
+    return (low + high) // 2 - window, (high - low + 1) // 2 + band_width
+
+
+def seeded_alignment(query_sequence, sequence, diagonals, band_width, window, substitution_matrix, gap_penalty, banded_smith_waterman, smith_waterman):
+    """
+    Aligns the query against a candidate transcript in the band of seed_band with banded_smith_waterman, or in full with
+    smith_waterman if the band is as wide as the transcript: a repeated k-mer of the query (e.g. a poly-A stretch) spreads
+    the seed diagonals, and the band would then cost more than the full matrix. Pass an engine supporting the gap penalty,
+    e.g. seq_utils.smith_waterman_vectorized, whose affine gaps the banded engine supports as well.
+    Returns the (score, align1, align2) of the engines.
+    """
+    diagonal, width = seed_band(diagonals, band_width, window)
+    if 2 * width + 1 >= len(sequence):
+        return smith_waterman(query_sequence, sequence, substitution_matrix, gap_penalty)
+    return banded_smith_waterman(query_sequence, sequence, substitution_matrix, gap_penalty, diagonal, width)
+
+
+def pseudoalign(index, read):
+    """
+    Pseudoaligns a read: intersects the sets of transcripts containing each of its k-mers.
+    k-mers missing from the index (e.g. with a sequencing error) are skipped, like k-mers with an 'N'.
+
+    Returns:
+    tuple: The compatible transcripts (sorted indices into index['transcript_ids'], empty if the sets don't intersect
+           or no k-mer was found) and the number of distinct k-mers of the read found in the index.
+    """
+    read_kmers = np.unique(kmer_codes(read, index['k']))
+    read_kmers = read_kmers[read_kmers >= 0]
+    starts = np.searchsorted(index['kmers'], read_kmers, side='left')
+    ends = np.searchsorted(index['kmers'], read_kmers, side='right')
+    found = np.flatnonzero(ends > starts)
+    if not len(found):
+        return np.empty(0, dtype=np.int32), 0
+    # Start with the rarest k-mer, the intersection only shrinks
+    found = found[np.argsort(ends[found] - starts[found], kind='stable')]
+    compatible = np.unique(index['transcripts'][starts[found[0]]:ends[found[0]]])
+    for start, end in zip(starts[found[1:]], ends[found[1:]]):
+        compatible = np.intersect1d(compatible, index['transcripts'][start:end])
+        if not len(compatible):
+            break
+    return compatible, len(found)
+
+
+def pseudoalign_hits(index, sequences, read, quality, engine, substitution_matrix, gap_penalty, k=1, ties='all'):
+    """
+    Assigns a read to its top-k transcripts by pseudoalignment.
+    Only an ambiguous read, with more than k compatible transcripts, is aligned with the quality adjusted engine,
+    and only against its compatible transcripts.
+
+    Parameters:
+    index (dict): The k-mer index of the cDNAs.
+    sequences (dict): transcript_id -> sequence of the cDNAs.
+    read, quality (str): The read and its quality string.
+    engine (function): A quality adjusted Smith-Waterman function (see quality_alignment_engine), 'full' mode.
+    k (int), ties (str): Top-k and tie policy of the ambiguous reads (see reducer_utils).
+
+    Returns:
+    tuple: The (transcript_id, support) hits, support being the number of read k-mers found in the index,
+           and the status 'unassigned', 'assigned' (at most k compatible transcripts) or 'ambiguous'.
+    """
+    compatible, support = pseudoalign(index, read)
+    transcript_ids = [str(index['transcript_ids'][t]) for t in compatible]
+    if not transcript_ids:
+        return [], 'unassigned'
+    if len(transcript_ids) <= k:
+        return [(transcript_id, support) for transcript_id in transcript_ids], 'assigned'
+    alignments = ((transcript_id, engine(read, quality, sequences[transcript_id], substitution_matrix, gap_penalty)) for transcript_id in transcript_ids)
+    best = top_hits(((transcript_id, alignment[0]) for transcript_id, alignment in alignments), k, ties)
+    return [(transcript_id, support) for transcript_id, _ in best], 'ambiguous'
@@ -0,0 +1,189 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial, reduce
+from multiprocessing import shared_memory
+from os import cpu_count
+from time import time
+import numpy as np
+from seq_utils import ScoringScheme, alignment_engines, smith_waterman_score, quality_adjusted_smith_waterman_score, encode_sequence, decode_sequence
+from reference_cache import open_reference_cache, cached_sequence
+from reducer_utils import merge_hit, merge_hits, top_hits
+
+# Local backend: BLASTN and sequence alignment with a pool of worker processes on one machine, without Hadoop or Spark.
+# The reference is encoded once into a shared memory buffer (or memory-mapped from a reference cache) that every worker
+# reads in place. Kept free of pyspark, so blastn_server runs without it, benchmark_utils re-exports these functions.
+
+
+def scoring_scheme(scoring):
+    """
+    Returns the substitution table and gap penalty passed to the alignment engines, of the default scheme if scoring is None.
+    """
+    scoring = scoring or ScoringScheme()
+    return scoring.substitution_matrix, scoring.gap_penalty
+
+def share_sequences(sequences):
+    """
+    Encodes sequences into one flat uint8 shared memory buffer.
+
+    Parameters:
+    sequences (list): The DNA sequence strings.
+
+    Returns:
+    tuple: The SharedMemory block and the offsets array (sequence k is buffer[offsets[k]:offsets[k+1]]).
+    """
+    codes = [encode_sequence(seq) for seq in sequences]
+    offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in codes])
+    shm = shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+    buffer = np.ndarray(int(offsets[-1]), dtype=np.uint8, buffer=shm.buf)
+    for c, start in zip(codes, offsets):
+        buffer[start:start + len(c)] = c
+    del buffer  # Release the view, otherwise the block can't be closed
+    return shm, offsets
+
+# Reference attached by each worker process of the local backend
+shared_reference = {}
+
+def attach_reference(name, offsets, transcript_ids):
+    """
+    Initializer of the worker processes: attaches the shared reference buffer without copying it.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    shared_reference['shm'] = shm  # Keep the block open as long as the worker lives
+    shared_reference['codes'] = np.ndarray(int(offsets[-1]), dtype=np.uint8, buffer=shm.buf)
+    shared_reference['offsets'] = offsets
+    shared_reference['transcript_ids'] = transcript_ids
+
+def attach_reference_cache(filepath):
+    """
+    Initializer of the worker processes: memory-maps a reference cache (see reference_cache), the pages are
+    shared by all workers through the page cache.
+    """
+    cache = open_reference_cache(filepath)
+    shared_reference['codes'] = cache['codes']
+    shared_reference['offsets'] = cache['offsets']
+    shared_reference['transcript_ids'] = cache['transcript_ids']
+
+def reference_sequence(k):
+    """
+    Returns the encoded k-th reference sequence as a view into the shared buffer.
+    """
+    offsets = shared_reference['offsets']
+    return shared_reference['codes'][offsets[k]:offsets[k + 1]]
+
+def blastn_local_shard(query_sequence, start, end, scoring=None, top_k=1, ties='all'):
+    """
+    Scores the query against the reference sequences start to end-1 and keeps the top-k ones, one per transcript.
+    The hits carry the reference index instead of the alignment, the traceback is done afterwards.
+    """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    transcript_ids = shared_reference['transcript_ids']
+    hits = ((transcript_ids[k], smith_waterman_score(query_sequence, reference_sequence(k), substitution_matrix, gap_penalty), k) for k in range(start, end))
+    return top_hits(hits, top_k, ties, unique=True)
+
+def align_local_shard(sequences, scoring=None, top_k=1, ties='all'):
+    """
+    Aligns sequences against all reference cDNAs and keeps the top-k (transcript_id, score) of each sequence.
+    """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    transcript_ids = shared_reference['transcript_ids']
+    out = []
+    for seq in sequences:
+        alignments = ((transcript_ids[k], quality_adjusted_smith_waterman_score(seq['sequence'], seq['quality'], reference_sequence(k), substitution_matrix, gap_penalty)) for k in range(len(transcript_ids)))
+        out.extend((seq['barcode'], alignment) for alignment in top_hits(alignments, top_k, ties, unique=True))
+    return out
+
+@contextmanager
+def local_reference(cdnas):
+    """
+    Prepares the reference of the local backend: a path is opened as a reference cache that the workers memory-map,
+    a list of cDNA records is encoded into a shared memory block that is released at exit.
+    Yields the worker initializer and its arguments, the transcript IDs and a function returning the k-th sequence.
+    """
+    if isinstance(cdnas, str):
+        cache = open_reference_cache(cdnas)
+        yield attach_reference_cache, (cdnas,), cache['transcript_ids'], lambda k: decode_sequence(cached_sequence(cache, k))
+        return
+    shm, offsets = share_sequences([cdna['sequence'] for cdna in cdnas])
+    try:
+        transcript_ids = [cdna['transcript_id'] for cdna in cdnas]
+        yield attach_reference, (shm.name, offsets, transcript_ids), transcript_ids, lambda k: cdnas[k]['sequence']
+    finally:
+        shm.close()
+        shm.unlink()
+
+def shard_bounds(n, shards):
+    """
+    Splits range(n) into at most `shards` contiguous (start, end) pairs of nearly equal size.
+    """
+    shards = max(1, min(shards, n))
+    bounds = np.linspace(0, n, shards + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def blastn_local(query_sequence, cdnas, processes=None, engine='vectorized', top_k=1, ties='all', scoring=None):
+    """
+    Executes the BLASTN algorithm on the local machine with a pool of worker processes, without Hadoop or Spark.
+    The cDNAs are encoded once into a shared memory buffer (or memory-mapped from a reference cache) that all workers read in place.
+
+    Parameters:
+    query_sequence (str): The DNA sequence to be used as the query for the alignment.
+    cdnas (list or str): The cDNAs, dictionaries with 'transcript_id' and 'sequence' keys,
+                         or the path of a reference cache (see reference_cache) to skip parsing and encoding.
+    processes (int): Number of worker processes, default: number of CPUs.
+    engine (str): The Smith-Waterman implementation used for the traceback of the best hits, 'scalar' or 'vectorized'.
+    top_k (int): Number of best hits to output.
+    ties (str): 'all' keeps every hit tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
+
+    Returns:
+    tuple: Execution time and the alignment output.
+    """
+    substitution_matrix, gap_penalty = scoring_scheme(scoring)
+    smith_waterman = alignment_engines[engine]
+    ts = time() # Start timing the operation
+    with local_reference(cdnas) as (initializer, initargs, transcript_ids, sequence):
+        with ProcessPoolExecutor(processes, initializer=initializer, initargs=initargs) as pool:
+            # More shards than workers so that long transcripts don't leave workers idle
+            bounds = shard_bounds(len(transcript_ids), 4 * (processes or cpu_count()))
+            shards = pool.map(blastn_local_shard, [query_sequence] * len(bounds), *zip(*bounds), [scoring] * len(bounds), [top_k] * len(bounds), [ties] * len(bounds))
+            best = reduce(partial(merge_hits, k=top_k, ties=ties, unique=True), shards, [])
+        # Align only the surviving hits
+        out = [(hit[0], *smith_waterman(query_sequence, sequence(hit[2]), substitution_matrix, gap_penalty)) for hit in best]
+    te = time() # End timing the operation
+    return te-ts, out # Return the execution time and results
+
+
+def align_local(cdnas, sequences, processes=None, top_k=1, ties='all', scoring=None):
+    """
+    Executes the sequence alignment on the local machine with a pool of worker processes, without Hadoop or Spark.
+    The cDNAs are encoded once into a shared memory buffer, the sequences are sharded across the workers.
+
+    Parameters:
+    cdnas (list or str): The cDNAs, dictionaries with 'transcript_id' and 'sequence' keys,
+                         or the path of a reference cache (see reference_cache) to skip parsing and encoding.
+    sequences (list): The sequences, dictionaries with 'barcode', 'sequence' and 'quality' keys.
+    processes (int): Number of worker processes, default: number of CPUs.
+    top_k (int): Number of best transcripts counted per sequence.
+    ties (str): 'all' keeps every transcript tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    scoring (ScoringScheme): Substitution scores and linear or affine gap penalties (see seq_utils.ScoringScheme), by default the linear scheme of seq_utils.
+
+    Returns:
+    tuple: Execution time and the alignment output.
+    """
+    ts = time() # Start timing the operation
+    with local_reference(cdnas) as (initializer, initargs, transcript_ids, sequence):
+        with ProcessPoolExecutor(processes, initializer=initializer, initargs=initargs) as pool:
+            bounds = shard_bounds(len(sequences), 4 * (processes or cpu_count()))
+            shards = pool.map(align_local_shard, [sequences[start:end] for start, end in bounds], [scoring] * len(bounds), [top_k] * len(bounds), [ties] * len(bounds))
+            # Keep the best alignments of each barcode, like combineByKey in align_pyspark
+            best = {}
+            for barcode, alignment in (pair for shard in shards for pair in shard):
+                best[barcode] = merge_hit(best.get(barcode, []), alignment, top_k, ties)
+    # Count the barcodes per transcript
+    counts = {}
+    for alignments in best.values():
+        for alignment in alignments:
+            counts[alignment[0]] = counts.get(alignment[0], 0) + 1
+    te = time() # End timing the operation
+    return te-ts, list(counts.items()) # Return the execution time and results
@@ -0,0 +1,81 @@
+from functools import partial, reduce
+
+# Bounded top-k of hits shared by the combiners and reducers of the jobs.
+# A hit is a tuple (id, score, ...), any further fields are carried along untouched.
+# The top-k is a plain list sorted by decreasing score and then by id, so it stays picklable for Spark
+# and JSON serializable for the mrjob protocols.
+# Tie policies at the k-th score:
+#   'all'        keeps every hit tying with the k-th hit (k=1 keeps all the best hits, like the former mergeValue)
+#   'lowest_id'  keeps exactly k hits, ties are broken by the lowest id
+# With unique=True a top-k holds at most one hit per id, the best one. This merges the hits of the windows
+# of a long transcript (see seq_utils.split_windows) back into one hit per transcript.
+
+TIE_POLICIES = ('all', 'lowest_id')
+
+
+def hit_key(hit):
+    """
+    Sort key of a hit: best score first, then lowest id.
+    """
+    return -hit[1], hit[0]
+
+
+def truncate_hits(top, k=1, ties='all'):
+    """
+    Cuts a sorted list of hits down to the top k according to the tie policy.
+    """
+    if len(top) > k:
+        end = k
+        if ties == 'all':
+            while end < len(top) and top[end][1] == top[k - 1][1]:
+                end += 1
+        del top[end:]
+    return top
+
+
+def unique_hits(top):
+    """
+    Keeps the first (best) hit of every id of a sorted list of hits.
+    """
+    seen = set()
+    return [hit for hit in top if not (hit[0] in seen or seen.add(hit[0]))]
+
+
+def merge_hit(top, hit, k=1, ties='all', unique=False):
+    """
+    Adds a hit to a top-k list (mergeValue of combineByKey / aggregate).
+    """
+    if unique:
+        for i, other in enumerate(top):
+            if other[0] == hit[0]:
+                if hit_key(hit) >= hit_key(other):
+                    return top  # The id already has a hit at least as good
+                del top[i]
+                break
+    if len(top) >= k and hit_key(hit) > hit_key(top[-1]) and (ties != 'all' or hit[1] < top[-1][1]):
+        return top  # Can't enter the top-k
+    top.append(hit)
+    top.sort(key=hit_key)
+    return truncate_hits(top, k, ties)
+
+
+def merge_hits(a, b, k=1, ties='all', unique=False):
+    """
+    Merges two top-k lists (mergeCombiners of combineByKey / aggregate).
+    """
+    top = sorted(a + b, key=hit_key)
+    return truncate_hits(unique_hits(top) if unique else top, k, ties)
+
+
+def top_hits(hits, k=1, ties='all', unique=False):
+    """
+    Returns the top-k list of an iterable of hits.
+    """
+    return reduce(partial(merge_hit, k=k, ties=ties, unique=unique), hits, [])
+
+
+def first_hit(hit):
+    """
+    Starts a top-k list with one hit (createCombiner of combineByKey).
+    """
+    return [hit]
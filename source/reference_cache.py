@@ -0,0 +1,121 @@
+import os
+import numpy as np
+from json import dumps, loads
+from seq_utils import encode_sequence, iter_fasta
+
+# Pre-encoded reference (cDNA) cache, one file that every backend can memory-map without parsing or encoding:
+#   magic (8 bytes) | header length (8 bytes, little endian) | JSON header | offsets (int64) | codes (uint8)
+# The header holds the transcript IDs and the size and modification time of the source file the cache was built from,
+# the codes of the transcript k are codes[offsets[k]:offsets[k+1]] (ALPHABET indices like encode_sequence).
+
+MAGIC = b'REFCACH1'
+
+
+def source_stamp(source):
+    """
+    Size and modification time of the source file, a cache built from another version of the file is stale.
+    """
+    stat = os.stat(source)
+    return {'source': os.path.abspath(source), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def build_reference_cache(cdnas, filepath, source=None):
+    """
+    Writes a reference cache from cDNA records.
+
+    Parameters:
+    cdnas (iterable): Dictionaries with 'transcript_id' and 'sequence' keys, e.g. from read_fasta.
+    filepath (str): Path of the cache file.
+    source (str): The file the records were read from, recorded to detect when the cache gets stale.
+    """
+    transcript_ids, codes = [], []
+    for cdna in cdnas:
+        transcript_ids.append(cdna['transcript_id'])
+        codes.append(encode_sequence(cdna['sequence']))
+    offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in codes])
+    header = dumps({**(source_stamp(source) if source else {}), 'transcript_ids': transcript_ids}).encode('utf_8')
+    header += b' ' * (-len(header) % 8)  # Keep the offsets 8-byte aligned
+
+    # Write to a temporary file first, so a concurrent reader never sees a half written cache
+    with open(filepath + '.tmp', 'wb') as file:
+        file.write(MAGIC)
+        file.write(len(header).to_bytes(8, 'little'))
+        file.write(header)
+        file.write(offsets.tobytes())
+        for c in codes:
+            file.write(c.tobytes())
+        if not offsets[-1]:
+            file.write(b'\0')  # An empty reference still needs one byte to map
+    os.replace(filepath + '.tmp', filepath)
+
+
+def open_reference_cache(filepath):
+    """
+    Memory-maps a reference cache, the sequences are read from the page cache on access and shared by all processes.
+
+    Returns:
+    dict: 'transcript_ids', 'index' (transcript_id -> k), 'offsets', 'codes' and the source stamp in 'source'.
+    """
+    with open(filepath, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a reference cache" % filepath)
+        header_length = int.from_bytes(file.read(8), 'little')
+        header = loads(file.read(header_length))
+    transcript_ids = header.pop('transcript_ids')
+    start = len(MAGIC) + 8 + header_length
+    offsets = np.memmap(filepath, dtype=np.int64, mode='r', offset=start, shape=(len(transcript_ids) + 1,))
+    codes = np.memmap(filepath, dtype=np.uint8, mode='r', offset=start + offsets.nbytes, shape=(max(int(offsets[-1]), 1),))
+    return {
+        'transcript_ids': transcript_ids,
+        'index': {transcript_id: k for k, transcript_id in enumerate(transcript_ids)},
+        'offsets': offsets,
+        'codes': codes,
+        'source': header,
+    }
+
+
+def cached_sequence(cache, k):
+    """
+    Returns the encoded k-th sequence of a reference cache as a view into the memory map.
+    """
+    offsets = cache['offsets']
+    return cache['codes'][offsets[k]:offsets[k + 1]]
+
+
+def cached_records(cache, start=0, end=None):
+    """
+    Yields the cDNA records start to end-1 of a reference cache like read_fasta, without attributes
+    and with the encoded sequence (a view into the memory map) instead of the string.
+    """
+    end = len(cache['transcript_ids']) if end is None else end
+    for k in range(start, end):
+        yield {"transcript_id": cache['transcript_ids'][k], "sequence": cached_sequence(cache, k)}
+
+
+def cache_is_valid(filepath, source):
+    """
+    True if the cache file exists and was built from the current version of the source file.
+    """
+    if not os.path.exists(filepath):
+        return False
+    try:
+        with open(filepath, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                return False
+            header = loads(file.read(int.from_bytes(file.read(8), 'little')))
+    except ValueError:
+        return False
+    stamp = source_stamp(source)
+    return all(header.get(key) == value for key, value in stamp.items())
+
+
+def reference_cache(fasta_path, filepath=None):
+    """
+    Opens the reference cache of a cDNA FASTA file, (re)building it first if it is missing or stale.
+    By default the cache is stored next to the FASTA file as <fasta_path>.refcache.
+    """
+    filepath = filepath or fasta_path + '.refcache'
+    if not cache_is_valid(filepath, fasta_path):
+        build_reference_cache(iter_fasta(fasta_path), filepath, source=fasta_path)
+    return open_reference_cache(filepath)
@@ -0,0 +1,112 @@
+import os
+from functools import reduce
+from hashlib import sha256
+from json import dumps, loads
+from time import time
+from reducer_utils import hit_key, merge_hits
+
+# Result store of incremental BLASTN searches over datasets that grow by appended part files.
+# The top-k hits of a search are stored per dataset part, in one JSON file per search under the store directory:
+#   {"search": {...parameters...}, "parts": {part path: {"stamp": {"length": ..., "modificationTime": ...}, "hits": [...]}}}
+# A search is identified by the hash of the dataset path, the query, the scoring scheme and every parameter that changes
+# its hits (search_key), a part by its HDFS path and its length and modification time, so only new or rewritten parts are
+# searched again. The per-part top-k lists are merged like the combiners of the jobs (reducer_utils.merge_hits),
+# which is exact: every hit of the overall top-k is among the top-k of its own part.
+
+
+def search_key(query_sequence, scoring=None, **params):
+    """
+    Returns the identifying parameters of a search and their hash.
+
+    Parameters:
+    query_sequence (str): The query.
+    scoring (ScoringScheme): The scoring scheme, None for the default one of seq_utils.
+    params: Every other parameter changing the hits, e.g. the dataset path, top_k, ties, engine or kmer_index.
+    """
+    search = {
+        'query': query_sequence,
+        'scoring': None if scoring is None else {'substitution_matrix': scoring.substitution_matrix.tolist(), 'gap_penalty': scoring.gap_penalty},
+        **params,
+    }
+    return search, sha256(dumps(search, sort_keys=True).encode('utf_8')).hexdigest()
+
+
+def dataset_parts(client, filepath):
+    """
+    Lists the parts of a dataset in HDFS with their stamps: the file itself, or the files of a directory of part files
+    (hidden files like _SUCCESS are skipped).
+
+    Returns:
+    dict: part path -> {'length', 'modificationTime'}
+    """
+    def stamp(status):
+        return {'length': status['length'], 'modificationTime': status['modificationTime']}
+    status = client.status(filepath)
+    if status['type'] != 'DIRECTORY':
+        return {filepath: stamp(status)}
+    return {'%s/%s' % (filepath.rstrip('/'), name): stamp(status) for name, status in client.list(filepath, status=True)
+            if status['type'] == 'FILE' and not name.startswith(('_', '.'))}
+
+
+def load_results(store_dir, key):
+    """
+    Loads the stored parts of a search, an empty dict if the search has never run.
+    """
+    path = os.path.join(store_dir, key + '.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return loads(file.read())['parts']
+
+
+def save_results(store_dir, key, search, parts):
+    """
+    Stores the parts of a search, written to a temporary file first so an interrupted run never leaves a broken store.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, key + '.json')
+    with open(path + '.tmp', 'w') as file:
+        file.write(dumps({'search': search, 'parts': parts}))
+    os.replace(path + '.tmp', path)
+
+
+def incremental_blastn(blastn, client, filepath, store_dir, query_sequence, top_k=1, ties='all', scoring=None, **kw):
+    """
+    Runs a BLASTN search only on the parts of a dataset that are new or changed since the last run of the same search,
+    and merges their top-k hits with the stored hits of the unchanged parts.
+
+    Parameters:
+    blastn (function): benchmark_utils.blastn_pyspark or blastn_hadoop, called once per new or changed part.
+                       Pass spark=... to reuse one Spark session for all parts.
+    client (hdfs.InsecureClient): The HDFS client (or hdfs_upload.LocalClient).
+    filepath (str): The HDFS path of the dataset, a file or a directory of part files (e.g. writeToHadoop with num_parts).
+    store_dir (str): Local directory of the result store.
+    query_sequence (str): The DNA sequence to be used as the query for the alignment.
+    top_k (int): Number of best hits to output.
+    ties (str): 'all' keeps every hit tying with the k-th best, 'lowest_id' breaks the ties by the lowest transcript ID.
+    scoring (ScoringScheme): The scoring scheme (see seq_utils.ScoringScheme).
+    kw: Further parameters of blastn, part of the search key except the ones that don't change the hits (spark, master,
+        num_partitions, num_shards, metrics, profile_task).
+
+    Returns:
+    tuple: Execution time and the alignment output, the number of searched parts is printed.
+    """
+    runtime_only = ('spark', 'master', 'num_partitions', 'num_shards', 'metrics', 'profile_task')
+    search, key = search_key(query_sequence, scoring, dataset=filepath.rstrip('/'), top_k=top_k, ties=ties, **{name: value for name, value in kw.items() if name not in runtime_only})
+    ts = time() # Start timing the operation
+    parts = dataset_parts(client, filepath)
+    stored = load_results(store_dir, key)
+    # Parts removed from the dataset are dropped, new or rewritten parts are searched
+    results = {path: stored[path] for path in parts if path in stored and stored[path]['stamp'] == parts[path]}
+    changed = sorted(path for path in parts if path not in results)
+    for path in changed:
+        _, hits = blastn(query_sequence, path, top_k=top_k, ties=ties, scoring=scoring, **kw)
+        results[path] = {'stamp': parts[path], 'hits': [list(hit) for hit in hits]}
+    if changed or len(results) != len(stored):
+        save_results(store_dir, key, search, results)
+    # The windows of a transcript may have hits in several parts, so the merge keeps one hit per transcript
+    out = reduce(lambda a, b: merge_hits(a, b, top_k, ties, unique=True), ([tuple(hit) for hit in result['hits']] for result in results.values()), [])
+    out.sort(key=hit_key)
+    te = time() # End timing the operation
+    print("Searched parts: %d of %d" % (len(changed), len(parts)))
+    return te-ts, out
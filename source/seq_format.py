@@ -0,0 +1,114 @@
+import numpy as np
+from base64 import b64encode, b64decode
+from json import dumps, loads
+from seq_utils import ALPHABET, encode_sequence
+
+# Compact line format for the sequence datasets in HDFS.
+# Each record is one tab separated line, so Hadoop streaming and sc.textFile can still split the files:
+#   C <TAB> transcript_id <TAB> length <TAB> 2-bit packed sequence (base64) <TAB> N-mask
+#   R <TAB> barcode <TAB> length <TAB> 2-bit packed sequence (base64) <TAB> N-mask <TAB> quality
+# The N-mask lists the runs of 'N' (any non ACGT base) as start:length pairs, the quality string is stored as is.
+# The header attributes are not part of the records, they are written to a separate file (see encode_attributes).
+
+bases = np.frombuffer(ALPHABET.encode('ascii'), dtype=np.uint8)
+
+
+def pack_sequence(seq):
+    """
+    Packs a DNA sequence into 2 bits per base.
+    Returns the packed bytes and the N-mask as a list of (start, length) runs.
+    """
+    codes = encode_sequence(seq)
+    is_n = codes > 3
+    # Pad to a multiple of 4 bases, N's are packed as 'A' and restored from the mask
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[:len(codes)] = np.where(is_n, 0, codes)
+    packed = (padded[0::4] << 6) | (padded[1::4] << 4) | (padded[2::4] << 2) | padded[3::4]
+
+    edges = np.diff(np.concatenate(([0], is_n.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return packed.tobytes(), list(zip(starts.tolist(), (ends - starts).tolist()))
+
+
+def unpack_sequence(packed, length, nmask=()):
+    """
+    Restores a DNA sequence string from its 2-bit packed bytes, length and N-mask.
+    """
+    packed = np.frombuffer(packed, dtype=np.uint8)
+    codes = np.empty(len(packed) * 4, dtype=np.uint8)
+    for offset, shift in enumerate((6, 4, 2, 0)):
+        codes[offset::4] = (packed >> shift) & 3
+    codes = codes[:length]
+    for start, run in nmask:
+        codes[start:start + run] = ALPHABET.index('N')
+    return bases[codes].tobytes().decode('ascii')
+
+
+def encode_record(record):
+    """
+    Encodes a cDNA (read_fasta) or sequence (read_fastq_barcode) record as one line of the packed format.
+    """
+    packed, nmask = pack_sequence(record['sequence'])
+    fields = [str(len(record['sequence'])),
+              b64encode(packed).decode('ascii'),
+              ','.join('%d:%d' % run for run in nmask)]
+    if 'barcode' in record:
+        return '\t'.join(['R', record['barcode'], *fields, record['quality']])
+    return '\t'.join(['C', record['transcript_id'], *fields])
+
+
+def decode_record(line):
+    """
+    Decodes one line of the packed format into a record with the fields the alignment jobs use:
+    'transcript_id' and 'sequence' for cDNAs, 'barcode', 'sequence' and 'quality' for sequences.
+    """
+    fields = line.rstrip('\n').split('\t')
+    nmask = [tuple(map(int, run.split(':'))) for run in fields[4].split(',')] if fields[4] else []
+    sequence = unpack_sequence(b64decode(fields[3]), int(fields[2]), nmask)
+    if fields[0] == 'R':
+        return {"barcode": fields[1], "sequence": sequence, "quality": fields[5]}
+    return {"transcript_id": fields[1], "sequence": sequence}
+
+
+def encode_attributes(records):
+    """
+    Dictionary-encodes the header attributes of the records.
+    Yields the lines of the attributes file: first a JSON object with the distinct values of every attribute,
+    then one JSON line per record with its ID and the index of each of its values (-1 if missing).
+    """
+    records = list(records)
+    keys = sorted({key for record in records for key in record.get('attributes', {})})
+    dictionary = {key: {} for key in keys}
+    rows = []
+    for record in records:
+        attributes = record.get('attributes', {})
+        rows.append([record.get('transcript_id', record.get('barcode')),
+                     [dictionary[key].setdefault(attributes[key], len(dictionary[key])) if key in attributes else -1 for key in keys]])
+    yield dumps({key: list(values) for key, values in dictionary.items()})
+    for row in rows:
+        yield dumps(row)
+
+
+def decode_attributes(lines):
+    """
+    Decodes the lines of an attributes file into a dictionary ID -> attributes.
+    """
+    lines = iter(lines)
+    dictionary = loads(next(lines))
+    keys = sorted(dictionary)
+    attributes = {}
+    for line in lines:
+        record_id, indices = loads(line)
+        attributes[record_id] = {key: dictionary[key][index] for key, index in zip(keys, indices) if index >= 0}
+    return attributes
+
+
+class PackedProtocol(object):
+    """
+    mrjob input protocol for the packed format, yields (None, record).
+    """
+    def read(self, line):
+        return None, decode_record(line.decode('utf_8'))
+
+    def write(self, key, value):
+        return encode_record(value).encode('utf_8')
@@ -1,6 +1,8 @@
 import re
+import gzip
 import numpy as np
-from functools import wraps
+from functools import wraps, partial
+from heapq import heappush, heapreplace
 from time import time
 
 
@@ -28,35 +30,47 @@ def parse_fasta_header(header):
     
     return attributes
     
-def read_fasta(filepath):
+def open_text(filepath):
     """
-    Reads a FASTA file and returns a dictionary of sequences with their attributes.
+    Opens a text file for reading, transparently decompressing gzip files (e.g. the Ensembl .fa.gz).
     """
-    with open(filepath, 'r') as file:
-        sequences = []
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rt')
+    return open(filepath, 'r')
+
+def fasta_record(header, lines):
+    """
+    Builds the record of one FASTA entry from its header line and the list of its sequence lines.
+    """
+    temp = parse_fasta_header(header)
+    return {"transcript_id":temp['transcript_id'],
+            "attributes": temp,
+            "sequence": "".join(lines)
+            }
+
+def iter_fasta(filepath):
+    """
+    Reads a FASTA file (plain or gzip) and yields the sequences with their attributes one at a time.
+    """
+    with open_text(filepath) as file:
         seq_id = ""
-        seq = ""
+        seq = []  # Sequence lines, joined once per record
         for line in file:
             if line.startswith(">"):
                 if seq_id:
-                    temp = parse_fasta_header(seq_id)
-                    sequences.append(
-                        {"transcript_id":temp['transcript_id'],
-                        "attributes": temp,
-                        "sequence": seq
-                        })
+                    yield fasta_record(seq_id, seq)
                 seq_id = line.strip()
-                seq = ""
+                seq = []
             else:
-                seq += line.strip()
+                seq.append(line.strip())
         if seq_id:
-            temp = parse_fasta_header(seq_id)
-            sequences.append(
-                {"transcript_id":temp['transcript_id'],
-                "attributes": temp,
-                "sequence": seq
-                })
-    return sequences
+            yield fasta_record(seq_id, seq)
+
+def read_fasta(filepath):
+    """
+    Reads a FASTA file and returns a dictionary of sequences with their attributes.
+    """
+    return list(iter_fasta(filepath))
 
 
 def parse_fastq_header(header):
@@ -72,13 +86,12 @@ def parse_fastq_header(header):
     return attributes
 
 
-def read_fastq(filepath):
+def iter_fastq(filepath):
     """
-    Reads a FASTQ file and returns a list of dictionaries with sequence information.
+    Reads a FASTQ file (plain or gzip) and yields dictionaries with sequence information one at a time.
     Each dictionary contains 'seq_id', 'attributes', 'sequence', and 'quality' keys.
     """
-    sequences = []
-    with open(filepath, 'r') as file:
+    with open_text(filepath) as file:
         while True:
             seq_id = file.readline().strip()
             if not seq_id:
@@ -87,22 +100,27 @@ def read_fastq(filepath):
             file.readline()  # Plus sign line (ignored)
             quality = file.readline().strip()
             temp = parse_fastq_header(seq_id)
-            sequences.append({
+            yield {
                 "seq_id": temp["tile"] + ':' + temp["x_pos"] + ':' + temp["y_pos"],
                 "attributes": temp,
                 "sequence": sequence,
                 "quality": quality
-            })
-    return sequences
+            }
 
-def read_fastq_barcode(sequences_path, barcodes_path):
+def read_fastq(filepath):
     """
-    Reads a FASTQ file and the corresponding barcode FASTQ file.
-    Returns a list of dictionaries with sequence information.
+    Reads a FASTQ file and returns a list of dictionaries with sequence information.
+    Each dictionary contains 'seq_id', 'attributes', 'sequence', and 'quality' keys.
+    """
+    return list(iter_fastq(filepath))
+
+def iter_fastq_barcode(sequences_path, barcodes_path):
+    """
+    Reads a FASTQ file and the corresponding barcode FASTQ file (plain or gzip).
+    Yields dictionaries with sequence information one at a time.
     Each dictionary contains 'barcode', 'attributes', 'sequence', 'quality' and 'bc_quality' keys.
     """
-    sequences = []
-    with open(sequences_path, 'r') as seq_file, open(barcodes_path, 'r') as code_file:
+    with open_text(sequences_path) as seq_file, open_text(barcodes_path) as code_file:
         while True:
             seq_id = seq_file.readline().strip()
             code_id = code_file.readline().strip()
@@ -115,14 +133,54 @@ def read_fastq_barcode(sequences_path, barcodes_path):
             quality = seq_file.readline().strip()
             barcode_quality = code_file.readline().strip()
             temp = parse_fastq_header(seq_id)
-            sequences.append({
+            yield {
                 "barcode": barcode,
                 "attributes": temp,
                 "sequence": sequence,
                 "quality": quality,
                 "bc_quality": barcode_quality
-            })
-    return sequences
+            }
+
+def read_fastq_barcode(sequences_path, barcodes_path):
+    """
+    Reads a FASTQ file and the corresponding barcode FASTQ file.
+    Returns a list of dictionaries with sequence information.
+    Each dictionary contains 'barcode', 'attributes', 'sequence', 'quality' and 'bc_quality' keys.
+    """
+    return list(iter_fastq_barcode(sequences_path, barcodes_path))
+
+def iter_chunks(records, chunk_size):
+    """
+    Groups the records of one of the iter_* readers into lists of chunk_size records (the last one may be shorter),
+    e.g. to write a large file to HDFS part by part with writeToHadoop.
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def split_windows(records, max_length, overlap):
+    """
+    Splits the records with a sequence longer than max_length into overlapping windows of max_length bases,
+    so a long transcript is aligned by several tasks instead of skewing one. Any alignment spanning at most overlap
+    bases of the sequence lies entirely in one window, so the overlap must be at least the query length plus the gaps
+    an alignment may open. The window records keep the fields of their record, with their start in 'window'.
+    """
+    if overlap >= max_length:
+        raise ValueError("The overlap must be shorter than max_length")
+    step = max_length - overlap
+    for record in records:
+        sequence = record['sequence']
+        if len(sequence) <= max_length:
+            yield record
+            continue
+        for start in range(0, len(sequence) - overlap, step):
+            yield {**record, "sequence": sequence[start:start + max_length], "window": start}
 
 
 # Define the substitution matrix and gap penalty
@@ -138,7 +196,10 @@ gap_penalty = -2
 def smith_waterman(seq1, seq2, substitution_matrix, gap_penalty):
     """
     Smith-Waterman algorithm for local sequence alignment.
+    Linear gap penalties only, affine ones (see ScoringScheme) need the vectorized engine.
     """
+    substitution_matrix, gap_penalty = scalar_scoring(substitution_matrix, gap_penalty)
+    seq2 = decode_sequence(seq2)  # The cDNA may come encoded from a reference cache
     m, n = len(seq1), len(seq2)
     score_matrix = np.zeros((m + 1, n + 1))
     traceback_matrix = np.zeros((m + 1, n + 1), dtype=int)
@@ -186,11 +247,489 @@ def smith_waterman(seq1, seq2, substitution_matrix, gap_penalty):
     return max_score, align1, align2
 
 
+# Integer codes of the nucleotides used by the vectorized engines.
+# Every other character is treated like 'N'.
+ALPHABET = 'ACGTN'
+base_codes = np.full(256, ALPHABET.index('N'), dtype=np.uint8)
+for code, base in enumerate(ALPHABET):
+    base_codes[ord(base)] = code
+
+def encode_sequence(seq):
+    """
+    Encodes a DNA sequence string as an uint8 array of ALPHABET indices.
+    Already encoded sequences (NumPy arrays) are returned as they are.
+    """
+    if isinstance(seq, np.ndarray):
+        return seq
+    return base_codes[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+
+alphabet_bytes = np.frombuffer(ALPHABET.encode('ascii'), dtype=np.uint8)
+
+def decode_sequence(seq):
+    """
+    Decodes an encoded sequence (e.g. from a reference cache) back into a string.
+    Strings are returned as they are.
+    """
+    if isinstance(seq, str):
+        return seq
+    return alphabet_bytes[seq].tobytes().decode('ascii')
+
+def kmer_codes(seq, k):
+    """
+    Returns the 2-bit packed code of every k-mer of a sequence (k <= 31).
+    k-mers containing 'N' (or any other non ACGT character) get the code -1.
+    """
+    codes = encode_sequence(seq)
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    bases = codes.astype(np.int64)
+    packed = np.zeros(n, dtype=np.int64)
+    for offset in range(k):
+        packed = (packed << 2) | (bases[offset:offset + n] & 3)
+    # Count the N's inside each k-mer window with a cumulative sum
+    n_count = np.concatenate(([0], np.cumsum(bases > 3)))
+    packed[(n_count[k:] - n_count[:n]) > 0] = -1
+    return packed
+
+def score_table(substitution_matrix):
+    """
+    Converts the tuple-keyed substitution matrix into a dense 5x5 lookup table ordered like ALPHABET.
+    Dense tables (e.g. ScoringScheme.substitution_matrix) are returned as they are.
+    """
+    if isinstance(substitution_matrix, np.ndarray):
+        return substitution_matrix
+    return np.array([[substitution_matrix[(a, b)] for b in ALPHABET] for a in ALPHABET])
+
+def gap_costs(gap_penalty):
+    """
+    Returns the (open, extend) scores of a gap penalty: a number is a linear penalty (open == extend),
+    a pair an affine one, a gap of length L then scores open + (L - 1) * extend.
+    """
+    if isinstance(gap_penalty, (tuple, list)):
+        return gap_penalty[0], gap_penalty[1]
+    return gap_penalty, gap_penalty
+
+def scale_gap(gap_penalty, factor):
+    """
+    Scales a linear or affine gap penalty, e.g. by 40 for the quality profiles.
+    """
+    gap_open, gap_extend = gap_costs(gap_penalty)
+    return gap_open * factor if gap_open == gap_extend else (gap_open * factor, gap_extend * factor)
+
+def scalar_scoring(substitution_matrix, gap_penalty):
+    """
+    Returns the tuple-keyed substitution matrix and the linear gap penalty used by the scalar loops.
+    """
+    gap_open, gap_extend = gap_costs(gap_penalty)
+    if gap_open != gap_extend:
+        raise ValueError("The scalar engines support linear gap penalties only, use the vectorized engine for affine gaps")
+    if isinstance(substitution_matrix, np.ndarray):
+        substitution_matrix = {(a, b): substitution_matrix[x, y].item() for x, a in enumerate(ALPHABET) for y, b in enumerate(ALPHABET)}
+    return substitution_matrix, gap_open
+
+def read_score_table(filepath):
+    """
+    Reads a substitution matrix file into a dense table ordered like ALPHABET.
+    The first line lists the bases of the columns, every other line a base followed by its scores,
+    e.g. the NCBI matrices (NUC.4.4). Lines starting with '#' are skipped, bases outside ALPHABET are ignored
+    and pairs missing from the file score 0.
+    """
+    with open(filepath, 'r') as file:
+        lines = [line.split() for line in file if line.strip() and not line.startswith('#')]
+    columns, table = lines[0], np.zeros((len(ALPHABET), len(ALPHABET)))
+    for row in lines[1:]:
+        for column, score in zip(columns, row[1:]):
+            if row[0] in ALPHABET and column in ALPHABET:
+                table[ALPHABET.index(row[0]), ALPHABET.index(column)] = float(score)
+    return table.astype(np.int64) if (table == table.round()).all() else table
+
+def write_score_table(table, filepath):
+    """
+    Writes a dense substitution table in the format of read_score_table.
+    """
+    with open(filepath, 'w') as file:
+        file.write(' '.join(ALPHABET) + '\n')
+        for base, row in zip(ALPHABET, score_table(table).tolist()):
+            file.write(' '.join([base] + [str(score) for score in row]) + '\n')
+
+class ScoringScheme:
+    """
+    Substitution scores and gap penalties of the alignments, passed to every engine in place of the module-level
+    substitution_matrix and gap_penalty: substitution_matrix is the dense table ordered like ALPHABET (see score_table),
+    gap_penalty the linear penalty, or the (open, extend) pair of affine gaps if gap_extend differs from gap_open.
+    A gap of length L scores gap_open + (L - 1) * gap_extend, the default scheme is the linear one of this module.
+    """
+
+    def __init__(self, substitution_matrix=substitution_matrix, gap_open=gap_penalty, gap_extend=None):
+        gap_extend = gap_open if gap_extend is None else gap_extend
+        if not gap_open <= gap_extend <= 0:
+            raise ValueError("Gap penalties must satisfy gap_open <= gap_extend <= 0, got %s and %s" % (gap_open, gap_extend))
+        self.substitution_matrix = score_table(substitution_matrix)
+        self.gap_penalty = gap_open if gap_open == gap_extend else (gap_open, gap_extend)
+
+    @classmethod
+    def from_file(cls, filepath=None, gap_open=gap_penalty, gap_extend=None):
+        """
+        Scoring scheme with the substitution matrix of a file (see read_score_table), or the default one.
+        """
+        return cls(read_score_table(filepath) if filepath else substitution_matrix, gap_open, gap_extend)
+
+    @property
+    def affine(self):
+        return isinstance(self.gap_penalty, tuple)
+
+    def __repr__(self):
+        return 'ScoringScheme(gap_penalty=%r, substitution_matrix=%r)' % (self.gap_penalty, self.substitution_matrix.tolist())
+
+def fill_profile(profile, codes2, gap_penalty):
+    """
+    Fills the score and traceback matrices row by row from a query profile.
+
+    profile[i] holds the scores of the i-th query position against each base of ALPHABET,
+    so profile[i][codes2] is the whole row of match scores.
+    The horizontal (insert) dependency of a row is resolved with a prefix maximum:
+    H[j] = max(V[j], H[j-1] + g) unrolls to g*j + max_{k<=j}(V[k] - g*k).
+    Affine gap penalties are filled by fill_profile_affine.
+    """
+    gap_open, gap_extend = gap_costs(gap_penalty)
+    if gap_open != gap_extend:
+        return fill_profile_affine(profile, codes2, gap_open, gap_extend)
+    gap_penalty = gap_open
+    profile = profile.astype(np.result_type(profile, gap_penalty))
+    m, n = len(profile), len(codes2)
+    score_matrix = np.zeros((m + 1, n + 1), dtype=profile.dtype)
+    traceback_matrix = np.zeros((m + 1, n + 1), dtype=np.uint8)
+    steps = gap_penalty * np.arange(n + 1, dtype=profile.dtype)
+
+    for i in range(1, m + 1):
+        prev = score_matrix[i - 1]
+        row = score_matrix[i]
+        match = prev[:-1] + profile[i - 1][codes2]
+        delete = prev[1:] + gap_penalty
+        row[1:] = np.maximum(np.maximum(match, delete), 0)
+        row[:] = np.maximum.accumulate(row - steps) + steps
+        insert = row[:-1] + gap_penalty
+
+        score = row[1:]
+        traceback_matrix[i, 1:] = np.where(score == match, 1,  # diagonal
+                                  np.where(score == delete, 2,  # up
+                                  np.where(score == insert, 3, 0)))  # left
+
+    return score_matrix, traceback_matrix
+
+def fill_profile_affine(profile, codes2, gap_open, gap_extend):
+    """
+    Affine gap (Gotoh) variant of fill_profile, a gap of length L scores gap_open + (L - 1) * gap_extend.
+    Besides the score matrix H, the best scores of the current row ending in a vertical gap (F) and a horizontal gap (E)
+    are kept: F = max(H_above + open, F_above + extend) is elementwise, and E[j] = max(H[j-1] + open, E[j-1] + extend)
+    unrolls to open + extend*(j-1) + max_{k<j}(V[k] - extend*k) over the scores V = max(0, match, F) without E,
+    one prefix maximum like the linear case (exact for gap_open <= gap_extend, re-opening a gap never beats extending it).
+    The traceback matrix holds the direction of H in its low 2 bits, bit 4 is set if E extends a gap, bit 8 if F does.
+    """
+    profile = profile.astype(np.result_type(profile, gap_open, gap_extend, float))
+    m, n = len(profile), len(codes2)
+    score_matrix = np.zeros((m + 1, n + 1), dtype=profile.dtype)
+    traceback_matrix = np.zeros((m + 1, n + 1), dtype=np.uint8)
+    steps = gap_extend * np.arange(n + 1, dtype=profile.dtype)
+    vertical = np.full(n, -np.inf)
+    horizontal = np.full(n + 1, -np.inf)
+
+    for i in range(1, m + 1):
+        prev = score_matrix[i - 1]
+        row = score_matrix[i]
+        match = prev[:-1] + profile[i - 1][codes2]
+        opened = prev[1:] + gap_open
+        vertical = np.maximum(opened, vertical + gap_extend)
+        row[1:] = np.maximum(np.maximum(match, vertical), 0)
+        horizontal[1:] = np.maximum.accumulate(row - steps)[:-1] + steps[:-1] + gap_open
+        row[:] = np.maximum(row, horizontal)
+
+        score = row[1:]
+        traceback_matrix[i, 1:] = np.where(score == match, 1,  # diagonal
+                                  np.where(score == vertical, 2,  # up
+                                  np.where(score == horizontal[1:], 3, 0))) \
+                                  | ((horizontal[1:] != row[:-1] + gap_open) << 2) \
+                                  | ((vertical != opened) << 3)
+
+    return score_matrix, traceback_matrix
+
+def traceback(seq1, seq2, score_matrix, traceback_matrix):
+    """
+    Follows the traceback matrix from the best cell and returns the score and aligned sequences.
+    Ties of the best score are resolved like the scalar loop: first cell in row-major order.
+    With affine gaps a gap is followed until its extension bit (see fill_profile_affine) is unset.
+    """
+    seq1, seq2 = decode_sequence(seq1), decode_sequence(seq2)
+    max_pos = np.unravel_index(np.argmax(score_matrix), score_matrix.shape)
+    max_score = score_matrix[max_pos]
+    if max_score <= 0:
+        return 0, "", ""
+
+    align1, align2 = [], []
+    i, j = int(max_pos[0]), int(max_pos[1])
+
+    state = 0  # 0: score matrix, 2: in a vertical gap, 3: in a horizontal gap
+    while state or score_matrix[i, j] != 0:
+        direction = int(traceback_matrix[i, j])
+        if not state:
+            state = direction & 3
+        if state == 1:
+            align1.append(seq1[i - 1])
+            align2.append(seq2[j - 1])
+            i -= 1
+            j -= 1
+            state = 0
+        elif state == 2:
+            align1.append(seq1[i - 1])
+            align2.append("-")
+            i -= 1
+            state = 2 if direction & 8 else 0
+        elif state == 3:
+            align1.append("-")
+            align2.append(seq2[j - 1])
+            j -= 1
+            state = 3 if direction & 4 else 0
+        else:
+            break
+
+    return float(max_score), "".join(reversed(align1)), "".join(reversed(align2))
+
+def smith_waterman_vectorized(seq1, seq2, substitution_matrix, gap_penalty):
+    """
+    Smith-Waterman algorithm for local sequence alignment, vectorized with NumPy.
+    Returns the same score and alignment as smith_waterman, but computes whole rows
+    of the score matrix at once from a query profile instead of cell by cell.
+    """
+    profile = score_table(substitution_matrix)[encode_sequence(seq1)]
+    score_matrix, traceback_matrix = fill_profile(profile, encode_sequence(seq2), gap_penalty)
+    return traceback(seq1, seq2, score_matrix, traceback_matrix)
+
+def score_profile(profile, codes2, gap_penalty):
+    """
+    Returns the best score of a query profile against an encoded sequence,
+    keeping two rolling rows instead of the full score and traceback matrices.
+    Affine gap penalties are scored like fill_profile_affine.
+    """
+    gap_open, gap_extend = gap_costs(gap_penalty)
+    if gap_open != gap_extend:
+        return score_profile_affine(profile, codes2, gap_open, gap_extend)
+    gap_penalty = gap_open
+    profile = profile.astype(np.result_type(profile, gap_penalty))
+    steps = gap_penalty * np.arange(len(codes2) + 1, dtype=profile.dtype)
+
+    prev = np.zeros(len(codes2) + 1, dtype=profile.dtype)
+    row = np.zeros_like(prev)
+    max_score = 0
+    for scores in profile:
+        row[1:] = np.maximum(np.maximum(prev[:-1] + scores[codes2], prev[1:] + gap_penalty), 0)
+        row[:] = np.maximum.accumulate(row - steps) + steps
+        max_score = max(max_score, row.max())
+        prev, row = row, prev
+
+    return max_score
+
+def score_profile_affine(profile, codes2, gap_open, gap_extend):
+    """
+    Score-only variant of fill_profile_affine with two rolling rows and the vertical gap scores of the last row.
+    """
+    profile = profile.astype(np.result_type(profile, gap_open, gap_extend, float))
+    steps = gap_extend * np.arange(len(codes2) + 1, dtype=profile.dtype)
+
+    prev = np.zeros(len(codes2) + 1, dtype=profile.dtype)
+    row = np.zeros_like(prev)
+    vertical = np.full(len(codes2), -np.inf)
+    max_score = 0
+    for scores in profile:
+        vertical = np.maximum(prev[1:] + gap_open, vertical + gap_extend)
+        row[1:] = np.maximum(np.maximum(prev[:-1] + scores[codes2], vertical), 0)
+        row[1:] = np.maximum(row[1:], np.maximum.accumulate(row - steps)[:-1] + steps[:-1] + gap_open)
+        max_score = max(max_score, row.max())
+        prev, row = row, prev
+
+    return max_score
+
+def smith_waterman_score(seq1, seq2, substitution_matrix, gap_penalty):
+    """
+    Score-only Smith-Waterman: returns just the best local alignment score.
+    Keeps two rolling rows instead of the full score and traceback matrices (O(n) memory),
+    the alignment of the best hits can be recomputed afterwards with one of the alignment_engines.
+    """
+    max_score = score_profile(score_table(substitution_matrix)[encode_sequence(seq1)], encode_sequence(seq2), gap_penalty)
+    return float(max_score) if max_score > 0 else 0
+
+def smith_waterman_score_batch(queries, seq2, substitution_matrix, gap_penalty):
+    """
+    Score-only Smith-Waterman of several queries against one sequence.
+    The queries are packed into a single (queries x query length x 5) profile, padded to the longest query,
+    so one row update covers the same query position of every query.
+    Returns a list with the best score of each query, like smith_waterman_score.
+    Affine gap penalties are scored like fill_profile_affine.
+    """
+    gap_open, gap_extend = gap_costs(gap_penalty)
+    affine = gap_open != gap_extend
+    table = score_table(substitution_matrix)
+    table = table.astype(np.result_type(table, gap_open, gap_extend, *((float,) if affine else ())))
+    lengths = np.array([len(q) for q in queries])
+    packed = np.full((len(queries), lengths.max(initial=0)), ALPHABET.index('N'), dtype=np.uint8)
+    for k, query in enumerate(queries):
+        packed[k, :len(query)] = encode_sequence(query)
+    codes2 = encode_sequence(seq2)
+    steps = gap_extend * np.arange(len(codes2) + 1, dtype=table.dtype)
+
+    prev = np.zeros((len(queries), len(codes2) + 1), dtype=table.dtype)
+    row = np.zeros_like(prev)
+    vertical = np.full((len(queries), len(codes2)), -np.inf)
+    max_scores = np.zeros(len(queries), dtype=table.dtype)
+    for i in range(packed.shape[1]):
+        if affine:
+            vertical = np.maximum(prev[:, 1:] + gap_open, vertical + gap_extend)
+            row[:, 1:] = np.maximum(np.maximum(prev[:, :-1] + table[packed[:, i]][:, codes2], vertical), 0)
+            row[:, 1:] = np.maximum(row[:, 1:], np.maximum.accumulate(row - steps, axis=1)[:, :-1] + steps[:-1] + gap_open)
+        else:
+            row[:, 1:] = np.maximum(np.maximum(prev[:, :-1] + table[packed[:, i]][:, codes2], prev[:, 1:] + gap_open), 0)
+            row[:] = np.maximum.accumulate(row - steps, axis=1) + steps
+        # Padded positions of shorter queries must not count
+        max_scores = np.where(i < lengths, np.maximum(max_scores, row.max(axis=1)), max_scores)
+        prev, row = row, prev
+
+    return [float(score) if score > 0 else 0 for score in max_scores]
+
+def fill_profile_banded(profile, codes2, gap_penalty, low, high):
+    """
+    Banded variant of fill_profile: only the diagonals low <= j - i <= high are computed.
+    Column c of row i in the returned (m+1) x (high-low+1) matrices is the cell j = i + low + c,
+    cells outside the band or the sequence count as 0.
+    Affine gap penalties are filled like fill_profile_affine, with the same traceback bits.
+    """
+    gap_open, gap_extend = gap_costs(gap_penalty)
+    affine = gap_open != gap_extend
+    profile = profile.astype(np.result_type(profile, gap_open, gap_extend, *((float,) if affine else ())))
+    m, n, width = len(profile), len(codes2), high - low + 1
+    score_matrix = np.zeros((m + 1, width), dtype=profile.dtype)
+    traceback_matrix = np.zeros((m + 1, width), dtype=np.uint8)
+    steps = gap_extend * np.arange(width, dtype=profile.dtype)
+    offsets = np.arange(width)
+    vertical = np.full(width, -np.inf)
+
+    for i in range(1, m + 1):
+        j = i + low + offsets
+        valid = (j >= 1) & (j <= n)
+        prev = score_matrix[i - 1]
+        row = score_matrix[i]
+        match = prev + profile[i - 1][codes2[np.clip(j - 1, 0, n - 1)]]
+        delete = np.append(prev[1:], 0) + gap_open
+        if affine:
+            # The cell above is one column to the right in the band
+            vertical = np.where(valid, np.maximum(delete, np.append(vertical[1:], -np.inf) + gap_extend), -np.inf)
+            row[:] = np.where(valid, np.maximum(np.maximum(match, vertical), 0), 0)
+            insert = np.append(-np.inf, np.maximum.accumulate(row - steps)[:-1] + steps[:-1] + gap_open)
+            row[:] = np.where(valid, np.maximum(row, insert), 0)
+            traceback_matrix[i] = np.where(~valid, 0,
+                                  np.where(row == match, 1,  # diagonal
+                                  np.where(row == vertical, 2,  # up
+                                  np.where(row == insert, 3, 0))) \
+                                  | ((insert != np.insert(row[:-1], 0, 0) + gap_open) << 2) \
+                                  | ((vertical != delete) << 3))
+            continue
+        row[:] = np.where(valid, np.maximum(np.maximum(match, delete), 0), 0)
+        row[:] = np.maximum.accumulate(row - steps) + steps
+        row[~valid] = 0
+        insert = np.insert(row[:-1], 0, 0) + gap_open
+
+        traceback_matrix[i] = np.where(~valid, 0,
+                              np.where(row == match, 1,  # diagonal
+                              np.where(row == delete, 2,  # up
+                              np.where(row == insert, 3, 0))))  # left
+
+    return score_matrix, traceback_matrix
+
+def traceback_banded(seq1, seq2, score_matrix, traceback_matrix, low):
+    """
+    Traceback of the banded matrices of fill_profile_banded, column c of row i is the cell j = i + low + c.
+    Affine gaps are followed like in traceback.
+    """
+    seq1, seq2 = decode_sequence(seq1), decode_sequence(seq2)
+    max_pos = np.unravel_index(np.argmax(score_matrix), score_matrix.shape)
+    max_score = score_matrix[max_pos]
+    if max_score <= 0:
+        return 0, "", ""
+
+    align1, align2 = [], []
+    i, c = int(max_pos[0]), int(max_pos[1])
+
+    state = 0  # 0: score matrix, 2: in a vertical gap, 3: in a horizontal gap
+    while state or score_matrix[i, c] != 0:
+        direction = int(traceback_matrix[i, c])
+        if not state:
+            state = direction & 3
+        j = i + low + c
+        if state == 1:
+            align1.append(seq1[i - 1])
+            align2.append(seq2[j - 1])
+            i -= 1
+            state = 0
+        elif state == 2:
+            align1.append(seq1[i - 1])
+            align2.append("-")
+            i -= 1
+            c += 1
+            state = 2 if direction & 8 else 0
+        elif state == 3:
+            align1.append("-")
+            align2.append(seq2[j - 1])
+            c -= 1
+            state = 3 if direction & 4 else 0
+        else:
+            break
+
+    return float(max_score), "".join(reversed(align1)), "".join(reversed(align2))
+
+def banded_smith_waterman(seq1, seq2, substitution_matrix, gap_penalty, diagonal=0, band_width=16):
+    """
+    Smith-Waterman algorithm restricted to a band around a diagonal (j - i) of the score matrix,
+    e.g. the diagonal of a seed shared by both sequences.
+    Cost and memory are proportional to len(seq1) * (2 * band_width + 1) instead of len(seq1) * len(seq2).
+    Returns the same (score, align1, align2) as smith_waterman when the best alignment lies within the band.
+    """
+    if len(seq1) == 0 or len(seq2) == 0:
+        return 0, "", ""
+    low, high = diagonal - band_width, diagonal + band_width
+    profile = score_table(substitution_matrix)[encode_sequence(seq1)]
+    score_matrix, traceback_matrix = fill_profile_banded(profile, encode_sequence(seq2), gap_penalty, low, high)
+
+    return traceback_banded(seq1, seq2, score_matrix, traceback_matrix, low)
+
+def read_queries(filepath):
+    """
+    Reads a file of query sequences, one per line.
+    A line is either 'query_id<TAB>sequence' or just the sequence, which is then also used as its ID.
+    Returns a list of (query_id, sequence) tuples.
+    """
+    queries = []
+    with open(filepath, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue  # Skip empty lines
+            parts = line.split('\t')
+            queries.append((parts[0], parts[-1]))
+    return queries
+
+# Alignment engines selectable by the BLASTN jobs
+alignment_engines = {
+    'scalar': smith_waterman,
+    'vectorized': smith_waterman_vectorized,
+}
+
 
 def quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_penalty):
     """
     Smith-Waterman algorithm with quality score adjustment.
+    Linear gap penalties only, affine ones (see ScoringScheme) need the vectorized engine.
     """
+    substitution_matrix, gap_penalty = scalar_scoring(substitution_matrix, gap_penalty)
+    seq2 = decode_sequence(seq2)  # The cDNA may come encoded from a reference cache
     m, n = len(seq1), len(seq2)
     score_matrix = np.zeros((m + 1, n + 1))
     traceback_matrix = np.zeros((m + 1, n + 1), dtype=int)
@@ -241,3 +780,299 @@ def quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_
             j -= 1
 
     return max_score, align1, align2
+
+
+def quality_profile(seq1, qual1, substitution_matrix):
+    """
+    Builds the position-specific scoring profile (read length x 5 bases) of a read.
+    The quality string is decoded once into Phred scores; the profile holds substitution score * Phred score,
+    i.e. the quality adjusted scores scaled by 40 so that integer substitution scores stay exact integers.
+    """
+    phred = np.frombuffer(qual1.encode('ascii'), dtype=np.uint8).astype(np.int64) - 33  # Convert ASCII quality scores to Phred scores
+    return score_table(substitution_matrix)[encode_sequence(seq1)] * phred[:, None]
+
+def quality_adjusted_smith_waterman_vectorized(seq1, qual1, seq2, substitution_matrix, gap_penalty):
+    """
+    Smith-Waterman algorithm with quality score adjustment, vectorized with NumPy.
+    Scores a per-read quality profile against the cDNA one row at a time and returns
+    the same (score, align1, align2) as quality_adjusted_smith_waterman.
+    """
+    # The profile is scaled by 40, so is the gap penalty
+    score_matrix, traceback_matrix = fill_profile(quality_profile(seq1, qual1, substitution_matrix), encode_sequence(seq2), scale_gap(gap_penalty, 40))
+    max_score, align1, align2 = traceback(seq1, seq2, score_matrix, traceback_matrix)
+    return (max_score / 40.0 if max_score else 0), align1, align2
+
+def quality_adjusted_smith_waterman_score(seq1, qual1, seq2, substitution_matrix, gap_penalty):
+    """
+    Score-only variant of quality_adjusted_smith_waterman with two rolling rows, returns just the best score.
+    """
+    max_score = score_profile(quality_profile(seq1, qual1, substitution_matrix), encode_sequence(seq2), scale_gap(gap_penalty, 40))
+    return max_score / 40.0 if max_score > 0 else 0
+
+def best_seed(seq1, seq2, k=11):
+    """
+    Finds a k-mer shared by both sequences on the diagonal (j - i) with the most shared k-mers.
+    Returns (diagonal, i, j) of the first seed on that diagonal, or None if the sequences share no k-mer.
+    """
+    kmers1, kmers2 = kmer_codes(seq1, k), kmer_codes(seq2, k)
+    positions2 = np.flatnonzero(np.isin(kmers2, kmers1[kmers1 >= 0]))
+    if len(positions2) == 0:
+        return None
+    seeds = sorted((j - i, i, j) for j in positions2.tolist() for i in np.flatnonzero(kmers1 == kmers2[j]).tolist())
+    diagonals = [seed[0] for seed in seeds]
+    diagonal = max(sorted(set(diagonals)), key=diagonals.count)
+    return seeds[diagonals.index(diagonal)]
+
+def xdrop_extend(profile, seq1, seq2, gap_penalty, x_drop):
+    """
+    X-drop extension of an alignment anchored at the start of both sequences (no restart at 0 like Smith-Waterman).
+    Each row only covers the cells reachable from the live cells of the row above, cells scoring more than x_drop
+    below the best score so far are dropped and the extension stops as soon as a row has no cells left.
+    Returns the best score and the aligned sequences up to the best cell (0, "", "" for an empty extension).
+    """
+    codes2 = encode_sequence(seq2)
+    m, n = len(profile), len(codes2)
+    # Row 0: only gaps, as long as they stay within x_drop
+    width = min(n, int(x_drop // -gap_penalty)) + 1
+    rows = [(0, gap_penalty * np.arange(width, dtype=float), np.full(width, 3, dtype=np.uint8))]
+    max_score, max_pos = 0, (0, 0)
+
+    for i in range(1, m + 1):
+        low, prev, _ = rows[-1]
+        high = min(low + len(prev), n)  # One column right of the row above
+        cols = np.arange(low, high + 1)
+        diag = np.full(len(cols), -np.inf)
+        has_diag = (cols >= 1) & (cols - 1 - low < len(prev))
+        diag[has_diag] = prev[cols[has_diag] - 1 - low] + profile[i - 1][codes2[cols[has_diag] - 1]]
+        up = np.full(len(cols), -np.inf)
+        has_up = cols - low < len(prev)
+        up[has_up] = prev[cols[has_up] - low] + gap_penalty
+        steps = gap_penalty * np.arange(len(cols))
+        row = np.maximum.accumulate(np.maximum(diag, up) - steps) + steps
+        direction = np.where(row == diag, 1, np.where(row == up, 2, 3)).astype(np.uint8)
+
+        # Horizontal gaps beyond the last column, as long as they stay within x_drop
+        extra = min(n - high, int((row[-1] - (max(max_score, row.max()) - x_drop)) // -gap_penalty)) if row[-1] > -np.inf else 0
+        if extra > 0:
+            row = np.append(row, row[-1] + gap_penalty * np.arange(1, extra + 1))
+            direction = np.append(direction, np.full(extra, 3, dtype=np.uint8))
+
+        if row.max() > max_score:
+            max_score, max_pos = row.max(), (i, low + int(np.argmax(row)))
+        live = row >= max_score - x_drop
+        if not live.any():
+            break  # X-drop: every cell fell too far below the best score
+        first, last = int(np.argmax(live)), len(live) - 1 - int(np.argmax(live[::-1]))
+        rows.append((low + first, np.where(live, row, -np.inf)[first:last + 1], direction[first:last + 1]))
+
+    align1, align2 = [], []
+    i, j = max_pos
+    while i > 0 or j > 0:
+        low, _, directions = rows[i]
+        direction = directions[j - low]
+        if direction == 1:
+            align1.append(seq1[i - 1])
+            align2.append(seq2[j - 1])
+            i -= 1
+            j -= 1
+        elif direction == 2:
+            align1.append(seq1[i - 1])
+            align2.append("-")
+            i -= 1
+        else:
+            align1.append("-")
+            align2.append(seq2[j - 1])
+            j -= 1
+
+    return max_score, "".join(reversed(align1)), "".join(reversed(align2))
+
+def banded_quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_penalty, diagonal=0, band_width=16):
+    """
+    Quality adjusted Smith-Waterman algorithm restricted to a band around a diagonal (j - i),
+    e.g. the diagonal of a seed shared by the read and the transcript (see best_seed).
+    Cost is proportional to read length * band width instead of read length * transcript length.
+    """
+    if len(seq1) == 0 or len(seq2) == 0:
+        return 0, "", ""
+    low, high = diagonal - band_width, diagonal + band_width
+    # The quality profile is scaled by 40, so is the gap penalty
+    score_matrix, traceback_matrix = fill_profile_banded(quality_profile(seq1, qual1, substitution_matrix), encode_sequence(seq2), scale_gap(gap_penalty, 40), low, high)
+    max_score, align1, align2 = traceback_banded(seq1, seq2, score_matrix, traceback_matrix, low)
+    return (max_score / 40.0 if max_score else 0), align1, align2
+
+def xdrop_quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_penalty, seed=(0, 0, 0), x_drop=20):
+    """
+    Quality adjusted local alignment by X-drop extension of a seed in both directions, like BLAST's gapped extension.
+    seed is (diagonal, i, j) of a k-mer shared by seq1[i:] and seq2[j:] (see best_seed), x_drop is in score units.
+    The extensions stop once their score falls x_drop below their best score, so the cost depends on the
+    length of the alignment rather than the length of the transcript. Linear gap penalties only.
+    """
+    gap_open, gap_extend = gap_costs(gap_penalty)
+    if gap_open != gap_extend:
+        raise ValueError("The X-drop extension supports linear gap penalties only, use the banded or full mode for affine gaps")
+    seq1, seq2 = decode_sequence(seq1), decode_sequence(seq2)
+    k = 0
+    _, i, j = seed
+    while i + k < len(seq1) and j + k < len(seq2) and seq1[i + k] == seq2[j + k] != 'N':
+        k += 1  # The seed is extended over all exact matches of its diagonal
+    profile = quality_profile(seq1, qual1, substitution_matrix)
+    codes2 = encode_sequence(seq2)
+    seed_score = profile[np.arange(i, i + k), codes2[j:j + k]].sum()
+    # The quality profile is scaled by 40, so are the gap penalty and the drop-off
+    right_score, right1, right2 = xdrop_extend(profile[i + k:], seq1[i + k:], seq2[j + k:], gap_penalty * 40, x_drop * 40)
+    left_score, left1, left2 = xdrop_extend(profile[:i][::-1], seq1[:i][::-1], seq2[:j][::-1], gap_penalty * 40, x_drop * 40)
+    max_score = left_score + seed_score + right_score
+    if max_score <= 0:
+        return 0, "", ""
+    return float(max_score) / 40.0, left1[::-1] + seq1[i:i + k] + right1, left2[::-1] + seq2[j:j + k] + right2
+
+def seeded_quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_penalty, mode='banded', seed_length=11, band_width=16, x_drop=20):
+    """
+    Seeds the alignment of a read against a transcript with their best shared k-mer (best_seed) and aligns it
+    with banded_quality_adjusted_smith_waterman (mode='banded') or xdrop_quality_adjusted_smith_waterman (mode='xdrop').
+    Returns None if the read and the transcript share no k-mer.
+    """
+    seed = best_seed(seq1, seq2, seed_length)
+    if seed is None:
+        return None
+    if mode == 'xdrop':
+        return xdrop_quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_penalty, seed, x_drop)
+    return banded_quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_penalty, seed[0], band_width)
+
+def myers_pattern(pattern):
+    """
+    Bit masks of the positions of each base of ALPHABET in a pattern, the per-pattern part of myers_distance.
+    'N' matches nothing, its mask stays empty.
+    """
+    peq = [0] * len(ALPHABET)
+    for i, base in enumerate(encode_sequence(pattern).tolist()):
+        if base < 4:
+            peq[base] |= 1 << i
+    return peq
+
+def myers_distance(pattern, text, peq=None):
+    """
+    Bit-parallel (Myers) semi-global edit distance: the fewest mismatches, insertions and deletions needed to
+    find the whole pattern anywhere in the text, 'N' matches nothing. Python integers serve as the bit vectors
+    (one bit per pattern base), so a read of up to 64 bases is a single machine word and a text base costs
+    a handful of word operations instead of a row of len(pattern) cells.
+    peq is myers_pattern(pattern), pass it to scan many texts with one pattern.
+    """
+    m = len(pattern)
+    if m == 0:
+        return 0
+    if peq is None:
+        peq = myers_pattern(pattern)
+    mask, high = (1 << m) - 1, 1 << (m - 1)
+    pv, mv, score = mask, 0, m  # Vertical deltas of the last DP column and the distance of the whole pattern
+    best = m
+    for base in encode_sequence(text).tolist():
+        eq = peq[base]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+            best = min(best, score)
+        # No carry into the first row: the pattern may start anywhere in the text
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return best
+
+def score_bound_profile(seq1, qual1, substitution_matrix, gap_penalty):
+    """
+    The per-read part of quality_score_bound, computed once per read: the Myers bit masks of the read and the score
+    bound of each edit distance 0..len(seq1), so bounding a pair only costs the bit-parallel scan of the transcript.
+    A local alignment with M matches and D deletions leaves an edit distance d <= len(seq1) - M + D, so it scores at
+    most the M best quality adjusted match scores of the read plus D gap penalties, with M <= len(seq1) - d + D.
+    With affine gaps every gap base costs at least the smaller of the open and extend penalties.
+    Returns None (no bound) if a substitution matrix scores anything but identical ACGT bases above 0.
+    """
+    table = score_table(substitution_matrix)
+    if (table[:4, :4] - np.diag(np.diag(table[:4, :4])) > 0).any() or (table[4] > 0).any() or (table[:, 4] > 0).any():
+        return None
+    m = len(seq1)
+    # Best score of each read position, largest first, cumulated (scaled by 40 like quality_profile)
+    best = np.concatenate(([0], np.cumsum(np.sort(np.clip(quality_profile(seq1, qual1, substitution_matrix).max(axis=1), 0, None))[::-1])))
+    # bounds[d] is the best of best[m - d + D] + D gap penalties over the deletions D <= d
+    distances, deletions = np.arange(m + 1)[:, None], np.arange(m + 1)[None, :]
+    scores = best[np.minimum(m - distances + deletions, m)] + deletions * max(gap_costs(gap_penalty)) * 40
+    bounds = np.maximum(np.where(deletions <= distances, scores, -np.inf).max(axis=1), 0) / 40.0
+    return myers_pattern(seq1), bounds.tolist()
+
+def profile_score_bound(profile, seq1, seq2):
+    """
+    quality_score_bound of the read seq1 against a transcript from the read's score_bound_profile.
+    """
+    if profile is None:
+        return np.inf
+    peq, bounds = profile
+    return bounds[myers_distance(seq1, seq2, peq)]
+
+def quality_score_bound(seq1, qual1, seq2, substitution_matrix, gap_penalty):
+    """
+    Upper bound of the quality adjusted Smith-Waterman score of a read against a transcript from their edit distance
+    (see score_bound_profile, which computes the per-read part once for many transcripts).
+    Returns inf (no bound) if a substitution matrix scores anything but identical ACGT bases above 0.
+    """
+    return profile_score_bound(score_bound_profile(seq1, qual1, substitution_matrix, gap_penalty), seq1, seq2)
+
+def prefilter_alignments(seq1, qual1, cdnas, quality_adjusted_smith_waterman, substitution_matrix, gap_penalty, k=1):
+    """
+    Aligns a read against (transcript_id, sequence) pairs, skipping the pairs whose quality_score_bound is below
+    the k-th best score found so far for the read: they cannot be among its top-k alignments.
+    Yields (transcript_id, alignment), the alignment is None for the skipped pairs.
+    Only the first alignment of a transcript enters the k best scores, so the windows of a long transcript
+    (see split_windows) can't fill the top-k with one transcript.
+    """
+    best_scores = []  # Min-heap of the k best scores so far
+    scored = set()
+    profile = score_bound_profile(seq1, qual1, substitution_matrix, gap_penalty)
+    for transcript_id, seq2 in cdnas:
+        if len(best_scores) == k and below_score(profile_score_bound(profile, seq1, seq2), best_scores[0]):
+            yield transcript_id, None
+            continue
+        alignment = quality_adjusted_smith_waterman(seq1, qual1, seq2, substitution_matrix, gap_penalty)
+        if alignment is not None and transcript_id not in scored:
+            scored.add(transcript_id)
+            push_score(best_scores, alignment[0], k)
+        yield transcript_id, alignment
+
+def below_score(bound, score):
+    """
+    Whether a score bound is below a score found by an alignment engine. The bound is exact (integer qualities
+    divided by 40), the scores of the engines drift in floating point (e.g. 37.000000000000014 for 37), so a bound
+    equal to the score up to that drift is not below it: the pair may tie with the score and is not pruned.
+    """
+    return bound < score - 1e-9 * max(1.0, abs(score))
+
+def push_score(best_scores, score, k):
+    """
+    Adds a score to a min-heap of at most k best scores, best_scores[0] is then the k-th best score.
+    """
+    if len(best_scores) < k:
+        heappush(best_scores, score)
+    elif score > best_scores[0]:
+        heapreplace(best_scores, score)
+
+# Quality adjusted alignment engines selectable by the alignment jobs
+quality_alignment_engines = {
+    'scalar': quality_adjusted_smith_waterman,
+    'vectorized': quality_adjusted_smith_waterman_vectorized,
+}
+
+def quality_alignment_engine(engine='scalar', mode='full', seed_length=11, band_width=16, x_drop=20):
+    """
+    Returns the quality adjusted alignment function of the alignment jobs, called like quality_adjusted_smith_waterman.
+    mode='full' aligns against the whole transcript with the given engine, mode='banded' or 'xdrop' seeds the alignment
+    (see seeded_quality_adjusted_smith_waterman) and returns None for the pairs without a shared k-mer.
+    mode='pseudo' aligns the ambiguous reads of the pseudoalignment (see kmer_index.pseudoalign_hits) in full.
+    """
+    if mode in ('full', 'pseudo'):
+        return quality_alignment_engines[engine]
+    return partial(seeded_quality_adjusted_smith_waterman, mode=mode, seed_length=seed_length, band_width=band_width, x_drop=x_drop)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of source/ import each other as top-level modules, like the jobs shipped to Hadoop (FILES)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
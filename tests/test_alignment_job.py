@@ -0,0 +1,44 @@
+import random
+from io import BytesIO
+from json import dumps
+import pytest
+
+pytest.importorskip('mrjob')
+from alignment_hadoop import Align_Hadoop
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+AFFINE = ['--gap_open', '-3', '--gap_extend', '-1']
+
+
+@pytest.mark.parametrize('engine, mode, rejected', [
+    ('scalar', 'full', True), ('scalar', 'pseudo', True), ('scalar', 'xdrop', True), ('vectorized', 'xdrop', True),
+    ('scalar', 'banded', False), ('vectorized', 'banded', False), ('vectorized', 'full', False), ('vectorized', 'pseudo', False)])
+def test_affine_gaps_are_checked_when_the_job_is_set_up(engine, mode, rejected):
+    # Like Blastn_Hadoop, only the full alignments of the scalar engine and the xdrop extensions lack affine gaps
+    job = Align_Hadoop([*AFFINE, '--engine', engine, '--mode', mode, '--cdna_file', 'cdnas.json'])
+    if rejected:
+        with pytest.raises(ValueError):
+            job.steps()
+    else:
+        assert job.steps()
+
+
+def test_banded_affine_alignment_with_scalar_engine(tmp_path):
+    rng = random.Random(3)
+    reads = [{'barcode': 'B%d' % i, 'sequence': random_sequence(rng, 30), 'quality': 'I' * 30} for i in range(4)]
+    cdnas = [{'transcript_id': 'T%d' % i, 'sequence': random_sequence(rng, 20) + read['sequence'] + random_sequence(rng, 20)} for i, read in enumerate(reads)]
+    cdna_file = tmp_path / 'cdnas.json'
+    cdna_file.write_text(''.join(dumps(cdna) + '\n' for cdna in cdnas))
+
+    def run(engine):
+        job = Align_Hadoop(['-r', 'inline', '--no-conf', *AFFINE, '--engine', engine, '--mode', 'banded', '--cdna_file', str(cdna_file)])
+        job.sandbox(stdin=BytesIO(''.join(dumps(read) + '\n' for read in reads).encode('utf_8')))
+        with job.make_runner() as runner:
+            runner.run()
+            return sorted(job.parse_output(runner.cat_output()))
+
+    assert run('scalar') == run('vectorized') == [('T%d' % i, 1) for i in range(4)]
@@ -0,0 +1,83 @@
+import os
+import random
+import shutil
+from json import loads
+import pytest
+from hdfs_upload import LocalClient
+
+pytest.importorskip('pyspark')
+from benchmark_utils import balance_by_cost, get_spark_session, partition_by_length, writeToHadoop, write_matrix_market
+
+
+def random_records(count, seed=7):
+    rng = random.Random(seed)
+    return [{'transcript_id': 'T%d' % i, 'sequence': ''.join(rng.choice('ACGT') for _ in range(rng.randint(1, 300)))} for i in range(count)]
+
+
+def read_lines(path):
+    return [loads(line) for line in path.read_text().splitlines()]
+
+
+def test_write_windows(tmp_path):
+    records = random_records(20)
+    client = LocalClient(str(tmp_path))
+    with pytest.raises(ValueError):
+        writeToHadoop(client, '/cdnas', records, max_length=100)
+    writeToHadoop(client, '/cdnas', records, max_length=100, overlap=40)
+    windows = read_lines(tmp_path / 'cdnas')
+    assert all(len(window['sequence']) <= 100 for window in windows)
+    assert {window['transcript_id'] for window in windows} == {record['transcript_id'] for record in records}
+
+
+def test_balance_by_cost():
+    rng = random.Random(8)
+    for num_partitions in (1, 3, 8):
+        costs = [('k%d' % i, rng.randint(1, 1000)) for i in range(rng.randint(0, 60))]
+        assignment = balance_by_cost(costs, num_partitions)
+        assert sorted(assignment) == sorted(key for key, _ in costs)
+        partition_loads = [0] * num_partitions
+        for key, cost in costs:
+            partition_loads[assignment[key]] += cost
+        # Greedy longest processing time first: no partition exceeds the mean load by more than one item
+        assert max(partition_loads) <= sum(partition_loads) / num_partitions + max([cost for _, cost in costs], default=0)
+
+
+def test_write_balanced_parts(tmp_path):
+    records = random_records(40)
+    writeToHadoop(LocalClient(str(tmp_path)), '/cdnas', records, num_parts=4)
+    parts = [read_lines(tmp_path / 'cdnas' / name) for name in sorted(os.listdir(str(tmp_path / 'cdnas')))]
+    assert len(parts) == 4
+    assert sorted(record['transcript_id'] for part in parts for record in part) == sorted(record['transcript_id'] for record in records)
+    assert all([len(record['sequence']) for record in part] == sorted(len(record['sequence']) for record in part) for part in parts)
+    lengths = [sum(len(record['sequence']) for record in part) for part in parts]
+    assert max(lengths) <= sum(lengths) / 4 + max(len(record['sequence']) for record in records)
+
+
+@pytest.mark.skipif(shutil.which('java') is None, reason='Spark needs a Java runtime')
+def test_partition_by_length():
+    records = random_records(50)
+    spark = get_spark_session('local[2]')
+    try:
+        partitions = partition_by_length(spark.sparkContext.parallelize(records, 3), 4).glom().collect()
+    finally:
+        spark.stop()
+    assert len(partitions) == 4
+    assert sorted(record['transcript_id'] for part in partitions for record in part) == sorted(record['transcript_id'] for record in records)
+    lengths = [sum(len(record['sequence']) for record in part) for part in partitions]
+    assert max(lengths) <= sum(lengths) / 4 + max(len(record['sequence']) for record in records)
+
+
+def test_write_matrix_market(tmp_path):
+    rng = random.Random(9)
+    cells, features = ['AAAC', 'CCGT', 'GTTA'], ['G1', 'G2', 'G3', 'G4']
+    counts = {(cell, feature): rng.randint(1, 9) for cell in cells for feature in features if rng.random() < 0.6}
+    write_matrix_market(((cell, feature, count) for (cell, feature), count in counts.items()), str(tmp_path / 'matrix'))
+    lines = (tmp_path / 'matrix' / 'matrix.mtx').read_text().splitlines()
+    barcodes = (tmp_path / 'matrix' / 'barcodes.tsv').read_text().split()
+    genes = (tmp_path / 'matrix' / 'features.tsv').read_text().split()
+    assert lines[0] == '%%MatrixMarket matrix coordinate integer general'
+    assert lines[1].split() == [str(len(genes)), str(len(barcodes)), str(len(counts))]
+    # Rows are features, columns cells, both indexed from 1
+    entries = {(barcodes[int(col) - 1], genes[int(row) - 1]): int(count) for row, col, count in (line.split() for line in lines[2:])}
+    assert entries == counts
+    assert barcodes == sorted({cell for cell, _ in counts}) and genes == sorted({feature for _, feature in counts})
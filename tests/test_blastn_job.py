@@ -0,0 +1,77 @@
+import random
+from io import BytesIO
+from json import dumps, loads
+import pytest
+from kmer_index import build_kmer_index, save_kmer_index
+from reference_cache import build_reference_cache
+from seq_utils import split_windows
+
+pytest.importorskip('mrjob')
+from blastn_hadoop import Blastn_Hadoop
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+@pytest.fixture
+def cdnas():
+    rng = random.Random(11)
+    return [{'transcript_id': 'T%02d' % i, 'sequence': random_sequence(rng, rng.randint(20, 120))} for i in range(12)]
+
+
+def run_job(args, lines):
+    job = Blastn_Hadoop(['-r', 'inline', '--no-conf', *args])
+    job.sandbox(stdin=BytesIO(''.join(line + '\n' for line in lines).encode('utf_8')))
+    with job.make_runner() as runner:
+        runner.run()
+        # TupleProtocol writes one JSON hit per line
+        return sorted(tuple(loads(line)) for line in b''.join(runner.cat_output()).decode('utf_8').splitlines() if line.strip())
+
+
+def test_reference_cache_ranges(tmp_path, cdnas):
+    query = cdnas[5]['sequence'][10:30]
+    args = ['--query_sequence', query, '--top_k', '3']
+    expected = run_job(args, [dumps(cdna) for cdna in cdnas])
+    cache = str(tmp_path / 'reference.cache')
+    build_reference_cache(cdnas, cache)
+    ranges = [(0, 5), (5, 9), (9, 12)]
+    assert run_job([*args, '--reference_cache', cache], ['%d\t%d' % bound for bound in ranges]) == expected
+    # Hadoop streaming's NLineInputFormat prepends the byte offset of the line
+    assert run_job([*args, '--reference_cache', cache], ['%d\t%d\t%d' % (8 * i, *bound) for i, bound in enumerate(ranges)]) == expected
+
+
+def test_affine_gaps_need_vectorized_engine(cdnas):
+    query = cdnas[2]['sequence'][5:25]
+    args = ['--query_sequence', query, '--gap_open', '-3', '--gap_extend', '-1']
+    # Rejected when the job is set up, not in every mapper
+    with pytest.raises(ValueError):
+        Blastn_Hadoop([*args, '--engine', 'scalar']).steps()
+    hits = run_job([*args, '--engine', 'vectorized'], [dumps(cdna) for cdna in cdnas])
+    assert hits[0][0] == cdnas[2]['transcript_id']
+
+
+def test_kmer_index_of_windows(tmp_path):
+    rng = random.Random(11)
+    cdnas = [{'transcript_id': 'T%02d' % i, 'sequence': random_sequence(rng, rng.randint(80, 400))} for i in range(12)]
+    query = cdnas[7]['sequence'][-40:]
+    windows = list(split_windows(cdnas, 100, 60))
+    save_kmer_index(build_kmer_index(windows, 11), str(tmp_path / 'index.npz'))
+    args = ['--query_sequence', query, '--top_k', '3', '--kmer_index', str(tmp_path / 'index.npz')]
+    lines = [dumps(window) for window in windows]
+    best = max(run_job([*args, '--exhaustive'], lines), key=lambda hit: hit[1])
+    assert best[0] == 'T07' and best[1] == 2 * len(query)
+    assert max(run_job(args, lines), key=lambda hit: hit[1]) == best
+
+
+def test_kmer_index_of_repeated_seeds(tmp_path):
+    rng = random.Random(13)
+    query = 'A' * 30 + random_sequence(rng, 20)
+    cdnas = [{'transcript_id': 'T0', 'sequence': 'A' * 80 + random_sequence(rng, 60) + query},
+             {'transcript_id': 'T1', 'sequence': random_sequence(rng, 100) + 'A' * 40}]
+    save_kmer_index(build_kmer_index(cdnas, 11), str(tmp_path / 'index.npz'))
+    lines = [dumps(cdna) for cdna in cdnas]
+    # The band of the poly-A seeds is wider than the transcript, so it is aligned in full, affine gaps included
+    args = ['--query_sequence', query, '--top_k', '2', '--gap_open', '-3', '--gap_extend', '-1']
+    expected = run_job([*args, '--engine', 'vectorized'], lines)
+    assert run_job([*args, '--engine', 'scalar', '--kmer_index', str(tmp_path / 'index.npz')], lines) == expected
@@ -0,0 +1,32 @@
+import asyncio
+import random
+import pytest
+from blastn_server import BlastnServer
+from local_backend import blastn_local
+from reference_cache import build_reference_cache
+from seq_utils import ScoringScheme
+
+
+@pytest.fixture
+def reference(tmp_path):
+    rng = random.Random(12)
+    cdnas = [{'transcript_id': 'T%02d' % i, 'sequence': ''.join(rng.choice('ACGT') for _ in range(rng.randint(30, 150)))} for i in range(16)]
+    build_reference_cache(cdnas, str(tmp_path / 'reference.cache'))
+    return cdnas, str(tmp_path / 'reference.cache')
+
+
+def test_affine_gaps_need_vectorized_engine(reference):
+    cdnas, cache = reference
+    scoring = ScoringScheme(gap_open=-3, gap_extend=-1)
+    with pytest.raises(ValueError):
+        BlastnServer(cache, processes=1, engine='scalar', scoring=scoring)
+
+    async def query(server, query_sequence):
+        await server.start()
+        try:
+            return await server.query(query_sequence, top_k=2)
+        finally:
+            server.close()
+    query_sequence = cdnas[4]['sequence'][5:35]
+    hits = asyncio.run(query(BlastnServer(cache, processes=1, engine='vectorized', scoring=scoring), query_sequence))
+    assert [tuple(hit) for hit in hits] == [tuple(hit) for hit in blastn_local(query_sequence, cdnas, processes=1, top_k=2, scoring=scoring)[1]]
@@ -0,0 +1,82 @@
+import random
+from json import loads
+import pytest
+from demultiplex import build_barcode_table, correct_barcodes, demultiplex
+
+
+def random_barcode(rng, length=8):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def mutate(rng, barcode, substitutions=1, base='ACGT'):
+    barcode = list(barcode)
+    for position in rng.sample(range(len(barcode)), substitutions):
+        barcode[position] = rng.choice([b for b in base if b != barcode[position]])
+    return ''.join(barcode)
+
+
+def reference_correction(whitelist, barcode):
+    """
+    The whitelist index of a barcode by brute force: itself, else the only whitelisted barcode at Hamming distance 1,
+    or with a single 'N' the only whitelisted barcode matching at the other positions.
+    """
+    if barcode in whitelist:
+        return whitelist.index(barcode), False
+    if barcode.count('N') > 1:
+        return -1, False
+    differences = [sum(a != b for a, b in zip(barcode, other) if a != 'N') for other in whitelist]
+    allowed = 0 if 'N' in barcode else 1
+    matches = [index for index, difference in enumerate(differences) if difference == allowed]
+    return (matches[0], True) if len(matches) == 1 else (-1, False)
+
+
+def test_correct_barcodes_match_brute_force():
+    rng = random.Random(3)
+    # Short barcodes from a small alphabet of variants, so ambiguous neighbours are common
+    whitelist = sorted({random_barcode(rng, 6) for _ in range(300)})
+    barcodes = []
+    for _ in range(2000):
+        barcode = rng.choice(whitelist)
+        # Whitelisted, 1 or 2 substitutions, 1 or 2 N's
+        barcodes.append(rng.choice([barcode, mutate(rng, barcode), mutate(rng, barcode, 2), mutate(rng, barcode, 1, 'N'), mutate(rng, barcode, 2, 'N')]))
+    targets, corrected = correct_barcodes(build_barcode_table(whitelist), barcodes)
+    for barcode, target, is_corrected in zip(barcodes, targets.tolist(), corrected.tolist()):
+        assert (target, is_corrected) == reference_correction(whitelist, barcode), barcode
+
+
+def write_fastq(path, records):
+    with open(path, 'w') as file:
+        for name, sequence, quality in records:
+            file.write('@%s\n%s\n+\n%s\n' % (name, sequence, quality))
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_demultiplex(tmp_path, processes):
+    rng = random.Random(processes)
+    whitelist = [random_barcode(rng, 16) for _ in range(20)]
+    (tmp_path / 'whitelist.txt').write_text('\n'.join(whitelist) + '\n')
+    reads, barcodes, expected = [], [], {}
+    for i in range(500):
+        cell = rng.choice(whitelist)
+        kind = rng.random()
+        barcode = mutate(rng, cell) if kind < 0.3 else random_barcode(rng, 16) if kind < 0.4 else cell
+        umi = random_barcode(rng, 12)
+        bc_quality = 'I' * 28 if rng.random() < 0.9 else '#' + 'I' * 27
+        sequence = random_barcode(rng, 50)
+        reads.append(('r%d' % i, sequence, 'I' * 50))
+        barcodes.append(('r%d' % i, barcode + umi, bc_quality))
+        target, _ = reference_correction(whitelist, barcode)
+        if target >= 0 and bc_quality[0] == 'I':
+            expected[sequence] = whitelist[target] + umi
+    write_fastq(tmp_path / 'R2.fastq', reads)
+    write_fastq(tmp_path / 'R1.fastq', barcodes)
+    counts = demultiplex(str(tmp_path / 'R2.fastq'), str(tmp_path / 'R1.fastq'), str(tmp_path / 'whitelist.txt'), str(tmp_path / 'parts'),
+                         num_parts=3, processes=processes, chunk_size=64)
+    parts = [[loads(line) for line in (tmp_path / 'parts' / ('part-%05d' % part)).read_text().splitlines()] for part in range(3)]
+    records = [record for part in parts for record in part]
+    assert {record['sequence']: record['barcode'] for record in records} == expected
+    assert counts['kept'] == len(expected) == sum(counts['part_reads'])
+    assert counts['reads'] == 500 and counts['low_quality'] + counts['no_match'] + counts['kept'] == 500
+    # All reads of a cell are in one part
+    cells = [{record['cell'] for record in part} for part in parts]
+    assert sum(len(part) for part in cells) == len(set.union(*cells))
@@ -0,0 +1,111 @@
+import bz2
+import os
+import random
+from json import loads
+from threading import Thread
+import pytest
+from hdfs_upload import LocalClient, bulkWriteToHadoop, serialize_blocks
+
+
+def random_records(count, seed=3):
+    rng = random.Random(seed)
+    return [{'transcript_id': 'T%d' % i, 'sequence': ''.join(rng.choice('ACGT') for _ in range(rng.randint(0, 300)))} for i in range(count)]
+
+
+def read_parts(root, compression=None):
+    records = []
+    for name in sorted(os.listdir(root)):
+        with open(os.path.join(root, name), 'rb') as file:
+            data = file.read()
+        records += [loads(line) for line in (bz2.decompress(data) if compression else data).decode('utf-8').splitlines()]
+    return records
+
+
+class FailingClient(LocalClient):
+    """
+    LocalClient whose part writers fail in write or when they are closed.
+    """
+
+    def __init__(self, root, fail_on):
+        super().__init__(root)
+        self.fail_on = fail_on
+
+    def write(self, hdfs_path, data=None, overwrite=False, encoding=None):
+        writer = super().write(hdfs_path, overwrite=overwrite)
+        fail_on = self.fail_on
+
+        class Writer:
+            def write(self, data):
+                if fail_on == 'write':
+                    raise IOError('write failed')
+                writer.write(data)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                writer.__exit__(*exc)
+                if fail_on == 'close':
+                    raise IOError('close failed')
+        return Writer()
+
+
+def test_serialize_blocks():
+    records = random_records(200)
+    blocks = list(serialize_blocks(iter(records), block_size=1000))
+    assert len(blocks) > 1 and all(block.endswith(b'\n') for block in blocks)
+    assert [loads(line) for block in blocks for line in block.decode('utf-8').splitlines()] == records
+
+
+@pytest.mark.parametrize('compression', [None, 'bz2'])
+@pytest.mark.parametrize('num_parts', [1, 3])
+def test_bulk_upload_roundtrip(tmp_path, compression, num_parts):
+    records = random_records(500)
+    stats = bulkWriteToHadoop(LocalClient(str(tmp_path)), '/data/cdnas', iter(records), num_parts, block_size=2000, compression=compression)
+    names = sorted(os.listdir(str(tmp_path / 'data' / 'cdnas')))
+    assert names == ['part-%05d%s' % (part, '.bz2' if compression else '') for part in range(num_parts)]
+    uploaded = read_parts(str(tmp_path / 'data' / 'cdnas'), compression)
+    assert sorted(uploaded, key=lambda record: int(record['transcript_id'][1:])) == records
+    assert stats['records'] == len(records)
+    assert stats['bytes_written'] == sum(os.path.getsize(str(tmp_path / 'data' / 'cdnas' / name)) for name in names)
+
+
+def test_unsupported_compression(tmp_path):
+    with pytest.raises(ValueError):
+        bulkWriteToHadoop(LocalClient(str(tmp_path)), '/data', [], compression='gzip')
+
+
+@pytest.mark.parametrize('fail_on', ['write', 'close'])
+@pytest.mark.parametrize('compression', [None, 'bz2'])
+def test_failed_part_is_raised(tmp_path, fail_on, compression):
+    errors = []
+
+    def upload():
+        try:
+            bulkWriteToHadoop(FailingClient(str(tmp_path), fail_on), '/data', random_records(300), 2, block_size=1000,
+                              compression=compression, queue_blocks=1)
+        except IOError as e:
+            errors.append(e)
+    thread = Thread(target=upload, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), 'the upload hangs'
+    assert [str(e) for e in errors] == ['%s failed' % fail_on]
+
+
+def test_serializer_error_is_raised(tmp_path):
+    def records():
+        yield from random_records(50)
+        raise RuntimeError('bad record')
+    with pytest.raises(RuntimeError, match='bad record'):
+        bulkWriteToHadoop(LocalClient(str(tmp_path)), '/data', records(), 2, block_size=100, queue_blocks=1)
+
+
+def test_local_client(tmp_path):
+    client = LocalClient(str(tmp_path))
+    client.write('/a/b.txt', data='ACGT')
+    with pytest.raises(FileExistsError):
+        client.write('/a/b.txt', data='ACGT')
+    assert client.status('/a/b.txt')['length'] == 4 and client.status('/a/c.txt', strict=False) is None
+    assert client.list('/a') == ['b.txt'] and client.list('/a', status=True)[0][1]['type'] == 'FILE'
+    assert client.delete('/a', recursive=True) and not client.delete('/a')
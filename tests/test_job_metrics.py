@@ -0,0 +1,12 @@
+import pytest
+from job_metrics import banded_cells, full_cells
+
+
+@pytest.mark.parametrize('m, n', [(0, 10), (10, 0), (5, 5), (20, 300), (300, 20), (1, 1)])
+@pytest.mark.parametrize('diagonal', [-40, -3, 0, 7, 250])
+@pytest.mark.parametrize('band_width', [0, 2, 16])
+def test_banded_cells(m, n, diagonal, band_width):
+    seq1, seq2 = 'A' * m, 'C' * n
+    in_band = sum(1 for i in range(1, m + 1) for j in range(1, n + 1) if abs(j - i - diagonal) <= band_width)
+    assert banded_cells(seq1, seq2, None, -2, diagonal, band_width) == in_band
+    assert banded_cells(seq1, seq2, None, -2, diagonal, band_width) <= min(full_cells(seq1, seq2), m * (2 * band_width + 1))
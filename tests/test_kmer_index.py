@@ -0,0 +1,55 @@
+import random
+from kmer_index import build_kmer_index, find_candidates, load_kmer_index, save_kmer_index, seeded_alignment
+from seq_utils import banded_smith_waterman, gap_penalty, kmer_codes, smith_waterman_vectorized, split_windows, substitution_matrix
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGTACGTN') for _ in range(length))
+
+
+def test_kmer_candidates_match_brute_force(tmp_path):
+    rng = random.Random(4)
+    k = 5
+    cdnas = [{'transcript_id': 'T%d' % i, 'sequence': random_sequence(rng, rng.randint(10, 80))} for i in range(40)]
+    save_kmer_index(build_kmer_index(cdnas, k), str(tmp_path / 'index.npz'))
+    index = load_kmer_index(str(tmp_path / 'index.npz'))
+    query = cdnas[7]['sequence'][3:30]
+    query_kmers = kmer_codes(query, k).tolist()
+    expected = {}
+    for cdna in cdnas:
+        diagonals = {j - i for i, a in enumerate(query_kmers) if a >= 0 for j, b in enumerate(kmer_codes(cdna['sequence'], k).tolist()) if a == b}
+        if diagonals:
+            expected[cdna['transcript_id']] = sorted(diagonals)
+    assert find_candidates(index, query) == expected
+
+
+def test_windows_are_indexed_at_transcript_positions():
+    rng = random.Random(5)
+    cdnas = [{'transcript_id': 'T%d' % i, 'sequence': random_sequence(rng, rng.randint(10, 400))} for i in range(20)]
+    query = cdnas[3]['sequence'][-60:]
+    windows = list(split_windows(cdnas, 100, 60))
+    assert find_candidates(build_kmer_index(windows, 7), query) == find_candidates(build_kmer_index(cdnas, 7), query)
+
+
+def test_wide_seed_bands_fall_back_to_full_alignment():
+    rng = random.Random(6)
+    calls = []
+
+    def recorded(name, engine):
+        def align(*args):
+            calls.append(name)
+            return engine(*args)
+        return align
+    banded, full = recorded('banded', banded_smith_waterman), recorded('full', smith_waterman_vectorized)
+    # The poly-A stretch of the query seeds every diagonal of the poly-A stretches of the transcript
+    query = 'A' * 30 + random_sequence(rng, 20).replace('N', 'C')
+    transcript = 'A' * 80 + random_sequence(rng, 60).replace('N', 'C') + query
+    cdnas = [{'transcript_id': 'T0', 'sequence': transcript}]
+    diagonals = find_candidates(build_kmer_index(cdnas, 7), query)['T0']
+    alignment = seeded_alignment(query, transcript, diagonals, 4, 0, substitution_matrix, gap_penalty, banded, full)
+    assert calls == ['full'] and alignment == smith_waterman_vectorized(query, transcript, substitution_matrix, gap_penalty)
+    # A unique seed keeps the band
+    query = transcript[85:115]
+    diagonals = find_candidates(build_kmer_index(cdnas, 7), query)['T0']
+    assert seeded_alignment(query, transcript, diagonals, 4, 0, substitution_matrix, gap_penalty, banded, full)[0] == 2 * len(query)
+    assert calls == ['full', 'banded']
@@ -0,0 +1,43 @@
+import random
+import pytest
+from local_backend import align_local, blastn_local
+from reducer_utils import top_hits
+from seq_utils import gap_penalty, quality_adjusted_smith_waterman, smith_waterman, substitution_matrix
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+@pytest.fixture
+def cdnas():
+    rng = random.Random(5)
+    cdnas = [{'transcript_id': 'T%02d' % i, 'sequence': random_sequence(rng, rng.randint(20, 100))} for i in range(24)]
+    # Duplicates, so the tie policies matter
+    return cdnas + [{'transcript_id': 'T%02d' % (24 + i), 'sequence': cdnas[i]['sequence']} for i in range(4)]
+
+
+@pytest.mark.parametrize('top_k', [1, 3])
+@pytest.mark.parametrize('ties', ['all', 'lowest_id'])
+def test_blastn_local_top_k(cdnas, top_k, ties):
+    query = cdnas[1]['sequence'][5:25]
+    expected = top_hits(((cdna['transcript_id'], *smith_waterman(query, cdna['sequence'], substitution_matrix, gap_penalty)) for cdna in cdnas), top_k, ties)
+    _, out = blastn_local(query, cdnas, processes=2, engine='scalar', top_k=top_k, ties=ties)
+    assert out == expected
+
+
+@pytest.mark.parametrize('top_k', [1, 2])
+@pytest.mark.parametrize('ties', ['all', 'lowest_id'])
+def test_align_local_top_k(cdnas, top_k, ties):
+    rng = random.Random(top_k)
+    sequences = []
+    for i in range(10):
+        read = cdnas[rng.randrange(len(cdnas))]['sequence'][:18]
+        sequences.append({'barcode': 'B%d' % i, 'sequence': read, 'quality': 'I' * len(read)})
+    counts = {}
+    for seq in sequences:
+        alignments = ((cdna['transcript_id'], quality_adjusted_smith_waterman(seq['sequence'], seq['quality'], cdna['sequence'], substitution_matrix, gap_penalty)[0]) for cdna in cdnas)
+        for transcript_id, _ in top_hits(alignments, top_k, ties):
+            counts[transcript_id] = counts.get(transcript_id, 0) + 1
+    _, out = align_local(cdnas, sequences, processes=2, top_k=top_k, ties=ties)
+    assert sorted(out) == sorted(counts.items())
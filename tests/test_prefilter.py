@@ -0,0 +1,77 @@
+import random
+from io import BytesIO
+from json import dumps
+import pytest
+from seq_utils import gap_penalty, prefilter_alignments, quality_adjusted_smith_waterman, quality_alignment_engines, quality_score_bound, substitution_matrix
+from reducer_utils import top_hits
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def random_quality(rng, length):
+    return ''.join(chr(33 + rng.randint(2, 41)) for _ in range(length))
+
+
+def tied_reference(rng, read, transcripts=6):
+    """
+    Transcripts around the read (tying for the best score) and random ones.
+    """
+    cdnas = [('T%d' % i, random_sequence(rng, rng.randint(5, 40)) + read + random_sequence(rng, rng.randint(5, 40))) for i in range(2)]
+    return cdnas + [('T%d' % i, random_sequence(rng, 80)) for i in range(2, transcripts)]
+
+
+def test_bound_ties_drifting_score():
+    # The scalar engine scores 30.550000000000004, the exact bound is 30.55
+    read, quality = 'AGGAGCCAACTGCGTATCTGGGGTATAAAG', 'GA<F6*&&C@9/,-5.<;41F<12$.D#=-'
+    score = quality_adjusted_smith_waterman(read, quality, 'CCCC' + read + 'GGGG', substitution_matrix, gap_penalty)[0]
+    assert quality_score_bound(read, quality, 'TTTT' + read + 'AAAA', substitution_matrix, gap_penalty) == pytest.approx(score)
+    cdnas = [('T1', 'CCCC' + read + 'GGGG'), ('T2', 'TTTT' + read + 'AAAA')]
+    alignments = list(prefilter_alignments(read, quality, cdnas, quality_adjusted_smith_waterman, substitution_matrix, gap_penalty))
+    assert all(alignment is not None for _, alignment in alignments)
+
+
+@pytest.mark.parametrize('engine', ['scalar', 'vectorized'])
+@pytest.mark.parametrize('top_k', [1, 2, 3])
+def test_prefilter_keeps_top_hits(engine, top_k):
+    rng = random.Random(top_k)
+    quality_adjusted_smith_waterman = quality_alignment_engines[engine]
+    for _ in range(20):
+        read = random_sequence(rng, rng.randint(10, 40))
+        quality = random_quality(rng, len(read))
+        cdnas = tied_reference(rng, read)
+        rng.shuffle(cdnas)
+        full = [(transcript_id, quality_adjusted_smith_waterman(read, quality, seq2, substitution_matrix, gap_penalty)[0]) for transcript_id, seq2 in cdnas]
+        pruned = [(transcript_id, alignment[0]) for transcript_id, alignment in prefilter_alignments(read, quality, cdnas, quality_adjusted_smith_waterman, substitution_matrix, gap_penalty, top_k)
+                  if alignment is not None]
+        for ties in ('all', 'lowest_id'):
+            assert sorted(top_hits(pruned, top_k, ties)) == sorted(top_hits(full, top_k, ties))
+
+
+@pytest.mark.parametrize('mode', ['cartesian', 'broadcast'])
+def test_alignment_job_prefilter_output(tmp_path, mode):
+    pytest.importorskip('mrjob')
+    from alignment_hadoop import Align_Hadoop
+    rng = random.Random(7)
+    reads = []
+    for i in range(8):
+        read = random_sequence(rng, 30)
+        reads.append({'barcode': 'B%d' % i, 'sequence': read, 'quality': random_quality(rng, 30)})
+    cdnas = [{'transcript_id': 'T%d' % i, 'sequence': random_sequence(rng, 10) + reads[i % len(reads)]['sequence'] + random_sequence(rng, 10)} for i in range(16)]
+    cdna_file = tmp_path / 'cdnas.json'
+    cdna_file.write_text(''.join(dumps(cdna) + '\n' for cdna in cdnas))
+    stdin = ''.join(dumps(record) + '\n' for record in (reads if mode == 'broadcast' else cdnas + reads)).encode('utf_8')
+
+    def run(*args):
+        args = ['-r', 'inline', '--no-conf', *(['--cdna_file', str(cdna_file)] if mode == 'broadcast' else []), *args]
+        job = Align_Hadoop(args)
+        job.sandbox(stdin=BytesIO(stdin))
+        with job.make_runner() as runner:
+            runner.run()
+            return sorted(job.parse_output(runner.cat_output()))
+
+    output = run()
+    # Every read ties between the two transcripts around it
+    assert output == sorted(('T%d' % i, 1) for i in range(16))
+    assert run('--prefilter') == output
@@ -0,0 +1,65 @@
+import random
+from functools import reduce
+import pytest
+from reducer_utils import first_hit, merge_hit, merge_hits, top_hits
+
+
+def reference_top(hits, k, ties, unique=False):
+    """
+    The top-k by definition: with 'all' every hit scoring at least the k-th best score, with 'lowest_id' the first k
+    by decreasing score and increasing id; with unique only the best hit of each id takes part.
+    """
+    if unique:
+        best = {}
+        for hit in hits:
+            if hit[0] not in best or hit[1] > best[hit[0]][1]:
+                best[hit[0]] = hit
+        hits = list(best.values())
+    ordered = sorted(hits, key=lambda hit: (-hit[1], hit[0], hit[2:]))
+    if len(ordered) <= k:
+        return ordered
+    if ties == 'all':
+        return [hit for hit in ordered if hit[1] >= ordered[k - 1][1]]
+    return ordered[:k]
+
+
+def random_hits(rng, count, ids=20):
+    # Few distinct scores and ids, so ties and repeated ids are frequent; the payload tells hits apart
+    return [('T%02d' % rng.randrange(ids), rng.randint(0, 6), chr(97 + i % 26)) for i in range(count)]
+
+
+def same_hits(a, b):
+    return [hit[:2] for hit in a] == [hit[:2] for hit in b]
+
+
+@pytest.mark.parametrize('k', [1, 2, 5])
+@pytest.mark.parametrize('ties', ['all', 'lowest_id'])
+@pytest.mark.parametrize('unique', [False, True])
+def test_top_hits(k, ties, unique):
+    rng = random.Random(k)
+    for _ in range(200):
+        hits = random_hits(rng, rng.randint(0, 30))
+        assert same_hits(top_hits(hits, k, ties, unique), reference_top(hits, k, ties, unique))
+
+
+@pytest.mark.parametrize('k', [1, 3])
+@pytest.mark.parametrize('ties', ['all', 'lowest_id'])
+@pytest.mark.parametrize('unique', [False, True])
+def test_merge_of_partitions(k, ties, unique):
+    # Like combineByKey: every partition keeps its top-k, the partial lists are merged in any order
+    rng = random.Random(10 + k)
+    for _ in range(200):
+        hits = random_hits(rng, rng.randint(1, 40))
+        cuts = sorted(rng.sample(range(1, len(hits) + 1), min(3, len(hits))))
+        partitions = [hits[start:end] for start, end in zip([0] + cuts, cuts + [len(hits)])]
+        partials = [reduce(lambda top, hit: merge_hit(top, hit, k, ties, unique), partition[1:], first_hit(partition[0]))
+                    for partition in partitions if partition]
+        rng.shuffle(partials)
+        merged = reduce(lambda a, b: merge_hits(a, b, k, ties, unique), partials, [])
+        assert same_hits(merged, reference_top(hits, k, ties, unique))
+
+
+def test_unique_keeps_best_hit_per_id():
+    hits = [('T1', 3, 'window 0'), ('T2', 4, 'window 0'), ('T1', 5, 'window 1'), ('T3', 5, 'window 0')]
+    assert top_hits(hits, 2, 'all', unique=True) == [('T1', 5, 'window 1'), ('T3', 5, 'window 0')]
+    assert top_hits(hits, 3, 'lowest_id', unique=True) == [('T1', 5, 'window 1'), ('T3', 5, 'window 0'), ('T2', 4, 'window 0')]
@@ -0,0 +1,27 @@
+import random
+from reference_cache import build_reference_cache, cache_is_valid, cached_records, open_reference_cache, reference_cache
+from seq_utils import decode_sequence
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGTACGTN') for _ in range(length))
+
+
+def test_cache_roundtrip(tmp_path):
+    rng = random.Random(2)
+    cdnas = [{'transcript_id': 'T%d' % i, 'sequence': random_sequence(rng, rng.randint(0, 200))} for i in range(30)]
+    build_reference_cache(cdnas, str(tmp_path / 'reference.cache'))
+    cache = open_reference_cache(str(tmp_path / 'reference.cache'))
+    assert [(record['transcript_id'], decode_sequence(record['sequence'])) for record in cached_records(cache)] == \
+        [(cdna['transcript_id'], cdna['sequence']) for cdna in cdnas]
+    assert [record['transcript_id'] for record in cached_records(cache, 10, 12)] == ['T10', 'T11']
+
+
+def test_cache_is_rebuilt_when_stale(tmp_path):
+    fasta = tmp_path / 'cdna.fa'
+    fasta.write_text('>T1 gene:G1\nACGTACGT\n>T2 gene:G2\nGGGG\n')
+    assert not cache_is_valid(str(fasta) + '.refcache', str(fasta))
+    assert reference_cache(str(fasta))['transcript_ids'] == ['T1', 'T2']
+    assert cache_is_valid(str(fasta) + '.refcache', str(fasta))
+    fasta.write_text('>T1 gene:G1\nACGTACGT\n>T2 gene:G2\nGGGG\n>T3 gene:G3\nCCCCAAAA\n')
+    assert reference_cache(str(fasta))['transcript_ids'] == ['T1', 'T2', 'T3']
@@ -0,0 +1,85 @@
+import os
+import random
+from json import dumps, loads
+import pytest
+from hdfs_upload import LocalClient
+from reducer_utils import top_hits
+from result_store import incremental_blastn, search_key
+from seq_utils import ScoringScheme, gap_penalty, smith_waterman, substitution_matrix
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    rng = random.Random(6)
+    root = tmp_path / 'hdfs'
+    (root / 'cdnas').mkdir(parents=True)
+    client = LocalClient(str(root))
+    searched = []
+
+    def write_part(name, count):
+        records = [{'transcript_id': '%s-%d' % (name, i), 'sequence': random_sequence(rng, rng.randint(20, 60))} for i in range(count)]
+        (root / 'cdnas' / name).write_text(''.join(dumps(record) + '\n' for record in records))
+        return records
+
+    def blastn(query_sequence, filepath, top_k=1, ties='all', scoring=None, **kw):
+        # Stands in for blastn_pyspark or blastn_hadoop on one part
+        searched.append(filepath)
+        with open(os.path.join(str(root), filepath.lstrip('/'))) as file:
+            records = [loads(line) for line in file]
+        hits = ((record['transcript_id'], *smith_waterman(query_sequence, record['sequence'], substitution_matrix, gap_penalty)) for record in records)
+        return 0.0, top_hits(hits, top_k, ties)
+
+    def full_scan(query_sequence, top_k, ties):
+        records = [loads(line) for name in sorted(os.listdir(str(root / 'cdnas'))) if not name.startswith('_')
+                   for line in (root / 'cdnas' / name).read_text().splitlines()]
+        return top_hits(((record['transcript_id'], *smith_waterman(query_sequence, record['sequence'], substitution_matrix, gap_penalty)) for record in records), top_k, ties)
+
+    return client, write_part, blastn, searched, full_scan, str(tmp_path / 'store')
+
+
+def test_incremental_runs(dataset):
+    client, write_part, blastn, searched, full_scan, store = dataset
+    parts = {name: write_part(name, 10) for name in ('part-00000', 'part-00001', 'part-00002')}
+    query = parts['part-00001'][3]['sequence'][5:20]
+
+    def search(top_k=3, ties='all'):
+        del searched[:]
+        _, hits = incremental_blastn(blastn, client, '/cdnas', store, query, top_k, ties)
+        assert hits == full_scan(query, top_k, ties)
+        return sorted(path.rsplit('/', 1)[1] for path in searched)
+
+    assert search() == ['part-00000', 'part-00001', 'part-00002']
+    assert search() == []
+    # New and rewritten parts are searched, removed ones are dropped
+    write_part('part-00003', 5)
+    assert search() == ['part-00003']
+    write_part('part-00000', 12)
+    assert search() == ['part-00000']
+    os.remove(os.path.join(client.root, 'cdnas', 'part-00002'))
+    assert search() == []
+    # Another search has its own results
+    assert search(top_k=1, ties='lowest_id') == ['part-00000', 'part-00001', 'part-00003']
+
+
+def test_datasets_have_their_own_results(dataset):
+    client, write_part, blastn, searched, _, store = dataset
+    os.makedirs(os.path.join(client.root, 'other'))
+    write_part('part-00000', 6)
+    os.rename(os.path.join(client.root, 'cdnas', 'part-00000'), os.path.join(client.root, 'other', 'part-00000'))
+    write_part('part-00000', 6)
+    for _ in range(2):
+        for filepath in ('/cdnas', '/other'):
+            incremental_blastn(blastn, client, filepath, store, 'ACGTACGTAC')
+    assert searched == ['/cdnas/part-00000', '/other/part-00000']
+
+
+def test_search_key():
+    _, key = search_key('ACGT', top_k=1, ties='all')
+    assert search_key('ACGT', ties='all', top_k=1)[1] == key
+    assert search_key('ACGA', top_k=1, ties='all')[1] != key
+    assert search_key('ACGT', top_k=2, ties='all')[1] != key
+    assert search_key('ACGT', ScoringScheme(gap_open=-5, gap_extend=-1), top_k=1, ties='all')[1] != key
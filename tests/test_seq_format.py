@@ -0,0 +1,41 @@
+import random
+import pytest
+from seq_format import decode_attributes, decode_record, encode_attributes, encode_record, pack_sequence, unpack_sequence
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGTACGTACGTN') for _ in range(length))
+
+
+@pytest.mark.parametrize('length', [0, 1, 3, 4, 5, 31, 64, 1001])
+def test_pack_roundtrip(length):
+    rng = random.Random(length)
+    for _ in range(20):
+        sequence = random_sequence(rng, length)
+        packed, nmask = pack_sequence(sequence)
+        assert len(packed) == -(-length // 4)
+        assert unpack_sequence(packed, length, nmask) == sequence
+
+
+def test_non_acgt_bases_read_back_as_n():
+    packed, nmask = pack_sequence('ACRYNNT')
+    assert unpack_sequence(packed, 7, nmask) == 'ACNNNNT'
+    assert nmask == [(2, 4)]
+
+
+def test_record_roundtrip():
+    rng = random.Random(1)
+    cdna = {'transcript_id': 'ENST00000000001.1', 'sequence': random_sequence(rng, 150)}
+    read = {'barcode': 'ACGTACGTACGTACGTAAACCCGGGTTT', 'sequence': random_sequence(rng, 90), 'quality': ''.join(chr(33 + rng.randint(2, 41)) for _ in range(90))}
+    assert decode_record(encode_record(cdna)) == cdna
+    assert decode_record(encode_record(read)) == read
+    assert '\n' not in encode_record(read)
+
+
+def test_attributes_roundtrip():
+    records = [
+        {'transcript_id': 'T1', 'attributes': {'gene': 'G1', 'gene_symbol': 'ABC'}},
+        {'transcript_id': 'T2', 'attributes': {'gene': 'G1'}},
+        {'transcript_id': 'T3'},
+    ]
+    assert decode_attributes(encode_attributes(records)) == {'T1': {'gene': 'G1', 'gene_symbol': 'ABC'}, 'T2': {'gene': 'G1'}, 'T3': {}}
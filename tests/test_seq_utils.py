@@ -0,0 +1,185 @@
+import random
+import numpy as np
+import pytest
+from seq_utils import ALPHABET, ScoringScheme, banded_smith_waterman, myers_distance, quality_adjusted_smith_waterman, \
+    quality_adjusted_smith_waterman_score, quality_adjusted_smith_waterman_vectorized, quality_score_bound, profile_score_bound, \
+    score_bound_profile, score_table, smith_waterman, smith_waterman_score, smith_waterman_score_batch, smith_waterman_vectorized, \
+    split_windows, gap_penalty, substitution_matrix
+
+AFFINE = [(-5, -1), (-3, -2), (-4, -1)]
+
+
+def random_sequence(rng, length, n_rate=0.05):
+    return ''.join('N' if rng.random() < n_rate else rng.choice('ACGT') for _ in range(length))
+
+
+def random_quality(rng, length):
+    return ''.join(chr(33 + rng.randint(2, 40)) for _ in range(length))
+
+
+def random_pairs(seed, count=60):
+    rng = random.Random(seed)
+    for _ in range(count):
+        seq1 = random_sequence(rng, rng.randint(1, 25))
+        # Half of the transcripts contain a mutated copy of the query
+        seq2 = random_sequence(rng, rng.randint(1, 40)) if rng.random() < 0.5 else \
+            random_sequence(rng, rng.randint(0, 10)) + seq1[rng.randint(0, 3):] + random_sequence(rng, rng.randint(0, 10))
+        yield seq1, random_quality(rng, len(seq1)), seq2
+
+
+def gotoh(seq1, seq2, gap_open, gap_extend, quality=None):
+    """
+    Textbook O(m * n) Gotoh local alignment score, the reference of the engines.
+    """
+    table = score_table(substitution_matrix)
+    m, n = len(seq1), len(seq2)
+    H, E, F = np.zeros((m + 1, n + 1)), np.full((m + 1, n + 1), -np.inf), np.full((m + 1, n + 1), -np.inf)
+    for i in range(1, m + 1):
+        for j in range(1, n + 1):
+            score = table[ALPHABET.index(seq1[i - 1]), ALPHABET.index(seq2[j - 1])]
+            if quality:
+                score *= (ord(quality[i - 1]) - 33) / 40
+            E[i, j] = max(H[i, j - 1] + gap_open, E[i, j - 1] + gap_extend)
+            F[i, j] = max(H[i - 1, j] + gap_open, F[i - 1, j] + gap_extend)
+            H[i, j] = max(0, H[i - 1, j - 1] + score, E[i, j], F[i, j])
+    return H.max()
+
+
+def rescore(align1, align2, gap_open, gap_extend):
+    """
+    Score of an alignment from its aligned sequences.
+    """
+    table = score_table(substitution_matrix)
+    score, gap = 0, None
+    for a, b in zip(align1, align2):
+        if '-' in (a, b):
+            side = a == '-'
+            score += gap_extend if gap == side else gap_open
+            gap = side
+        else:
+            score += table[ALPHABET.index(a), ALPHABET.index(b)]
+            gap = None
+    return score
+
+
+def check_alignment(seq1, seq2, alignment, gap_open, gap_extend):
+    score, align1, align2 = alignment
+    if score:
+        assert rescore(align1, align2, gap_open, gap_extend) == pytest.approx(score)
+        assert align1.replace('-', '') in seq1 and align2.replace('-', '') in seq2
+
+
+def edit_distance(pattern, text):
+    """
+    Semi-global edit distance by dynamic programming: the pattern may start and end anywhere in the text.
+    'N' matches nothing, like in myers_distance.
+    """
+    previous = list(range(len(pattern) + 1))
+    best = previous[-1]
+    for base in text:
+        current = [0]
+        for i, p in enumerate(pattern, 1):
+            current.append(min(previous[i] + 1, current[i - 1] + 1, previous[i - 1] + (p != base or p == 'N')))
+        best = min(best, current[-1])
+        previous = current
+    return best
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_linear_engines_match_scalar(seed):
+    for seq1, _, seq2 in random_pairs(seed):
+        expected = smith_waterman(seq1, seq2, substitution_matrix, gap_penalty)
+        assert smith_waterman_vectorized(seq1, seq2, substitution_matrix, gap_penalty)[0] == expected[0]
+        check_alignment(seq1, seq2, smith_waterman_vectorized(seq1, seq2, substitution_matrix, gap_penalty), gap_penalty, gap_penalty)
+        assert smith_waterman_score(seq1, seq2, substitution_matrix, gap_penalty) == expected[0]
+        # A band covering the whole matrix is the full alignment
+        assert banded_smith_waterman(seq1, seq2, substitution_matrix, gap_penalty, 0, len(seq1) + len(seq2))[0] == expected[0]
+        batch = smith_waterman_score_batch([seq1, seq2, seq1[::-1]], seq2, substitution_matrix, gap_penalty)
+        assert batch == [expected[0], smith_waterman(seq2, seq2, substitution_matrix, gap_penalty)[0], smith_waterman(seq1[::-1], seq2, substitution_matrix, gap_penalty)[0]]
+
+
+@pytest.mark.parametrize('seed', range(2))
+def test_quality_engines_match_scalar(seed):
+    for seq1, quality, seq2 in random_pairs(seed):
+        expected = quality_adjusted_smith_waterman(seq1, quality, seq2, substitution_matrix, gap_penalty)[0]
+        assert expected == pytest.approx(gotoh(seq1, seq2, gap_penalty, gap_penalty, quality))
+        assert quality_adjusted_smith_waterman_vectorized(seq1, quality, seq2, substitution_matrix, gap_penalty)[0] == pytest.approx(expected)
+        assert quality_adjusted_smith_waterman_score(seq1, quality, seq2, substitution_matrix, gap_penalty) == pytest.approx(expected)
+
+
+def test_narrow_band_alignments_are_valid():
+    rng = random.Random(4)
+    for seq1, _, seq2 in random_pairs(4):
+        diagonal = rng.randint(-3, 3)
+        alignment = banded_smith_waterman(seq1, seq2, substitution_matrix, gap_penalty, diagonal, 2)
+        assert alignment[0] <= smith_waterman(seq1, seq2, substitution_matrix, gap_penalty)[0]
+        check_alignment(seq1, seq2, alignment, gap_penalty, gap_penalty)
+
+
+def test_myers_matches_dynamic_programming():
+    rng = random.Random(8)
+    for _ in range(300):
+        pattern = random_sequence(rng, rng.randint(0, 80), 0.1)
+        text = random_sequence(rng, rng.randint(0, 120), 0.1) if rng.random() < 0.5 else \
+            random_sequence(rng, 15) + pattern[rng.randint(0, 5):] + random_sequence(rng, 15)
+        assert myers_distance(pattern, text) == edit_distance(pattern, text)
+
+
+def test_quality_score_bound():
+    for seq1, quality, seq2 in random_pairs(9, 150):
+        score = quality_adjusted_smith_waterman(seq1, quality, seq2, substitution_matrix, gap_penalty)[0]
+        assert quality_score_bound(seq1, quality, seq2, substitution_matrix, gap_penalty) >= score - 1e-9
+    for gap_open, gap_extend in AFFINE:
+        for seq1, quality, seq2 in random_pairs(gap_extend, 30):
+            assert quality_score_bound(seq1, quality, seq2, substitution_matrix, (gap_open, gap_extend)) >= gotoh(seq1, seq2, gap_open, gap_extend, quality) - 1e-9
+
+
+def test_split_windows_cover_long_transcripts():
+    rng = random.Random(10)
+    records = [{'transcript_id': 'T%d' % i, 'sequence': random_sequence(rng, length)} for i, length in enumerate((5, 100, 257))]
+    windows = list(split_windows(records, 64, 16))
+    for record in records:
+        parts = [window for window in windows if window['transcript_id'] == record['transcript_id']]
+        assert all(len(window['sequence']) <= 64 for window in parts)
+        # Every stretch of overlap bases lies within one window
+        for start in range(len(record['sequence']) - 16 + 1):
+            assert any(window.get('window', 0) <= start and start + 16 <= window.get('window', 0) + len(window['sequence']) for window in parts)
+
+
+@pytest.mark.parametrize('gap_open, gap_extend', AFFINE)
+def test_affine_engines_match_gotoh(gap_open, gap_extend):
+    scoring = ScoringScheme(gap_open=gap_open, gap_extend=gap_extend)
+    table, gaps = scoring.substitution_matrix, scoring.gap_penalty
+    for seq1, quality, seq2 in random_pairs(gap_open):
+        expected = gotoh(seq1, seq2, gap_open, gap_extend)
+        alignment = smith_waterman_vectorized(seq1, seq2, table, gaps)
+        assert alignment[0] == pytest.approx(expected)
+        check_alignment(seq1, seq2, alignment, gap_open, gap_extend)
+        assert smith_waterman_score(seq1, seq2, table, gaps) == pytest.approx(expected)
+        assert smith_waterman_score_batch([seq1, seq2], seq2, table, gaps) == pytest.approx([expected, gotoh(seq2, seq2, gap_open, gap_extend)])
+        banded = banded_smith_waterman(seq1, seq2, table, gaps, 0, len(seq1) + len(seq2))
+        assert banded[0] == pytest.approx(expected)
+        check_alignment(seq1, seq2, banded, gap_open, gap_extend)
+        expected = gotoh(seq1, seq2, gap_open, gap_extend, quality)
+        assert quality_adjusted_smith_waterman_vectorized(seq1, quality, seq2, table, gaps)[0] == pytest.approx(expected)
+        assert quality_adjusted_smith_waterman_score(seq1, quality, seq2, table, gaps) == pytest.approx(expected)
+
+
+def test_scalar_engines_reject_affine_gaps():
+    with pytest.raises(ValueError):
+        smith_waterman('ACGT', 'ACGT', substitution_matrix, (-5, -1))
+    with pytest.raises(ValueError):
+        ScoringScheme(gap_open=-1, gap_extend=-3)
+
+
+def test_score_bound_profile():
+    rng = random.Random(13)
+    for gaps in [gap_penalty, *AFFINE]:
+        seq1 = random_sequence(rng, 40)
+        quality = random_quality(rng, 40)
+        profile = score_bound_profile(seq1, quality, substitution_matrix, gaps)
+        for _ in range(30):
+            seq2 = random_sequence(rng, rng.randint(0, 120))
+            assert profile_score_bound(profile, seq1, seq2) == pytest.approx(quality_score_bound(seq1, quality, seq2, substitution_matrix, gaps))
+    # A matrix rewarding mismatches admits no bound
+    assert profile_score_bound(score_bound_profile('ACGT', 'IIII', {**substitution_matrix, ('A', 'C'): 1}, gap_penalty), 'ACGT', 'CCCC') == np.inf